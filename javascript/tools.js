@@ -360,8 +360,30 @@ const tools = {
             selectElem.addEventListener("change", () => window.tools_state.toolSettings["transcribe"].transcription_model=selectElem.value)
             whisperLangSelect.addEventListener("change", () => window.tools_state.toolSettings["transcribe"].whisper_lang=whisperLangSelect.value)
 
+            const whisperBatchSizeDescription = createElem("div", "Whisper batch size")
+            const whisperBatchSizeInput = createElem("input", {type: "number", min: 1, step: 1})
+            whisperBatchSizeInput.style.width = "70%"
+            whisperBatchSizeInput.value = "8"
+            whisperBatchSizeInput.addEventListener("change", () => {
+                window.tools_state.toolSettings["transcribe"].whisper_batch_size = parseInt(whisperBatchSizeInput.value)
+            })
+            const rowItemWhisperBatchSizeInputs = createElem("div", whisperBatchSizeInput)
+            rowItemWhisperBatchSizeInputs.style.flexDirection = "row"
+            const rowItemWhisperBatchSize = createElem("div", whisperBatchSizeDescription, rowItemWhisperBatchSizeInputs)
+            window.tools_state.toolSettings["transcribe"].whisper_batch_size = parseInt(whisperBatchSizeInput.value)
+
+            const whisperPackCkbxDescription = createElem("div", "Pack short clips into shared 30s whisper windows")
+            const whisperPackCkbx = createElem("input", {type: "checkbox"})
+            whisperPackCkbx.style.height = "20px"
+            whisperPackCkbx.style.width = "20px"
+            whisperPackCkbx.addEventListener("click", () => {
+                window.tools_state.toolSettings["transcribe"].whisper_pack = whisperPackCkbx.checked
+            })
+            const rowItemWhisperPack = createElem("div", whisperPackCkbxDescription, createElem("div", whisperPackCkbx))
+            window.tools_state.toolSettings["transcribe"].whisper_pack = whisperPackCkbx.checked
+
             const container = createElem("div.flexTable.toolSettingsTable", rowItemModel)
-            const container2 = createElem("div.flexTable.toolSettingsTable", rowItemWhisperLang)
+            const container2 = createElem("div.flexTable.toolSettingsTable", rowItemWhisperLang, rowItemWhisperBatchSize, rowItemWhisperPack)
             toolDescription.appendChild(container)
             toolDescription.appendChild(container2)
         }
@@ -380,7 +402,25 @@ const tools = {
         inputDirectory: `${window.path}/python/noise_removal/input`,
         inputDirectory2: `${window.path}/python/noise_removal/noise`,
         outputDirectory: `${window.path}/python/noise_removal/output/`,
-        inputFileType: "folder"
+        inputFileType: "folder",
+        setupFn: (taskId) => {
+            window.tools_state.toolSettings["noise_removal"] = window.tools_state.toolSettings["noise_removal"] || {}
+
+            const noiseRemovalStrengthDescription = createElem("div", "Strength (0-1)")
+            const noiseRemovalStrengthInput = createElem("input", {type: "number", min: 0, max: 1, step: 0.05})
+            noiseRemovalStrengthInput.style.width = "70%"
+            noiseRemovalStrengthInput.value = "0.25"
+            noiseRemovalStrengthInput.addEventListener("change", () => {
+                window.tools_state.toolSettings["noise_removal"].removeNoiseStrength = noiseRemovalStrengthInput.value
+            })
+            const rowItemNoiseRemovalStrengthInputs = createElem("div", noiseRemovalStrengthInput)
+            rowItemNoiseRemovalStrengthInputs.style.flexDirection = "row"
+            const rowItemNoiseRemovalStrength = createElem("div", noiseRemovalStrengthDescription, rowItemNoiseRemovalStrengthInputs)
+            window.tools_state.toolSettings["noise_removal"].removeNoiseStrength = noiseRemovalStrengthInput.value
+
+            const container = createElem("div.flexTable.toolSettingsTable", rowItemNoiseRemovalStrength)
+            toolDescription.appendChild(container)
+        }
     },
     "Cut padding": {
         taskId: "cut_padding",
@@ -624,8 +664,9 @@ toolsRunTool.addEventListener("click", () => {
     window.tools_state.taskFileIndex = 0
     window.tools_state.taskFiles = []
     window.tools_state.progressElem.innerHTML = ""
+    window.tools_state.cancelled = false
 
-    window.tools_state.taskFiles = fs.readdirSync(window.tools_state.inputDirectory).filter(f => !f.endsWith(".ini"))
+    window.tools_state.taskFiles = fs.readdirSync(window.tools_state.inputDirectory).filter(f => !f.endsWith(".ini") && !f.startsWith("."))
     if (!window.tools_state.taskFiles.length) {
         return window.errorModal(`There are no files in the tool's input directory: <br>${window.tools_state.inputDirectory}`)
     }
@@ -716,6 +757,11 @@ const doNextTaskItem = () => {
 
 const updateMPProgress = () => {
 
+    // Stop polling once the task has ended some other way (cancelled, or an error)
+    if (!window.tools_state.running) {
+        return
+    }
+
     const outputFiles = fs.readdirSync(window.tools_state.outputDirectory)
     const filesDone = outputFiles.filter(fname => window.tools_state.taskFiles.map(fname => fname.split(".").reverse().slice(1,1000).reverse().join(".")+".wav").includes(fname)).length
 
@@ -735,6 +781,21 @@ const updateMPProgress = () => {
 }
 
 
+// Multi-processed tools stream an event per finished file, from the shared worker pool
+window.websocket_handlers["tasks_file_done"] = (data) => {
+    const percentDone = parseInt(data.done/data.total*100*100)/100
+    window.tools_state.currentFileElem.innerHTML = `Files done: ${data.done}/${data.total} (${percentDone}%)`
+}
+
+toolsCancelTool.addEventListener("click", () => {
+    if (!window.tools_state.running || window.tools_state.cancelled) {
+        return
+    }
+    // Worker pool tools stop starting new files, and reply with tasks_cancelled. Otherwise, stop after the current file
+    window.tools_state.cancelled = true
+    window.ws.send(JSON.stringify({model: window.tools_state.taskId, task: "cancelTask"}))
+})
+
 window.websocket_handlers["task_info"] = (data) => {
     window.tools_state.infoElem.innerHTML = data
 }
@@ -749,9 +810,19 @@ window.websocket_handlers["tasks_error"] = (data) => {
     window.tools_state.progressElem.innerHTML = ""
     toolsRunTool.disabled = false
     // prepAudioStart.disabled = false
+    if (window.tools_state.isMultiProcessed) {
+        // The tasks_next that may follow is ignored for multi-processed tools, so this is the end of the task
+        toolsList.querySelectorAll("button").forEach(button => button.disabled = false)
+        window.tools_state.running = false
+    }
     window.tools_state.infoElem.innerHTML = ""
     window.tools_state.currentFileElem.innerHTML = ""
 }
+// A worker pool job was cancelled part way through. Finish up the task (multi-processed or not) as cancelled
+window.websocket_handlers["tasks_cancelled"] = () => {
+    window.tools_state.cancelled = true
+    window.websocket_handlers["tasks_next"](undefined, true)
+}
 
 window.websocket_handlers["tasks_next"] = (data, mpOverride=false) => {
 
@@ -761,17 +832,18 @@ window.websocket_handlers["tasks_next"] = (data, mpOverride=false) => {
 
     window.tools_state.progressElem.innerHTML = `${window.tools_state.taskFileIndex}/${window.tools_state.taskFiles.length} files done (${parseInt(window.tools_state.taskFileIndex/window.tools_state.taskFiles.length*100*100)/100}%)`
 
-    if (window.tools_state.taskFileIndex<window.tools_state.taskFiles.length-1) {
+    if (window.tools_state.taskFileIndex<window.tools_state.taskFiles.length-1 && !window.tools_state.cancelled) {
         window.tools_state.taskFileIndex++
         doNextTaskItem()
     } else {
         if (window.tools_state.spinnerElem) {
             window.tools_state.spinnerElem.style.display = "none"
         }
-        window.tools_state.progressElem.innerHTML = "Done"
+        window.tools_state.progressElem.innerHTML = window.tools_state.cancelled ? "Cancelled" : "Done"
         toolsRunTool.disabled = false
         // prepAudioStart.disabled = false
         toolsList.querySelectorAll("button").forEach(button => button.disabled = false)
+        window.tools_state.running = false
         window.tools_state.infoElem.innerHTML = ""
         window.tools_state.currentFileElem.innerHTML = ""
 
@@ -22,6 +22,14 @@ def formatTask (data):
         return traceback.format_exc()
 
 
+def formatStage (audio, sr, toolSettings):
+    """In-memory formatting, for audio pipelines. Down-mixed to mono and resampled, like formatTask's ffmpeg -ac 1 -ar"""
+    from python.audio_norm.loudnorm import to_mono_resampled
+    formatting_hz = int(toolSettings["formatting_hz"]) if "formatting_hz" in toolSettings.keys() else 22050
+    wav, sr = to_mono_resampled(audio, sr, formatting_hz)
+    return wav.reshape(-1, 1), sr
+
+
 class AudioFormatter(object):
     def __init__(self, logger, PROD, device, models_manager):
         super(AudioFormatter, self).__init__()
@@ -34,6 +42,7 @@ class AudioFormatter(object):
 
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
 
 
     def load_state_dict (self, ckpt_path, sd):
@@ -55,8 +64,6 @@ class AudioFormatter(object):
         useMP = data["toolSettings"]["useMP"] if "useMP" in data["toolSettings"].keys() else False
         formatting_hz = data["toolSettings"]["formatting_hz"] if "formatting_hz" in data["toolSettings"].keys() else "22050"
         formatting_hz = int(formatting_hz)
-        # processes = data["toolSettings"]["mpProcesses"]
-        processes = max(1, int(mp.cpu_count()/2)-5) # TODO, figure out why more processes break the websocket
 
         # TODO, make this an checkbox toggle
         # also TODO, need to add checkbox toggle for not deleting the output director first, before kicking off the tool
@@ -67,7 +74,7 @@ class AudioFormatter(object):
 
         if useMP:
             input_paths = sorted(os.listdir(inPath))
-            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini")]
+            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini") and not fpath.startswith(".")]
             output_paths = [f'{outputDirectory}/{".".join(fpath.split(".")[:-1])+".wav"}' for fpath in input_paths]
             input_paths = [f'{inPath}/{fpath}' for fpath in input_paths]
             ffmpeg_path = f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
@@ -76,15 +83,11 @@ class AudioFormatter(object):
             for ip, path in enumerate(input_paths):
                 workItems.append([path, output_paths[ip], formatting_hz, ffmpeg_path])
 
-            workers = processes if processes>0 else max(1, mp.cpu_count()-1)
-            workers = min(len(workItems), workers)
-
-            self.logger.info("[mp ffmpeg] workers: "+str(workers))
-
-            pool = mp.Pool(workers)
-            results = pool.map(formatTask, workItems)
-            pool.close()
-            pool.join()
+            results, cancelled = await self.models_manager.run_pool_job("formatting", formatTask, workItems, websocket, data["toolSettings"])
+            if cancelled:
+                if websocket is not None:
+                    await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+                return
 
             errs = [items for items in results if items is not None]
             if len(errs):
@@ -0,0 +1,293 @@
+import numpy as np
+import soundfile as sf
+from scipy import signal, ndimage
+
+# Native EBU R128 loudness normalization, on decoded numpy audio, replacing the (3x ffmpeg subprocess per file)
+# ffmpeg-normalize path, with the same targets. Measurement follows ITU-R BS.1770-4 / EBU Tech 3341 + 3342:
+#   - K-weighting (libebur128 filter design, so it works at any sample rate)
+#   - Integrated loudness: 400ms blocks, 75% overlap, -70 LUFS absolute gate, -10 LU relative gate
+#   - Loudness range: 3s short-term windows at 10Hz, -70 LUFS absolute gate, -20 LU relative gate, 10th-95th percentile
+#   - True peak: 4x oversampled sample peak
+#
+# The gain follows what ffmpeg's loudnorm does in its second pass (linear=true):
+#   - One linear gain to the target, when that keeps the true peak under the target and the loudness range is already
+#     within target (ffmpeg's "linear mode"). For inputs under 3s (most voice lines), ffmpeg also uses a single gain,
+#     capped so the peak stays under the target, so that's done here too
+#   - Otherwise (ffmpeg's "dynamic mode"): a smooth gain curve over the 3s short-term loudness that compresses the
+#     loudness range down to the target, followed by a true-peak limiter
+
+TARGET_I = -23.0
+TARGET_TP = -2.0
+TARGET_LRA = 7.0
+
+SHORT_INPUT_SECONDS = 3
+
+
+def get_k_weighting_filters (sr):
+    # Stage 1: high shelf (head effects)
+    f0 = 1681.974450955533
+    G = 3.999843853973347
+    Q = 0.7071752369554196
+    K = np.tan(np.pi * f0 / sr)
+    Vh = 10 ** (G / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / Q + K * K
+    b1 = [(Vh + Vb * K / Q + K * K) / a0, 2 * (K * K - Vh) / a0, (Vh - Vb * K / Q + K * K) / a0]
+    a1 = [1, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]
+
+    # Stage 2: high pass (RLB)
+    f0 = 38.13547087602444
+    Q = 0.5003270373238773
+    K = np.tan(np.pi * f0 / sr)
+    a0 = 1 + K / Q + K * K
+    b2 = [1, -2, 1]
+    a2 = [1, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]
+
+    return np.polymul(b1, b2), np.polymul(a1, a2)
+
+
+def get_window_energies (weighted_sq_cumsum, sr, window_s, hop_s):
+    window = int(round(window_s*sr))
+    hop = int(round(hop_s*sr))
+    num_samples = len(weighted_sq_cumsum)-1
+    if num_samples < window:
+        return np.zeros((0,))
+    starts = np.arange(0, num_samples-window+1, hop)
+    return (weighted_sq_cumsum[starts+window] - weighted_sq_cumsum[starts]) / window
+
+def energy_to_lufs (energy):
+    return -0.691 + 10*np.log10(np.maximum(energy, 1e-20))
+
+
+def measure_loudness (wav, sr):
+    """Returns integrated loudness (LUFS), loudness range (LU), true peak (dBTP), and the relative gate threshold (LUFS)
+    of a mono float waveform"""
+    b, a = get_k_weighting_filters(sr)
+    weighted = signal.lfilter(b, a, wav.astype(np.float64))
+    cumsum = np.concatenate([[0], np.cumsum(weighted**2)])
+
+    # Integrated loudness
+    energies = get_window_energies(cumsum, sr, 0.4, 0.1)
+    if not len(energies):
+        # Shorter than one block. Measure over the whole input instead of giving up
+        energies = np.array([cumsum[-1]/max(1, len(wav))])
+    energies = energies[energy_to_lufs(energies) > -70]
+    if len(energies):
+        thresh = energy_to_lufs(np.mean(energies)) - 10
+        gated = energies[energy_to_lufs(energies) > thresh]
+        integrated = energy_to_lufs(np.mean(gated if len(gated) else energies))
+    else:
+        integrated, thresh = -70.0, -70.0
+
+    # Loudness range
+    st_lufs = energy_to_lufs(get_window_energies(cumsum, sr, 3, 0.1))
+    st_lufs = st_lufs[st_lufs > -70]
+    lra = 0.0
+    if len(st_lufs):
+        st_energies = 10**((st_lufs+0.691)/10)
+        st_lufs = st_lufs[st_lufs > energy_to_lufs(np.mean(st_energies)) - 20]
+        if len(st_lufs):
+            lra = float(np.percentile(st_lufs, 95) - np.percentile(st_lufs, 10))
+
+    return float(integrated), lra, get_true_peak(wav), float(thresh)
+
+
+def get_true_peak (wav, oversample=4):
+    if not len(wav):
+        return -np.inf
+    upsampled = signal.resample_poly(wav.astype(np.float64), oversample, 1)
+    peak = max(np.max(np.abs(upsampled)), np.max(np.abs(wav)))
+    return float(20*np.log10(max(peak, 1e-10)))
+
+
+def true_peak_limit (wav, target_tp, sr, release_s=0.1, lookahead_s=0.005, oversample=4):
+    """Smooth gain reduction wherever the (oversampled) peak envelope goes over the target"""
+    ceiling = 10**(target_tp/20)
+    upsampled = np.abs(signal.resample_poly(wav, oversample, 1))
+    envelope = np.maximum(upsampled[:len(wav)*oversample].reshape(len(wav), oversample).max(axis=1), np.abs(wav))
+    if np.max(envelope) <= ceiling:
+        return wav
+
+    required_gain = np.minimum(1.0, ceiling / np.maximum(envelope, 1e-10))
+
+    # Look ahead/hold: start reducing the gain a bit before each peak, then release slowly after it
+    lookahead = max(1, int(lookahead_s*sr))
+    required_gain = ndimage.minimum_filter1d(required_gain, size=2*lookahead+1, mode="nearest")
+    release_coeff = np.exp(-1/(release_s*sr))
+    gain = signal.lfilter([1-release_coeff], [1, -release_coeff], required_gain - 1) + 1 # Smooth in the linear domain
+    gain = np.minimum(gain, required_gain)
+    return wav * gain
+
+
+def get_dynamic_gain_curve (wav, sr, integrated, lra, target_lra):
+    """Per-sample gain (linear) that compresses the short-term loudness deviations from the integrated loudness, to bring
+    the loudness range down to the target"""
+    b, a = get_k_weighting_filters(sr)
+    weighted = signal.lfilter(b, a, wav.astype(np.float64))
+    cumsum = np.concatenate([[0], np.cumsum(weighted**2)])
+    hop = int(0.1*sr)
+    window = int(3*sr)
+    st_lufs = energy_to_lufs(get_window_energies(cumsum, sr, 3, 0.1))
+
+    # Only the windows that count towards the loudness range (over its -70 LUFS absolute and -20 LU relative gates) are
+    # compressed. The relative gate follows the mean loudness, which the compression moves, so the quieter (gated)
+    # windows get that same shift, keeping them under the gate. Otherwise, they would be pulled into the range, widening it
+    ratio = target_lra / max(lra, 1e-3)
+    gains_db = np.zeros_like(st_lufs)
+    over_abs_gate = st_lufs > -70
+    if np.any(over_abs_gate):
+        mean_lufs = energy_to_lufs(np.mean(10**((st_lufs[over_abs_gate]+0.691)/10)))
+        in_range = over_abs_gate & (st_lufs > mean_lufs - 20)
+        gains_db[in_range] = (integrated - st_lufs[in_range]) * (1 - ratio)
+        compressed_lufs = energy_to_lufs(np.mean(10**((st_lufs[over_abs_gate]+gains_db[over_abs_gate]+0.691)/10)))
+        gains_db[over_abs_gate & ~in_range] = compressed_lufs - mean_lufs
+
+    # Gain points at the middle of each short-term window, interpolated to per-sample, with a gentle smoothing
+    centers = np.arange(len(gains_db))*hop + window//2
+    gain_db = np.interp(np.arange(len(wav)), centers, gains_db)
+    smooth = np.hanning(2*hop+1)
+    gain_db = np.convolve(np.pad(gain_db, (hop, hop), mode="edge"), smooth/smooth.sum(), mode="valid")
+    return 10**(gain_db/20)
+
+
+def loudness_normalize (wav, sr, target_i=TARGET_I, target_tp=TARGET_TP, target_lra=TARGET_LRA):
+    """Returns the normalized waveform, and the mode used ("linear" or "dynamic")"""
+    integrated, lra, true_peak, thresh = measure_loudness(wav, sr)
+    if integrated <= -70:
+        return wav, "linear" # Silence
+
+    gain_db = target_i - integrated
+    is_short = len(wav) < SHORT_INPUT_SECONDS*sr
+
+    if is_short or (true_peak + gain_db <= target_tp and lra <= target_lra):
+        # ffmpeg's linear mode (and the short input behaviour): a single gain, capped to keep the peak under the target
+        gain_db = min(gain_db, target_tp - true_peak)
+        return (wav * 10**(gain_db/20)).astype(np.float32), "linear"
+
+    # Dynamic mode
+    out = wav.astype(np.float64)
+    for _ in range(3):
+        # Compressing changes which windows pass the loudness range gates, so re-measure, and go again if still too wide.
+        # A pass that ends up widening the range instead is dropped
+        if lra <= target_lra:
+            break
+        compressed = out * get_dynamic_gain_curve(out, sr, integrated, lra, target_lra)
+        compressed_integrated, compressed_lra, _, _ = measure_loudness(compressed, sr)
+        if compressed_lra >= lra:
+            break
+        out, integrated, lra = compressed, compressed_integrated, compressed_lra
+    for _ in range(2):
+        # Gain to the target and limit. Limiting lowers the loudness a bit, so re-measure and correct once more
+        out_integrated = measure_loudness(out, sr)[0]
+        out = true_peak_limit(out * 10**((target_i - out_integrated)/20), target_tp, sr)
+    # Guard against any left over inter-sample overs
+    out = out * min(1.0, 10**(target_tp/20) / max(10**(get_true_peak(out)/20), 1e-10))
+    return out.astype(np.float32), "dynamic"
+
+
+def load_audio (fpath):
+    """Decoded audio as float32 (samples, channels), and its sample rate"""
+    wav, sr = sf.read(fpath, dtype="float32", always_2d=True)
+    return wav, sr
+
+def to_mono_resampled (wav, sr, target_sr):
+    # Down-mix (like ffmpeg's -ac 1) and resample in the same pass
+    if wav.ndim>1:
+        wav = np.mean(wav, axis=1)
+    if target_sr is not None and sr!=target_sr:
+        gcd = np.gcd(int(sr), int(target_sr))
+        wav = signal.resample_poly(wav, int(target_sr)//gcd, int(sr)//gcd).astype(np.float32)
+        sr = target_sr
+    return wav, sr
+
+
+def normalize_file (in_path, out_path, target_sr=22050):
+    wav, sr = load_audio(in_path)
+    wav, sr = to_mono_resampled(wav, sr, target_sr)
+    wav, mode = loudness_normalize(wav, sr)
+    sf.write(out_path, np.clip(wav, -1, 1), sr, subtype="PCM_16" if out_path.lower().endswith(".wav") else None)
+    return mode
+
+
+def check_loudnorm (ffmpeg_path=None, sr=48000, seed=1234):
+    """Deterministic checks of the native loudness normalization targets. Measurement against EBU Tech 3341/3342 style
+    reference signals, then the normalized outputs of some synthetic inputs against the -23 LUFS / -2 dBTP / LRA 7
+    targets. With ffmpeg available (ffmpeg_path, or on the PATH), also against the ffmpeg-normalize output"""
+    import shutil
+    import tempfile
+    rng = np.random.RandomState(seed)
+
+    def sine (seconds, lufs, freq=997):
+        # A mono sine at the given loudness (a full scale sine, in one channel, measures -3.01 LUFS)
+        t = np.arange(int(seconds*sr))/sr
+        return np.sqrt(2)*10**(lufs/20) * np.sin(2*np.pi*freq*t)
+
+    integrated, lra, true_peak, _ = measure_loudness(sine(20, -23), sr)
+    assert abs(integrated+23) < 0.1, integrated
+    integrated, lra, true_peak, _ = measure_loudness(np.concatenate([sine(20, -20), sine(20, -30)]), sr)
+    assert abs(lra-10) < 1, lra # EBU Tech 3342, case 1
+    # A sine at a quarter of the sample rate, 45 degrees out of phase: its samples only reach 0.707 of its peak
+    intersample = 0.5*np.sin(2*np.pi*(np.arange(sr*5)/4 + 1/8))
+    true_peak = get_true_peak(intersample)
+    assert abs(true_peak-20*np.log10(0.5)) < 0.5 and np.max(np.abs(intersample)) < 0.5*0.71, true_peak
+
+    def speech_like (seconds, lufs):
+        # Noise bursts (syllables) of varying loudness, with short pauses
+        out = []
+        while sum([len(part) for part in out]) < seconds*sr:
+            out.append(rng.randn(int(rng.uniform(0.1, 0.4)*sr)) * 10**((lufs+rng.uniform(-6, 6))/20))
+            out.append(np.zeros(int(rng.uniform(0.02, 0.2)*sr)))
+        return np.concatenate(out)[:int(seconds*sr)]
+
+    inputs = {
+        "short quiet": speech_like(2, -40),
+        "short loud": speech_like(2.5, -12),
+        "long quiet": speech_like(8, -35),
+        "long loud": speech_like(8, -10),
+        "long wide range": np.concatenate([speech_like(10, -20), speech_like(10, -30), speech_like(10, -22)]),
+        "long very wide range": np.concatenate([speech_like(10, -15), speech_like(10, -40)]),
+        "long peaky": speech_like(8, -30) + np.where(rng.rand(int(8*sr))<0.0005, 0.9, 0),
+    }
+    outputs = {}
+    for name, wav in inputs.items():
+        out, mode = loudness_normalize(wav.astype(np.float32), sr)
+        integrated, lra, true_peak, _ = measure_loudness(out, sr)
+        _, in_lra, in_true_peak, _ = measure_loudness(wav, sr)
+        assert true_peak <= TARGET_TP+0.1, f'{name}: true peak {true_peak}'
+        if mode=="linear" and integrated < TARGET_I-1:
+            # Only a peak-capped single gain may fall short of the target
+            assert abs(true_peak-TARGET_TP) < 0.1, f'{name}: {integrated} LUFS, true peak {true_peak}, input true peak {in_true_peak}'
+        else:
+            assert abs(integrated-TARGET_I) < 1, f'{name}: {integrated} LUFS ({mode})'
+        if mode=="dynamic":
+            # Bimodal inputs with very quiet parts may not get all the way down to the target, as compressing them moves
+            # windows in and out of the range's relative gate. Their range must still narrow
+            if name=="long very wide range":
+                assert lra < in_lra, f'{name}: loudness range {in_lra} -> {lra}'
+            else:
+                assert lra <= TARGET_LRA+1, f'{name}: loudness range {in_lra} -> {lra}'
+        outputs[name] = out
+
+    ffmpeg_path = ffmpeg_path if ffmpeg_path is not None else shutil.which("ffmpeg")
+    if ffmpeg_path is None:
+        print("Native loudness normalization hits the targets. ffmpeg not found, skipping the comparison against ffmpeg-normalize")
+        return
+    try:
+        from python.audio_norm.model import normalizeTaskFFmpeg
+    except:
+        from model import normalizeTaskFFmpeg
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, wav in inputs.items():
+            sf.write(f'{tmp_dir}/in.wav', wav.astype(np.float32), sr, subtype="FLOAT")
+            err = normalizeTaskFFmpeg([ffmpeg_path, f'{tmp_dir}/in.wav', f'{tmp_dir}/ffmpeg.wav', sr])
+            assert err is None, err
+            ffmpeg_out, _ = sf.read(f'{tmp_dir}/ffmpeg.wav', dtype="float32")
+            ffmpeg_integrated = measure_loudness(ffmpeg_out, sr)[0]
+            native_integrated = measure_loudness(outputs[name], sr)[0]
+            assert abs(native_integrated-ffmpeg_integrated) < 1, f'{name}: native {native_integrated} LUFS, ffmpeg {ffmpeg_integrated} LUFS'
+    print("Native loudness normalization hits the targets, and matches ffmpeg-normalize")
+
+
+if __name__ == '__main__':
+    import sys
+    check_loudnorm(ffmpeg_path=sys.argv[1] if len(sys.argv)>1 else None)
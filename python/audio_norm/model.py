@@ -7,9 +7,34 @@ import platform
 
 import multiprocessing as mp
 from lib.ffmpeg_normalize._ffmpeg_normalize import FFmpegNormalize
+try:
+    from python.audio_norm.loudnorm import normalize_file, measure_loudness, load_audio, to_mono_resampled, loudness_normalize
+except:
+    from loudnorm import normalize_file, measure_loudness, load_audio, to_mono_resampled, loudness_normalize
 
 
 def normalizeTask (data):
+    # Native (in-process) EBU R128 normalization, with the same -23 LUFS / -2 dBTP / LRA 7 targets as the ffmpeg-normalize
+    # path. Files the native decoder/encoder can't handle fall back to ffmpeg
+    [ffmpeg_path, inPath, outPath, normalization_hz] = data
+    try:
+        normalize_file(inPath, outPath, normalization_hz)
+        return None
+    except KeyboardInterrupt:
+        raise
+    except:
+        return normalizeTaskFFmpeg(data)
+
+
+def normalizeStage (audio, sr, toolSettings):
+    """In-memory normalization, for audio pipelines"""
+    normalization_hz = int(toolSettings["normalization_hz"]) if "normalization_hz" in toolSettings.keys() else 22050
+    wav, sr = to_mono_resampled(audio, sr, normalization_hz)
+    wav, mode = loudness_normalize(wav, sr)
+    return wav.reshape(-1, 1), sr
+
+
+def normalizeTaskFFmpeg (data):
     [ffmpeg_path, inPath, outPath, normalization_hz] = data
 
     sample_rate = normalization_hz
@@ -62,6 +87,7 @@ class AudioNormalizer(object):
 
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
         self.ffmpeg_path = f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
         if platform.system() != 'Windows':
             self.ffmpeg_path = 'ffmpeg'
@@ -79,6 +105,14 @@ class AudioNormalizer(object):
 
     def normalize_sync(self, inPath, outputPath, sample_rate=22050):
 
+        try:
+            normalize_file(inPath, outputPath, sample_rate)
+            return
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.logger.info(f'Native normalization failed, falling back to ffmpeg: {traceback.format_exc()}')
+
         ffmpeg_normalize = FFmpegNormalize(
                 normalization_type="ebu",
                 target_level=-23.0,
@@ -118,13 +152,11 @@ class AudioNormalizer(object):
         useMP = data["toolSettings"]["useMP"]
         normalization_hz = data["toolSettings"]["normalization_hz"] if "normalization_hz" in data["toolSettings"].keys() else "22050"
         normalization_hz = int(normalization_hz)
-        # processes = data["toolSettings"]["mpProcesses"]
-        processes = max(1, int(mp.cpu_count()/2)-5) # TODO
 
         if useMP:
 
             input_paths = sorted(os.listdir(inPath))
-            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini")]
+            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini") and not fpath.startswith(".")]
             output_paths = [f'{outputDirectory}/{fpath}' for fpath in input_paths]
             input_paths = [f'{inPath}/{fpath}' for fpath in input_paths]
 
@@ -133,15 +165,11 @@ class AudioNormalizer(object):
             for ip, path in enumerate(input_paths):
                 workItems.append([self.ffmpeg_path, path, output_paths[ip], normalization_hz])
 
-            workers = processes if processes>0 else max(1, mp.cpu_count()-1)
-            workers = min(len(workItems), workers)
-
-            self.logger.info("[mp ffmpeg] workers: "+str(workers))
-
-            pool = mp.Pool(workers)
-            results = pool.map(normalizeTask, workItems)
-            pool.close()
-            pool.join()
+            results, cancelled = await self.models_manager.run_pool_job("normalize", normalizeTask, workItems, websocket, data["toolSettings"])
+            if cancelled:
+                if websocket is not None:
+                    await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+                return
 
             errs = [items for items in results if items is not None]
             if len(errs):
@@ -193,3 +221,51 @@ class AudioNormalizer(object):
             if websocket is not None:
                 await websocket.send(json.dumps({"key": "tasks_next"}))
 
+
+
+def benchmark_normalize (in_dir, out_dir, ffmpeg_path="ffmpeg", normalization_hz=22050, workers=None):
+    """Files/s of the native normalizer vs the ffmpeg-normalize subprocess path, over the audio files in in_dir, plus how
+    closely both outputs hit the targets"""
+    import time
+    import numpy as np
+
+    in_paths = [f'{in_dir}/{fname}' for fname in sorted(os.listdir(in_dir)) if not fname.endswith(".ini")]
+    workers = max(1, int(mp.cpu_count()/2)-5) if workers is None else workers
+    workers = min(len(in_paths), workers)
+
+    for name, task in [["native", normalizeTask], ["ffmpeg", normalizeTaskFFmpeg]]:
+        os.makedirs(f'{out_dir}/{name}', exist_ok=True)
+        workItems = [[ffmpeg_path, path, f'{out_dir}/{name}/{path.split("/")[-1]}', normalization_hz] for path in in_paths]
+
+        start = time.time()
+        pool = mp.Pool(workers)
+        try:
+            results = pool.map(task, workItems)
+        except:
+            print(f'[{name}] Failed: {traceback.format_exc()}')
+            continue
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+
+        errs = [res for res in results if res is not None]
+        if len(errs)==len(in_paths):
+            print(f'[{name}] All {len(errs)} files failed. First error: {errs[0]}')
+            continue
+
+        loudness = []
+        for _, _, out_path, _ in workItems:
+            if os.path.exists(out_path):
+                wav, sr = to_mono_resampled(*load_audio(out_path), None)
+                loudness.append(measure_loudness(wav, sr)[:3])
+        loudness = np.array(loudness)
+        print(f'[{name}] {round(len(in_paths)/elapsed, 2)} files/s ({workers} workers) | {len(errs)} failed | ' + \
+              f'Integrated: {round(np.mean(loudness[:,0]), 2)} LUFS (min {round(np.min(loudness[:,0]), 2)}, max {round(np.max(loudness[:,0]), 2)}) | ' + \
+              f'Loudness range: max {round(np.max(loudness[:,1]), 2)} LU | True peak: max {round(np.max(loudness[:,2]), 2)} dBTP')
+
+
+if __name__ == '__main__':
+    # python -m python.audio_norm.model <input dir> <output dir> [ffmpeg path]
+    import sys
+    benchmark_normalize(sys.argv[1], sys.argv[2], ffmpeg_path=sys.argv[3] if len(sys.argv)>3 else "ffmpeg")
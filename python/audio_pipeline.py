@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import tempfile
+import importlib
+import traceback
+
+import numpy as np
+import soundfile as sf
+
+import subprocess
+
+# Chained audio tool pipelines. Instead of running the dataset preparation tools one after another, each one writing
+# out a full directory of wavs for the next one to read back and decode again, every clip is decoded once, streamed
+# through all the stages in memory, inside one worker (of the shared worker pool), and only the final audio is written.
+#
+# Each stage is a tool's in-memory counterpart of its file-to-file task: fn(audio, sr, toolSettings) -> (audio, sr),
+# with audio as float32 (samples, channels). wem2ogg can only be the first stage, as it decodes the .wem input files
+
+PIPELINE_STAGES = {
+    "formatting": ["python.audio_format.model", "formatStage"],
+    "noise_removal": ["python.noise_removal.model", "noiseRemovalStage"],
+    "silence_cut": ["python.silence_cut.model", "silenceCutStage"],
+    "cut_padding": ["python.cut_padding.model", "cutPaddingStage"],
+    "normalize": ["python.audio_norm.model", "normalizeStage"],
+}
+
+
+def get_stage_fn (stage_key):
+    module_name, fn_name = PIPELINE_STAGES[stage_key]
+    return getattr(importlib.import_module(module_name), fn_name)
+
+
+def decode_audio (inPath, ffmpeg_path):
+    """Decoded audio as float32 (samples, channels), and its sample rate. Formats soundfile can't read are decoded with
+    ffmpeg, through a temporary wav file"""
+    try:
+        return sf.read(inPath, dtype="float32", always_2d=True)
+    except RuntimeError:
+        pass
+
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    fd, tmp_path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    try:
+        command = f'{ffmpeg_path} -y -i "{inPath}" -c:a pcm_f32le "{tmp_path}"'
+        sp = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = sp.communicate()
+        if sp.returncode!=0:
+            raise Exception(f'Command: {command} | {stderr.decode("utf-8")}')
+        return sf.read(tmp_path, dtype="float32", always_2d=True)
+    finally:
+        os.remove(tmp_path)
+
+
+def pipelineTask (data):
+    """Returns None, or the error"""
+    [inPath, outPath, stages, stage_settings, tool_paths] = data
+    try:
+        if stages[0]=="wem2ogg":
+            from python.wem2ogg.model import wem2oggDecode
+            audio, sr = wem2oggDecode(inPath, tool_paths["wem2ogg"])
+            stages = stages[1:]
+        else:
+            audio, sr = decode_audio(inPath, tool_paths["ffmpeg"])
+
+        for stage_key in stages:
+            audio, sr = get_stage_fn(stage_key)(audio, sr, stage_settings[stage_key] if stage_key in stage_settings.keys() else {})
+            if not len(audio):
+                return f'File: {inPath} | No audio left after the {stage_key} stage'
+
+        sf.write(outPath, np.clip(audio, -1, 1), sr, subtype="PCM_16")
+    except KeyboardInterrupt:
+        raise
+    except:
+        return f'File: {inPath} | Error: {traceback.format_exc()}'
+
+
+def check_stages (stages):
+    """Returns an error message if the stages can't be chained, else None"""
+    if not len(stages):
+        return "No pipeline stages given"
+    for si, stage_key in enumerate(stages):
+        if stage_key=="wem2ogg" and si>0:
+            return "wem2ogg can only be the first pipeline stage"
+        if stage_key!="wem2ogg" and stage_key not in PIPELINE_STAGES.keys():
+            return f'The "{stage_key}" tool can\'t be used in a pipeline. Supported: wem2ogg, {", ".join(PIPELINE_STAGES.keys())}'
+    return None
+
+
+
+def benchmark_pipeline (inputDirectory, outputDirectory, stages=["formatting", "silence_cut", "cut_padding", "normalize"]):
+    """The pipeline, vs running the same stages one after another, each writing a directory of wavs for the next one"""
+    fnames = [fname for fname in sorted(os.listdir(inputDirectory)) if not fname.endswith(".ini") and not fname.startswith(".")]
+    total_seconds = sum([sf.info(f'{inputDirectory}/{fname}').duration for fname in fnames])
+    tool_paths = {"ffmpeg": "ffmpeg"}
+
+    # Chained directories
+    start = time.time()
+    stage_in = inputDirectory
+    for stage_key in stages:
+        stage_out = f'{outputDirectory}/chained_{stage_key}'
+        os.makedirs(stage_out, exist_ok=True)
+        for fname in fnames:
+            audio, sr = decode_audio(f'{stage_in}/{fname}', tool_paths["ffmpeg"])
+            audio, sr = get_stage_fn(stage_key)(audio, sr, {})
+            sf.write(f'{stage_out}/{fname}', np.clip(audio, -1, 1), sr, subtype="PCM_16")
+        stage_in = stage_out
+    chained_time = time.time()-start
+
+    # Pipeline
+    os.makedirs(f'{outputDirectory}/pipeline', exist_ok=True)
+    start = time.time()
+    for fname in fnames:
+        pipelineTask([f'{inputDirectory}/{fname}', f'{outputDirectory}/pipeline/{fname}', stages, {}, tool_paths])
+    pipeline_time = time.time()-start
+
+    print(f'{len(fnames)} files, {round(total_seconds/60, 1)} minutes of audio | stages: {", ".join(stages)}')
+    print(f'Chained directories: {round(chained_time, 2)}s ({round(total_seconds/chained_time)}x real-time), {len(stages)} decodes and writes per file')
+    print(f'Pipeline:            {round(pipeline_time, 2)}s ({round(total_seconds/pipeline_time)}x real-time), 1 decode and write per file')
+
+
+
+class AudioPipeline(object):
+    def __init__(self, logger, PROD, device, models_manager):
+        super(AudioPipeline, self).__init__()
+
+        self.logger = logger
+        self.PROD = PROD
+        self.models_manager = models_manager
+        self.device = device
+        self.ckpt_path = None
+
+        self.model = None
+        self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
+
+        app_path = "./resources/app" if self.PROD else "."
+        self.tool_paths = {
+            "ffmpeg": f'{app_path}/python/ffmpeg.exe',
+            "wem2ogg": f'{app_path}/python/wem2ogg',
+        }
+
+
+    def load_state_dict (self, ckpt_path, sd):
+        pass
+
+    def set_device (self, device):
+        pass
+
+    def runTask (self, data, websocket=None):
+        return self.run_pipeline(data, websocket)
+
+
+    async def run_pipeline (self, data, websocket):
+        """
+        data["stages"] - the tool keys to run each file through, in order. eg ["wem2ogg", "formatting", "noise_removal",
+                         "silence_cut", "cut_padding", "normalize"]
+        data["toolSettings"] - {tool key: that tool's toolSettings}
+        data["inPath2"] - the noise sample directory, for noise_removal
+        """
+        inPath, outputDirectory = data["inPath"], data["outputDirectory"]
+        stages = [stage_key.lower() for stage_key in data["stages"]]
+        stage_settings = {stage_key: dict(settings) for stage_key, settings in (data["toolSettings"] if "toolSettings" in data.keys() else {}).items()}
+
+        err = check_stages(stages)
+        if err is None and "noise_removal" in stages:
+            from python.noise_removal.model import load_noise_profile
+            stage_settings["noise_removal"] = stage_settings["noise_removal"] if "noise_removal" in stage_settings.keys() else {}
+            try:
+                stage_settings["noise_removal"]["noise_profile"] = load_noise_profile(data["inPath2"])
+            except:
+                err = f'The noise profile could not be created from the noise sample in: {data["inPath2"]}<br>{traceback.format_exc()}'
+
+        if err is not None:
+            self.logger.info(f'[pipeline] {err}')
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": err}))
+            return
+
+        input_fnames = [fname for fname in sorted(os.listdir(inPath)) if not fname.endswith(".ini") and not fname.startswith(".")]
+        if stages[0]=="wem2ogg":
+            input_fnames = [fname for fname in input_fnames if fname.lower().endswith(".wem")]
+
+        workItems = []
+        for fname in input_fnames:
+            out_fname = f'{".".join(fname.split(".")[:-1]) if "." in fname else fname}.wav'
+            workItems.append([f'{inPath}/{fname}', f'{outputDirectory}/{out_fname}', stages, stage_settings, self.tool_paths])
+
+        self.logger.info(f'[pipeline] stages: {", ".join(stages)}')
+        results, cancelled = await self.models_manager.run_pool_job("pipeline", pipelineTask, workItems, websocket, stage_settings["pipeline"] if "pipeline" in stage_settings.keys() else {})
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
+
+        errs = [items for items in results if items is not None]
+        if len(errs):
+            self.logger.info(errs)
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": f'Task done. {len(errs)} items failed (out of: {len(workItems)})<br>First error (check the server.log for all):<br>{errs[0]}'}))
+
+        if websocket is not None:
+            await websocket.send(json.dumps({"key": "tasks_next"}))
+
+
+if __name__ == '__main__':
+    # python -m python.audio_pipeline <input directory> <output directory> [stages, comma separated]
+    import sys
+    if len(sys.argv)>3:
+        benchmark_pipeline(sys.argv[1], sys.argv[2], sys.argv[3].split(","))
+    else:
+        benchmark_pipeline(sys.argv[1], sys.argv[2])
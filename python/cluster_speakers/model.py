@@ -4,10 +4,7 @@ import shutil
 import json
 import traceback
 
-import torch
 import faiss
-from resemblyzer import VoiceEncoder, preprocess_wav
-from pathlib import Path
 import numpy as np
 import sklearn
 from sklearn.cluster import KMeans
@@ -25,10 +22,9 @@ class ClusterSpeakers(object):
         self.device = device
         self.ckpt_path = None
 
-        self.encoder = VoiceEncoder()
-
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
 
 
     def load_state_dict (self, ckpt_path, sd):
@@ -59,23 +55,20 @@ class ClusterSpeakers(object):
             await websocket.send(json.dumps({"key": "task_info", "data": f'Gathering audio files...'}))
 
         files = [f'{inPath}/{file}' for file in list(os.listdir(inPath)) if ".wav" in file]
-        embeddings = []
-        files_done = []
 
-        with torch.no_grad():
-            for fi, file in enumerate(files):
+        async def on_progress (done, total):
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "task_info", "data": f'Encoding audio files: {done}/{total}  ({int(done/total*100*100)/100}%) '}))
 
-                if websocket is not None:
-                    websocket.send(json.dumps({"key": "task_info", "data": f'Encoding audio files: {fi+1}/{len(files)}  ({int((fi+1)/len(files)*100*100)/100}%) '}))
-
-                try:
-                    fpath = Path(file)
-                    wav = preprocess_wav(fpath)
-                    embedding = self.encoder.embed_utterance(wav)
-                    embeddings.append(embedding)
-                    files_done.append(file)
-                except:
-                    self.logger.info(traceback.format_exc())
+        file_embeddings, errors, cancelled = await self.models_manager.get_speaker_embeddings().embed_files(files, job_id="cluster_speakers", on_progress=on_progress)
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
+        for fpath, error in errors:
+            self.logger.info(f'{fpath}: {error}')
+        files_done = [file for file, embedding in zip(files, file_embeddings) if embedding is not None]
+        embeddings = [embedding for embedding in file_embeddings if embedding is not None]
 
 
 
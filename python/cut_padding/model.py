@@ -5,6 +5,8 @@ import traceback
 
 import subprocess
 
+import numpy as np
+
 # Not a model, but it was easier to just integrate the code this way
 
 import multiprocessing as mp
@@ -27,6 +29,37 @@ def splitTask (data):
         return f'Command: {command} | Error: {traceback.format_exc()}'
 
 
+def get_sound_start (nonsilent, min_len):
+    """Index of the start of the first run of at least min_len non-silent frames, or None"""
+    change_points = np.flatnonzero(np.diff(nonsilent.astype(np.int8))) + 1
+    run_starts = np.concatenate([[0], change_points])
+    run_ends = np.concatenate([change_points, [len(nonsilent)]])
+    long_runs = np.flatnonzero(nonsilent[run_starts] & (run_ends-run_starts >= min_len))
+    return run_starts[long_runs[0]] if len(long_runs) else None
+
+def trim_padding (audio, sr, min_dB, start_duration=1, window=0.02):
+    """Leading and trailing silence removed, as the ffmpeg silenceremove filters in splitTask: audio is trimmed up to the
+    first stretch of start_duration seconds where the peak (over a window, across channels) stays above min_dB. Then the
+    same from the end"""
+    from scipy import ndimage
+    if not len(audio):
+        return audio
+    peaks = ndimage.maximum_filter1d(np.max(np.abs(audio), axis=1), size=max(1, int(window*sr)), mode="nearest")
+    nonsilent = peaks >= 10**(float(min_dB)/20)
+    min_len = max(1, int(start_duration*sr))
+
+    start = get_sound_start(nonsilent, min_len)
+    if start is None:
+        return audio[:0]
+    end = len(audio) - get_sound_start(nonsilent[::-1], min_len)
+    return audio[start:end]
+
+def cutPaddingStage (audio, sr, toolSettings):
+    """In-memory padding cutting, for audio pipelines"""
+    min_dB = toolSettings["min_dB"] if "min_dB" in toolSettings.keys() else "-15"
+    return trim_padding(audio, sr, min_dB), sr
+
+
 class CutPadding(object):
     def __init__(self, logger, PROD, device, models_manager):
         super(CutPadding, self).__init__()
@@ -39,6 +72,7 @@ class CutPadding(object):
 
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
 
 
     def load_state_dict (self, ckpt_path, sd):
@@ -59,7 +93,6 @@ class CutPadding(object):
         inPath, outputDirectory = data["inPath"], data["outputDirectory"]
         min_dB = data["toolSettings"]["min_dB"] if "min_dB" in data["toolSettings"].keys() else "-15"
         useMP = data["toolSettings"]["useMP"] if "useMP" in data["toolSettings"].keys() else False
-        processes = max(1, int(mp.cpu_count()/2)-5) # TODO, figure out why more processes break the websocket
 
         ffmpeg_path = f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
 
@@ -68,20 +101,17 @@ class CutPadding(object):
         if useMP:
 
             input_paths = sorted(os.listdir(inPath))
-            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini")]
+            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini") and not fpath.startswith(".")]
 
             workItems = []
             for ip, path in enumerate(input_paths):
                 workItems.append([f'{inPath}/{path}', min_dB, ffmpeg_path, outputDirectory])
 
-            workers = processes if processes>0 else max(1, mp.cpu_count()-1)
-            workers = min(len(workItems), workers)
-            self.logger.info("[mp ffmpeg] workers: "+str(workers))
-
-            pool = mp.Pool(workers)
-            results = pool.map(splitTask, workItems)
-            pool.close()
-            pool.join()
+            results, cancelled = await self.models_manager.run_pool_job("cut_padding", splitTask, workItems, websocket, data["toolSettings"])
+            if cancelled:
+                if websocket is not None:
+                    await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+                return
 
             errs = [items for items in results if items is not None]
             if len(errs):
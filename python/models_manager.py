@@ -1,9 +1,12 @@
 import os
 import json
+import asyncio
 import traceback
 
 import torch
 
+from python.worker_pool import WorkerPool
+
 
 class ModelsManager(object):
 
@@ -15,6 +18,9 @@ class ModelsManager(object):
         self.PROD = PROD
         self.device_label = device
         self.device = torch.device(device)
+        self.worker_pool = WorkerPool(logger)
+        self.task_locks = {}
+        self.speaker_embeddings = None
 
     async def init_model (self, model_key, websocket=None):
         model_key = model_key.lower()
@@ -84,6 +90,10 @@ class ModelsManager(object):
                 from python.cut_padding.model import CutPadding
                 self.models_bank[model_key] = CutPadding(self.logger, self.PROD, self.device, self)
 
+            if model_key=="pipeline":
+                from python.audio_pipeline import AudioPipeline
+                self.models_bank[model_key] = AudioPipeline(self.logger, self.PROD, self.device, self)
+
             if model_key=="srt_split":
                 from python.srt_split.model import SRTSplit
                 self.models_bank[model_key] = SRTSplit(self.logger, self.PROD, self.device, self)
@@ -160,5 +170,48 @@ class ModelsManager(object):
         for model_key in list(self.models_bank.keys()):
             self.models_bank[model_key].set_device(self.device)
 
+    async def run_pool_job (self, model_key, fn, work_items, websocket=None, toolSettings={}, get_error=None):
+        """Runs a tool's work items in the shared worker pool, sending a "tasks_file_done" websocket event as each one
+        finishes. The "mpProcesses" tool setting caps how many of the job's items run at once
+
+        get_error - optional fn(result) returning the item's error, if any. By default, a result is its error
+
+        Returns (results, cancelled), as WorkerPool.map()
+        """
+        concurrency = toolSettings["mpProcesses"] if "mpProcesses" in toolSettings.keys() and toolSettings["mpProcesses"] else None
+        get_error = (lambda result: result) if get_error is None else get_error
+        num_done = [0]
+
+        async def on_result (index, result):
+            num_done[0] += 1
+            if websocket is not None:
+                error = get_error(result)
+                await websocket.send(json.dumps({"key": "tasks_file_done", "data": {"index": index, "done": num_done[0], "total": len(work_items), \
+                                                 "error": None if error is None else str(error)}}))
+
+        self.logger.info(f'[{model_key}] items: {len(work_items)} | workers: {self.worker_pool.workers}')
+        return await self.worker_pool.map(fn, work_items, job_id=model_key, concurrency=concurrency, on_result=on_result)
+
+    def get_speaker_embeddings (self):
+        """The speaker embedding service (and its cache) shared by the speaker tools"""
+        if self.speaker_embeddings is None:
+            from python.speaker_embeddings import SpeakerEmbeddings
+            self.speaker_embeddings = SpeakerEmbeddings(self.logger, self.PROD, self.worker_pool)
+        return self.speaker_embeddings
+
+    async def run_task (self, model_key, data, websocket=None):
+        """Runs a tool's task. Tasks of the same tool are run one after another, as they share its model/job state"""
+        model_key = model_key.lower()
+        if model_key not in self.task_locks.keys():
+            self.task_locks[model_key] = asyncio.Lock()
+        async with self.task_locks[model_key]:
+            await self.models_bank[model_key].runTask(data, websocket=websocket)
+
+    def cancel_task (self, model_key=None):
+        model_key = None if model_key is None else model_key.lower()
+        cancelled = self.worker_pool.cancel(model_key)
+        self.logger.info(f'ModelsManager: Cancel task: {model_key} | was running: {cancelled}')
+        return cancelled
+
     def models (self, key):
         return self.models_bank[key.lower()]
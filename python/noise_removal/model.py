@@ -5,8 +5,252 @@ import traceback
 # import ffmpeg
 import subprocess
 
+import numpy as np
+import soundfile as sf
+
 # Not a model, but it was easier to just integrate the code this way
 
+# Native spectral gating noise removal, ported from sox's noiseprof + noisered (which this tool used to run as one
+# subprocess per file), so results stay close to the sox profile approach:
+#   - Noise profile: per channel, the mean log power spectrum of consecutive (non-overlapping) 2048 sample windows of
+#     the noise sample. Built once per task, instead of per file
+#   - Gating: 2048 sample windows at 50% overlap. A frequency bin is gated out when its (Hann windowed) log power is
+#     below the profile + strength*8. The gate is smoothed over time (half of the new gate + half of the last), isolated
+#     bins are suppressed, and the gated (unwindowed) spectrum is resynthesized with a Hann window and overlap-add
+# The STFTs of all the windows of a file are done in one go. Files are spread over the shared worker pool
+# reduce_noise_reference() is a line by line port of sox's per window loops, which check_noise_removal() compares against
+
+WINDOW_SIZE = 2048
+HALF_WINDOW = WINDOW_SIZE // 2
+FREQ_COUNT = HALF_WINDOW + 1
+DEFAULT_STRENGTH = 0.25
+
+
+def get_hann (n=WINDOW_SIZE):
+    # sox's lsx_apply_hann(): symmetric
+    return 0.5 - 0.5*np.cos(2*np.pi*np.arange(n)/(n-1))
+
+def get_noise_profile (audio):
+    """(channels, FREQ_COUNT) mean log power spectrum, of float (samples, channels) noise audio. As sox noiseprof"""
+    num_windows = int(np.ceil(audio.shape[0]/WINDOW_SIZE))
+    padded = np.zeros((num_windows*WINDOW_SIZE, audio.shape[1]))
+    padded[:audio.shape[0]] = audio
+    windows = padded.T.reshape(audio.shape[1], num_windows, WINDOW_SIZE)
+    power = np.abs(np.fft.rfft(windows, axis=-1))**2
+
+    # Mean over the windows where the bin has any power
+    has_power = power > 0
+    log_power = np.where(has_power, np.log(np.where(has_power, power, 1)), 0)
+    counts = np.sum(has_power, axis=1)
+    return np.where(counts>0, np.sum(log_power, axis=1)/np.maximum(counts, 1), 0)
+
+def load_noise_profile (noise_dir):
+    """Noise profile of the first .wav file in noise_dir"""
+    noise_wav = sorted([fname for fname in os.listdir(noise_dir) if fname.endswith(".wav")])[0]
+    audio, sr = sf.read(f'{noise_dir}/{noise_wav}', dtype="float32", always_2d=True)
+    return get_noise_profile(audio)
+
+
+def get_gate_smoothing (log_power, noise_gate, prev):
+    """Per window, per bin 0-1 gains, from the (windows, FREQ_COUNT) log power, as sox noisered's recursive smoothing.
+    prev is the last window's smoothing"""
+    gates = (log_power >= noise_gate).astype(np.float64)
+    smoothing = np.zeros_like(gates)
+    for wi in range(gates.shape[0]):
+        smooth = gates[wi]*0.5 + prev*0.5
+
+        # Lone bins that just opened up (sox: "eliminate tinkle bells"). sox goes through the bins in order, in place, so
+        # each bin sees the already updated ones below it. Only bins in the 0.5-0.55 range can change, so just those are
+        # walked through, the same way
+        candidates = np.nonzero((smooth[2:-2]>=0.5) & (smooth[2:-2]<=0.55))[0] + 2
+        for i in candidates:
+            if smooth[i-1]<0.1 and smooth[i-2]<0.1 and smooth[i+1]<0.1 and smooth[i+2]<0.1:
+                smooth[i] = 0
+
+        smoothing[wi] = smooth
+        prev = smooth
+    return smoothing
+
+def reduce_noise (audio, noise_profile, strength=DEFAULT_STRENGTH, block_windows=2048):
+    """Noise reduced float (samples, channels) audio. The STFT is done block_windows windows at a time, to bound memory
+    use on long recordings"""
+    num_samples = audio.shape[0]
+    if not num_samples:
+        return audio
+    hann = get_hann()
+    num_windows = int(np.ceil(num_samples/HALF_WINDOW))
+    out = np.zeros((audio.shape[1], (num_windows+1)*HALF_WINDOW))
+
+    for ci in range(audio.shape[1]):
+        padded = np.zeros(((num_windows+1)*HALF_WINDOW,))
+        padded[:num_samples] = audio[:, ci]
+        all_windows = np.lib.stride_tricks.sliding_window_view(padded, WINDOW_SIZE)[::HALF_WINDOW]
+        noise_gate = noise_profile[ci % noise_profile.shape[0]] + float(strength)*8.0
+        prev = np.zeros((FREQ_COUNT,))
+
+        for block_start in range(0, num_windows, block_windows):
+            windows = all_windows[block_start:block_start+block_windows]
+            spectrum = np.fft.rfft(windows, axis=-1)
+            power = np.abs(np.fft.rfft(windows*hann, axis=-1))**2
+            log_power = np.full(power.shape, -np.inf)
+            np.log(power, out=log_power, where=power>0)
+
+            smoothing = get_gate_smoothing(log_power, noise_gate, prev)
+            prev = smoothing[-1]
+            resynth = np.fft.irfft(spectrum*smoothing, n=WINDOW_SIZE, axis=-1) * hann
+
+            # Overlap-add: the first half of each window, plus the second half of the previous one
+            offset = block_start*HALF_WINDOW
+            out[ci, offset:offset+len(windows)*HALF_WINDOW] += resynth[:, :HALF_WINDOW].reshape(-1)
+            out[ci, offset+HALF_WINDOW:offset+(len(windows)+1)*HALF_WINDOW] += resynth[:, HALF_WINDOW:].reshape(-1)
+
+    return out[:, :num_samples].T.astype(np.float32)
+
+
+def reduce_noise_reference (audio, noise_profile, strength=DEFAULT_STRENGTH):
+    """Slow, window by window and bin by bin port of sox noisered's reduce_noise() loops, for check_noise_removal()"""
+    hann = get_hann()
+    num_samples = audio.shape[0]
+    out = np.zeros((audio.shape[1], num_samples+WINDOW_SIZE))
+    for ci in range(audio.shape[1]):
+        noise_gate = noise_profile[ci % noise_profile.shape[0]]
+        smoothing = np.zeros((FREQ_COUNT,))
+        for start in range(0, num_samples, HALF_WINDOW):
+            window = np.zeros((WINDOW_SIZE,))
+            chunk = audio[start:start+WINDOW_SIZE, ci]
+            window[:len(chunk)] = chunk
+            power = np.abs(np.fft.rfft(window*hann))**2
+
+            for i in range(FREQ_COUNT):
+                if power[i]==0 or np.log(power[i]) < noise_gate[i] + float(strength)*8.0:
+                    smooth = 0.0
+                else:
+                    smooth = 1.0
+                smoothing[i] = smooth*0.5 + smoothing[i]*0.5
+
+            for i in range(2, FREQ_COUNT-2):
+                if smoothing[i]>=0.5 and smoothing[i]<=0.55 and smoothing[i-1]<0.1 and smoothing[i-2]<0.1 and smoothing[i+1]<0.1 and smoothing[i+2]<0.1:
+                    smoothing[i] = 0.0
+
+            out[ci, start:start+WINDOW_SIZE] += np.fft.irfft(np.fft.rfft(window)*smoothing, n=WINDOW_SIZE) * hann
+    return out[:, :num_samples].T.astype(np.float32)
+
+
+def noiseRemovalTask (data):
+    [inPath, outPath, noise_profile, strength] = data
+    try:
+        audio, sr = sf.read(inPath, dtype="float32", always_2d=True)
+        subtype = sf.info(inPath).subtype
+        out = reduce_noise(audio, noise_profile, strength)
+        sf.write(outPath, np.clip(out, -1, 1), sr, subtype=subtype if subtype in ["PCM_16", "PCM_24", "PCM_32", "FLOAT"] else "PCM_16")
+    except KeyboardInterrupt:
+        raise
+    except:
+        return f'File: {inPath} | Error: {traceback.format_exc()}'
+
+
+def noiseRemovalTaskSox (data):
+    """The old sox subprocess path, for comparisons"""
+    [sox_path, inPath, outPath, noise_profile_path, strength] = data
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    command = f'{sox_path} {inPath} {outPath} noisered {noise_profile_path} {strength}'
+    command_process = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = command_process.communicate()
+    stderr = stderr.decode("utf-8")
+    if len(stderr):
+        return f'SOX Command: {command} | SOX ERROR: {stderr}'
+
+
+def noiseRemovalStage (audio, sr, toolSettings):
+    """In-memory noise removal, for audio pipelines. toolSettings needs the "noise_profile" (see load_noise_profile())"""
+    strength = toolSettings["removeNoiseStrength"] if "removeNoiseStrength" in toolSettings.keys() else DEFAULT_STRENGTH
+    return reduce_noise(audio, np.asarray(toolSettings["noise_profile"]), strength), sr
+
+
+
+def benchmark_noise_removal (inputDirectory, noiseDirectory, outputDirectory, strength=DEFAULT_STRENGTH, workers=1, sox_path=None):
+    """Seconds of audio processed per second. With a sox_path, also against sox noisered, and how close the outputs are"""
+    import time
+    import multiprocessing as mp
+    fnames = [fname for fname in sorted(os.listdir(inputDirectory)) if fname.endswith(".wav")]
+    total_seconds = sum([sf.info(f'{inputDirectory}/{fname}').duration for fname in fnames])
+
+    runs = [["native", noiseRemovalTask]]
+    if sox_path is not None:
+        runs.append(["sox", noiseRemovalTaskSox])
+        noise_wav = sorted([fname for fname in os.listdir(noiseDirectory) if fname.endswith(".wav")])[0]
+        noise_profile_path = f'{outputDirectory}/noise.noise_profile_file'
+        os.makedirs(outputDirectory, exist_ok=True)
+        subprocess.run(f'{sox_path} {noiseDirectory}/{noise_wav} -n noiseprof {noise_profile_path}', shell=True)
+
+    for name, task in runs:
+        os.makedirs(f'{outputDirectory}/{name}', exist_ok=True)
+        start = time.time()
+        if name=="native":
+            noise_profile = load_noise_profile(noiseDirectory)
+            workItems = [[f'{inputDirectory}/{fname}', f'{outputDirectory}/{name}/{fname}', noise_profile, strength] for fname in fnames]
+        else:
+            workItems = [[sox_path, f'{inputDirectory}/{fname}', f'{outputDirectory}/{name}/{fname}', noise_profile_path, strength] for fname in fnames]
+        if workers>1:
+            pool = mp.Pool(workers)
+            results = pool.map(task, workItems)
+            pool.close()
+            pool.join()
+        else:
+            results = [task(workItem) for workItem in workItems]
+        elapsed = time.time()-start
+        errs = [err for err in results if err is not None]
+        print(f'[{name}] {len(fnames)} files, {round(total_seconds/60, 1)} minutes of audio, in {round(elapsed, 2)}s ({round(total_seconds/elapsed)}x real-time, {workers} workers){f" | {len(errs)} failed" if len(errs) else ""}')
+
+    if sox_path is not None:
+        diffs = []
+        for fname in fnames:
+            native, _ = sf.read(f'{outputDirectory}/native/{fname}', always_2d=True)
+            sox, _ = sf.read(f'{outputDirectory}/sox/{fname}', always_2d=True)
+            num_samples = min(len(native), len(sox))
+            diffs.append(np.sqrt(np.mean((native[:num_samples]-sox[:num_samples])**2)) / max(1e-10, np.sqrt(np.mean(sox[:num_samples]**2))))
+        print(f'native vs sox relative RMS difference: mean {round(float(np.mean(diffs)), 5)}, max {round(float(np.max(diffs)), 5)}')
+
+
+def check_noise_removal (sox_path=None, seed=1234):
+    """Deterministic checks of reduce_noise(): against the bin by bin reduce_noise_reference() port (also across STFT
+    block boundaries), and, when sox is available (sox_path, or on the PATH), against sox noiseprof + noisered"""
+    import shutil
+    import tempfile
+    rng = np.random.RandomState(seed)
+    sr = 22050
+    noise = (rng.randn(sr*2, 2)*0.01).astype(np.float32)
+    t = np.arange(sr*3)/sr
+    tone = 0.3*np.sin(2*np.pi*440*t) * (t>1) # Some silence (just noise) first, then a tone
+    audio = (np.stack([tone, 0.5*tone], axis=1) + rng.randn(len(t), 2)*0.01).astype(np.float32)
+    audio[:HALF_WINDOW*3] = 0 # Some digital silence, for the no power bins
+
+    profile = get_noise_profile(noise)
+    for strength in [0.0, DEFAULT_STRENGTH, 0.5]:
+        reference = reduce_noise_reference(audio, profile, strength)
+        for block_windows in [2048, 7]:
+            out = reduce_noise(audio, profile, strength, block_windows=block_windows)
+            max_diff = float(np.max(np.abs(out-reference)))
+            assert max_diff < 1e-5, f'strength {strength}, block_windows {block_windows}: max abs diff {max_diff}'
+    print("reduce_noise matches the sox loop port")
+
+    sox_path = sox_path if sox_path is not None else shutil.which("sox")
+    if sox_path is None:
+        print("sox not found, skipping the comparison against sox noisered")
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sf.write(f'{tmp_dir}/noise.wav', noise, sr, subtype="FLOAT")
+        sf.write(f'{tmp_dir}/in.wav', audio, sr, subtype="FLOAT")
+        subprocess.run([sox_path, f'{tmp_dir}/noise.wav', "-n", "noiseprof", f'{tmp_dir}/noise.prof'], check=True)
+        subprocess.run([sox_path, f'{tmp_dir}/in.wav', f'{tmp_dir}/sox.wav', "noisered", f'{tmp_dir}/noise.prof', str(DEFAULT_STRENGTH)], check=True)
+        sox_out, _ = sf.read(f'{tmp_dir}/sox.wav', dtype="float32", always_2d=True)
+    out = reduce_noise(audio, profile, DEFAULT_STRENGTH)
+    num_samples = min(len(out), len(sox_out))
+    rel_rms = np.sqrt(np.mean((out[:num_samples]-sox_out[:num_samples])**2)) / max(1e-10, np.sqrt(np.mean(sox_out[:num_samples]**2)))
+    assert rel_rms < 0.01, f'Relative RMS difference to sox noisered: {rel_rms}'
+    print(f'reduce_noise matches sox noisered (relative RMS difference {round(float(rel_rms), 6)})')
+
 
 class NoiseRemoval(object):
     def __init__(self, logger, PROD, device, models_manager):
@@ -20,6 +264,7 @@ class NoiseRemoval(object):
 
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
 
 
     def load_state_dict (self, ckpt_path, sd):
@@ -34,49 +279,44 @@ class NoiseRemoval(object):
 
     async def remove_noise(self, data, websocket):
 
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-
         inPath, inPath2, outputDirectory = data["inPath"], data["inPath2"], data["outputDirectory"]
+        toolSettings = data["toolSettings"] if "toolSettings" in data.keys() else {}
+        removeNoiseStrength = float(toolSettings["removeNoiseStrength"]) if "removeNoiseStrength" in toolSettings.keys() else DEFAULT_STRENGTH
 
-        removeNoiseStrength = 0.25 # TODO, make configurable
-
-        sox_path = f'{"./resources/app" if self.PROD else "."}/python/sox/sox.exe'
-
-        # Create noise profile
-        noise_wav = sorted([fname for fname in os.listdir(inPath2) if fname.endswith(".wav")])[0]
-        noise_profile_file = f'{noise_wav.replace(".wav", "")}.noise_profile_file'
-        if not os.path.exists(noise_profile_file):
-            command = f'{sox_path} {inPath2}/{noise_wav} -n noiseprof {inPath2}/{noise_profile_file}'
-            command_process = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = command_process.communicate()
-            stderr = stderr.decode("utf-8")
-            if len(stderr):
-                self.logger.info(f'SOX Command: {command}')
-                self.logger.info(f'SOX ERROR: {stderr}')
-                if websocket is not None:
-                    await websocket.send(json.dumps({"key": "tasks_error", "data": stderr}))
-
+        # Create noise profile, once
+        try:
+            noise_profile = load_noise_profile(inPath2)
+        except:
+            self.logger.info(traceback.format_exc())
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": f'The noise profile could not be created from the noise sample in: {inPath2}<br>{traceback.format_exc()}'}))
+            return
 
         input_files = sorted(os.listdir(inPath))
         input_files = [fname for fname in input_files if fname.endswith(".wav")]
+        workItems = [[f'{inPath}/{fname}', f'{outputDirectory}/{fname}', noise_profile, removeNoiseStrength] for fname in input_files]
 
-        for fni, fname in enumerate(input_files):
+        results, cancelled = await self.models_manager.run_pool_job("noise_removal", noiseRemovalTask, workItems, websocket, toolSettings)
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
 
-            if fni%3==0 and websocket is not None:
-                await websocket.send(json.dumps({"key": "task_info", "data": f'Removing noise: {fni+1}/{len(input_files)}  ({(int(fni+1)/len(input_files)*100*100)/100}%)'}))
-
-            command = f'{sox_path} {inPath}/{fname} {outputDirectory}/{fname} noisered {inPath2}/{noise_profile_file} {removeNoiseStrength}'
-            command_process = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = command_process.communicate()
-            stderr = stderr.decode("utf-8")
-            if len(stderr):
-                self.logger.info(f'SOX Command: {command}')
-                self.logger.info(f'SOX ERROR: {stderr}')
-                if websocket is not None:
-                    await websocket.send(json.dumps({"key": "tasks_error", "data": stderr}))
+        errs = [items for items in results if items is not None]
+        if len(errs):
+            self.logger.info(errs)
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": f'Task done. {len(errs)} items failed (out of: {len(workItems)})<br>First error (check the server.log for all):<br>{errs[0]}'}))
 
         if websocket is not None:
             await websocket.send(json.dumps({"key": "tasks_next"}))
 
+
+if __name__ == '__main__':
+    # python model.py <input dir> <noise sample dir> <output dir> [sox path]
+    # python model.py check [sox path]
+    import sys
+    if sys.argv[1]=="check":
+        check_noise_removal(sox_path=sys.argv[2] if len(sys.argv)>2 else None)
+    else:
+        benchmark_noise_removal(sys.argv[1], sys.argv[2], sys.argv[3], sox_path=sys.argv[4] if len(sys.argv)>4 else None)
@@ -2,7 +2,9 @@ import os
 import json
 import traceback
 
-from pydub import AudioSegment
+import numpy as np
+import soundfile as sf
+from scipy import signal
 
 # Not a model, but it was easier to just integrate the code this way
 
@@ -10,24 +12,92 @@ from pydub import AudioSegment
 import multiprocessing as mp
 
 
-def processingTask(workItem):
-    [ffmpeg_path, inputPath, outputPath] = workItem
-
+def get_chunk_bounds (num_frames, sr, interval):
+    # Frame boundaries of the interval (ms) long chunks, the same as slicing a pydub AudioSegment by ms
+    num_chunks = int(np.ceil(round(1000 * num_frames / sr) / interval))
+    return (np.arange(num_chunks+1) * interval * sr) // 1000
+
+def get_silent_chunks (audio, sr, threshold, interval):
+    """Boolean flags of the chunks with a dBFS below the threshold, and the chunk frame boundaries"""
+    bounds = get_chunk_bounds(audio.shape[0], sr, interval)
+    # Running sum of the squared samples (over all channels), so that every chunk's RMS comes from two lookups
+    sq_cumsum = np.concatenate([[0], np.cumsum(np.sum(audio.astype(np.float64)**2, axis=1))])
+    chunk_lens = np.diff(bounds) * audio.shape[1]
+    chunk_energy = (sq_cumsum[np.minimum(bounds[1:], audio.shape[0])] - sq_cumsum[np.minimum(bounds[:-1], audio.shape[0])]) / np.maximum(chunk_lens, 1)
+    # dBFS < threshold  <=>  mean square < 10^(threshold/10). Digital silence (-inf dBFS) is included
+    return chunk_energy < 10**(threshold/10), bounds
+
+def get_kept_chunk_ranges (silent, max_silence):
+    """[start, end) chunk ranges to keep: leading and trailing silence removed, and silences longer than max_silence
+    shortened to max_silence, keeping half of it on each side"""
+    if not len(silent) or np.all(silent):
+        return []
+
+    # Run-length encode the silent flags
+    change_points = np.flatnonzero(np.diff(silent.astype(np.int8))) + 1
+    run_starts = np.concatenate([[0], change_points])
+    run_lens = np.diff(np.concatenate([run_starts, [len(silent)]]))
+    run_silent = silent[run_starts]
+
+    sound_start = run_starts[0] + (run_lens[0] if run_silent[0] else 0)
+    sound_end = len(silent) - (run_lens[-1] if run_silent[-1] else 0)
+
+    ranges = []
+    range_start = sound_start
+    for run_start, run_len in zip(run_starts[run_silent], run_lens[run_silent]):
+        if run_start <= sound_start or run_start+run_len >= len(silent):
+            continue # Leading/trailing silence
+        if run_len > max_silence:
+            ranges.append([range_start, run_start + int(max_silence/2)])
+            range_start = run_start + run_len - int(max_silence/2)
+    ranges.append([range_start, sound_end])
+    return ranges
+
+
+def cut_silence (audio, sr, out_sr=22050):
     threshold = -40 # tweak based on signal-to-noise ratio
     interval = 1 # ms, increase to speed up
     max_silence = 300 / interval
 
-    audio = AudioSegment.from_wav(inputPath)
+    silent, bounds = get_silent_chunks(audio, sr, threshold, interval)
+    ranges = get_kept_chunk_ranges(silent, max_silence)
+
+    # Splice the kept ranges (as frames) into a single buffer, down-mixed to mono
+    frame_ranges = [[bounds[start], min(bounds[end], audio.shape[0])] for start, end in ranges]
+    out = np.zeros((sum([end-start for start, end in frame_ranges]),), dtype=np.float32)
+    offset = 0
+    for start, end in frame_ranges:
+        out[offset:offset+end-start] = np.mean(audio[start:end], axis=1)
+        offset += end-start
+
+    if sr!=out_sr and len(out):
+        gcd = np.gcd(int(sr), out_sr)
+        out = signal.resample_poly(out, out_sr//gcd, int(sr)//gcd)
+    return out, out_sr
+
+
+def processingTask(workItem):
+    [ffmpeg_path, inputPath, outputPath] = workItem
+
+    audio, sr = sf.read(inputPath, dtype="float32", always_2d=True)
+    out, out_sr = cut_silence(audio, sr)
+    sf.write(outputPath, np.clip(out, -1, 1), out_sr, subtype="PCM_16")
 
-    AudioSegment.converter = ffmpeg_path
 
-    # break into chunks
+def silenceCutStage (audio, sr, toolSettings):
+    """In-memory silence cutting, for audio pipelines"""
+    out, out_sr = cut_silence(audio, sr)
+    return out.astype(np.float32).reshape(-1, 1), out_sr
+
+
+def get_kept_chunk_ranges_pydub (inputPath, threshold=-40, interval=1, max_silence=300):
+    """The original pydub implementation's [start, end) chunk ranges, and its chunks, for check_silence_cut"""
+    from pydub import AudioSegment
+    audio = AudioSegment.from_wav(inputPath)
     chunks = [audio[i:i+interval] for i in range(0, len(audio), interval)]
 
-    # find number of chunks with dBFS below threshold
     final_starting_silent_count = 0
     silent_blocks = 0
-
     index_cuts = []
     for ci, c in enumerate(chunks):
         if (c.dBFS == float('-inf') or c.dBFS < threshold):
@@ -42,16 +112,74 @@ def processingTask(workItem):
                 index_cuts.append(ci)
             silent_blocks = 0
 
-    index_cuts.append(len(chunks)-silent_blocks) # Add the index of the last bit of audio
-    spliced_chunks = []
-    for i in range(int(len(index_cuts)/2)):
-        spliced_chunks.append(chunks[index_cuts[i*2]:index_cuts[i*2+1]])
-
-    spliced_chunks = [item for sublist in spliced_chunks for item in sublist]
-    combined_sound = sum(spliced_chunks, AudioSegment.empty())
-    combined_sound = combined_sound.set_frame_rate(22050)
-
-    combined_sound.export(f'{outputPath}', format="wav", bitrate="22050", parameters=["-ac", "1"])
+    index_cuts.append(len(chunks)-silent_blocks)
+    ranges = [[index_cuts[i*2], index_cuts[i*2+1]] for i in range(int(len(index_cuts)/2))]
+    return ranges, chunks
+
+def check_silence_cut (seed=1234):
+    """Deterministic check of the vectorized silence cutting against the original pydub chunk loop: the same kept
+    chunk ranges, and the same spliced samples (before the resampling), over some synthetic 16 bit wavs"""
+    import tempfile
+    rng = np.random.RandomState(seed)
+
+    def make_wav (sr, channels, parts):
+        # parts: [seconds, dBFS (None for digital silence)]
+        out = []
+        for seconds, db in parts:
+            num_frames = int(seconds*sr)
+            out.append(np.zeros((num_frames, channels)) if db is None else rng.randn(num_frames, channels)*10**(db/20))
+        return np.clip(np.concatenate(out), -1, 1)
+
+    cases = {
+        "speech, pauses": [22050, 1, [[0.5, None], [1, -15], [0.2, -70], [1, -20], [0.8, None], [0.7, -18], [1.2, -65]]],
+        "44.1kHz stereo": [44100, 2, [[0.31, -60], [0.9, -12], [0.45, None], [0.6, -25], [0.33, -80]]],
+        "no leading silence": [48000, 1, [[1.5, -20], [0.2, -70]]],
+        "all silent": [22050, 1, [[1, None], [0.5, -70]]],
+        "leading, trailing only": [16000, 1, [[0.4, None], [0.25, -10], [0.4, -75]]],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, (sr, channels, parts) in cases.items():
+            sf.write(f'{tmp_dir}/in.wav', make_wav(sr, channels, parts), sr, subtype="PCM_16")
+            ref_ranges, chunks = get_kept_chunk_ranges_pydub(f'{tmp_dir}/in.wav')
+
+            audio, sr = sf.read(f'{tmp_dir}/in.wav', dtype="float32", always_2d=True)
+            silent, bounds = get_silent_chunks(audio, sr, -40, 1)
+            ranges = [[int(start), int(end)] for start, end in get_kept_chunk_ranges(silent, 300)]
+            if not silent[0]:
+                # Without leading silence, the pydub loop kept adding a cut for every sound chunk, so it kept every
+                # other ms of the audio. Not carried over
+                assert ref_ranges[:2]==[[0, 1], [2, 3]] and ranges==[[0, 1500]], f'{name}: {ranges} vs {ref_ranges[:3]}...'
+                continue
+            assert ranges==ref_ranges, f'{name}: {ranges} vs {ref_ranges}'
+
+            # The same samples spliced together, compared as down-mixed 16 bit values
+            ref = [np.frombuffer(chunk.raw_data, dtype=np.int16) for start, end in ref_ranges for chunk in chunks[start:end]]
+            ref = np.mean(np.concatenate(ref + [np.zeros((0,), dtype=np.int16)]).reshape(-1, channels).astype(np.float64), axis=1)
+            out, _ = cut_silence(audio, sr, out_sr=sr)
+            assert len(out)==len(ref) and np.allclose(out*32768, ref, atol=1e-2), f'{name}: {len(out)} vs {len(ref)} frames'
+    print(f'Silence cutting matches the pydub implementation ({len(cases)} cases)')
+
+
+
+def benchmark_silence_cut (inputDirectory, outputDirectory, workers=1):
+    """Seconds of audio processed per second"""
+    import time
+    file_names = sorted(os.listdir(inputDirectory))
+    workItems = [[None, f'{inputDirectory}/{file_name}', f'{outputDirectory}/{file_name}'] for file_name in file_names]
+    total_seconds = sum([sf.info(inputPath).duration for _, inputPath, _ in workItems])
+
+    os.makedirs(outputDirectory, exist_ok=True)
+    start = time.time()
+    if workers>1:
+        pool = mp.Pool(workers)
+        pool.map(processingTask, workItems)
+        pool.close()
+        pool.join()
+    else:
+        for workItem in workItems:
+            processingTask(workItem)
+    elapsed = time.time()-start
+    print(f'{len(workItems)} files, {round(total_seconds/60, 1)} minutes of audio, in {round(elapsed, 2)}s ({round(total_seconds/elapsed)}x real-time, {workers} workers)')
 
 
 
@@ -66,11 +194,9 @@ class SilenceCutter(object):
 
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
         self.ffmpeg_path = f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
 
-        AudioSegment.ffmpeg = self.ffmpeg_path
-        AudioSegment.converter = self.ffmpeg_path
-
 
     def load_state_dict (self, ckpt_path, sd):
         pass
@@ -85,19 +211,30 @@ class SilenceCutter(object):
 
         inputDirectory, outputDirectory = data["inputDirectory"], data["outputDirectory"]
 
-        workItems = [[self.ffmpeg_path, f'{inputDirectory}/{file_name}', f'{outputDirectory}/{file_name}'] for file_name in sorted(os.listdir(inputDirectory))]
-        AudioSegment.ffmpeg = self.ffmpeg_path
-        AudioSegment.converter = self.ffmpeg_path
+        workItems = [[self.ffmpeg_path, f'{inputDirectory}/{file_name}', f'{outputDirectory}/{file_name}'] for file_name in sorted(os.listdir(inputDirectory)) if not file_name.startswith(".")]
 
-        workers = max(1, int(mp.cpu_count()/2)-5) # TODO, figure out why more processes break the websocket
-        workers = min(len(workItems), workers)
-        self.logger.info("[mp silence_cutter] workers: "+str(workers))
+        results, cancelled = await self.models_manager.run_pool_job("silence_cut", processingTask, workItems, websocket, data["toolSettings"] if "toolSettings" in data.keys() else {})
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
 
-        pool = mp.Pool(workers)
-        pool.map(processingTask, workItems)
-        pool.close()
-        pool.join()
+        errs = [items for items in results if items is not None]
+        if len(errs):
+            self.logger.info(errs)
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": f'Task done. {len(errs)} items failed (out of: {len(workItems)})<br>First error (check the server.log for all):<br>{errs[0]}'}))
 
         if websocket is not None:
             await websocket.send(json.dumps({"key": "tasks_next"}))
 
+
+
+if __name__ == '__main__':
+    # python model.py <input dir> <output dir>
+    # python model.py check
+    import sys
+    if sys.argv[1]=="check":
+        check_silence_cut()
+    else:
+        benchmark_silence_cut(sys.argv[1], sys.argv[2])
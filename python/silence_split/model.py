@@ -3,6 +3,9 @@ import shutil
 import json
 import traceback
 
+import numpy as np
+import soundfile as sf
+
 # import ffmpeg
 import subprocess
 
@@ -10,53 +13,256 @@ import subprocess
 
 import multiprocessing as mp
 
-def splitTask (data):
-    [inPath, min_dB, silence_duration, ffmpeg_path, outputDirectory] = data
+# Each input file is decoded once, in blocks (so long recordings don't have to fit in memory), silences are detected on
+# the decoded samples (same rules as ffmpeg's silencedetect), and the segments are then read back out of the same
+# decoded file, block by block. Inputs soundfile can't read are first decoded to a temporary wav with a single ffmpeg call.
+#
+# The cut points are saved to a manifest in the output directory, for downstream tools (eg transcribe) to re-use:
+#   <outputDirectory>/.split_manifest.json
+#   {"file.wav": {"sample_rate", "duration", "min_dB", "silence_duration", "silences": [[start, end], ...],
+#                 "segments": [{"file": "file_000000.wav", "start": s, "end": s}, ...]}, ...}
+
+SPLIT_MANIFEST_FNAME = ".split_manifest.json"
+SPLIT_SILENCE_DURATION = 2 # Only silences longer than this (s) are split at
+SEGMENT_TAIL = 0.25 # Extra time (s) kept at the end of each segment
+
+
+BLOCK_SECONDS = 30 # Audio decoded at a time
+
+
+def get_silences (audio, sr, min_dB, silence_duration):
+    """[start, end] (s) of the stretches where every sample, in all channels, stays under min_dB for at least
+    silence_duration seconds. As ffmpeg's silencedetect"""
+    return get_silences_blocks([audio], sr, min_dB, silence_duration)
+
+
+def get_silences_blocks (blocks, sr, min_dB, silence_duration):
+    """get_silences(), over consecutive (samples, channels) blocks of the audio. A silent run still open at the end of a
+    block is carried over into the next one"""
+    threshold = 10**(float(min_dB)/20)
+    min_len = float(silence_duration)*sr
+    runs = []
+    open_start = None # Start sample of the silent run still open at the end of the last block
+    offset = 0
+    for block in blocks:
+        silent = np.all(np.abs(block) < threshold, axis=1)
+        if not len(silent):
+            continue
+
+        # Run-length encode the silent flags
+        change_points = np.flatnonzero(np.diff(silent.astype(np.int8))) + 1
+        run_starts = np.concatenate([[0], change_points]) + offset
+        run_ends = np.concatenate([change_points, [len(silent)]]) + offset
+        run_silent = silent[run_starts-offset]
+        starts, ends = run_starts[run_silent], run_ends[run_silent]
+
+        if len(starts) and open_start is not None and starts[0]==offset:
+            starts[0] = open_start # Continues the run from the last block
+        elif open_start is not None:
+            runs.append([open_start, offset])
+        open_start = None
+        if len(starts) and ends[-1]==offset+len(silent):
+            open_start = int(starts[-1])
+            starts, ends = starts[:-1], ends[:-1]
+        runs += [[int(start), int(end)] for start, end in zip(starts, ends)]
+        offset += len(silent)
+
+    if open_start is not None:
+        runs.append([open_start, offset])
+    return [[start/sr, end/sr] for start, end in runs if end-start >= min_len]
+
+
+def get_segments (silences, duration):
+    """[start, end] (s) of the segments between consecutive long silences"""
+    silences = [silence for silence in silences if silence[1]-silence[0] > SPLIT_SILENCE_DURATION]
+    segments = []
+    for si, silence in enumerate(silences[:-1]):
+        segments.append([silence[1], min(duration, silences[si+1][0] + SEGMENT_TAIL)])
+    return segments
+
+
+def decode_with_ffmpeg (inPath, ffmpeg_path, tmp_path):
     startupinfo = subprocess.STARTUPINFO()
     startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-    command = ""
-
-    try:
-        command = f'{ffmpeg_path} -i "{inPath}" -af silencedetect=noise={min_dB}dB:d={silence_duration} -f null -'
-        command_process = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = command_process.communicate()
-        stderr = stderr.decode("utf-8")
-        # if len(stderr):
-        #     self.logger.info(f'ffmpeg Command: {command}')
-        #     self.logger.info(f'ffmpeg ERROR: {stderr}')
-        #     if websocket is not None:
-        #         await websocket.send(json.dumps({"key": "tasks_error", "data": stderr}))
-        lines = [line for line in stderr.split("\n") if "silence_end" in line]
-        silences = []
-        for line in lines:
-
-            end = line.split("silence_end: ")[1].split(" ")[0]
-            dur = line.split(": ")[-1]
-            start = float(end)-float(dur)
-
-            if float(dur)>2:
-                silences.append([start, float(end), float(dur)])
-
-        filename = inPath.split("/")[-1]
-
-        if len(silences)<2:
-            shutil.copyfile(inPath, f'{outputDirectory}/{filename}')
-        else:
-            for si, silence in enumerate(silences[:-1]):
-                silence_end = silence[1]
-                next_silence_start = silences[si+1][0]
-
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    command = f'{ffmpeg_path} -y -i "{inPath}" -c:a pcm_f32le "{tmp_path}"'
+    sp = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = sp.communicate()
+    if sp.returncode!=0:
+        raise Exception(f'Command: {command} | {stderr.decode("utf-8")}')
 
 
-                out_fname = f'{outputDirectory}/{filename.split(".wav")[0]}_{str(si).zfill(6)}.wav'
+def splitTask (data):
+    """Returns [error or None, manifest entry or None]"""
+    [inPath, min_dB, silence_duration, ffmpeg_path, outputDirectory] = data
+    filename = inPath.split("/")[-1]
+    tmp_path = f'{outputDirectory}/.{filename}.decoded.wav'
 
-                command = f'{ffmpeg_path} -ss {silence_end} -t {next_silence_start - silence_end + 0.25} -i "{inPath}" "{out_fname}"'
-                sp = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                stdout, stderr = sp.communicate()
+    try:
+        try:
+            sound_file = sf.SoundFile(inPath)
+        except RuntimeError:
+            # Not a format soundfile can read. Decode it once with ffmpeg instead
+            decode_with_ffmpeg(inPath, ffmpeg_path, tmp_path)
+            sound_file = sf.SoundFile(tmp_path)
+
+        with sound_file:
+            sr = sound_file.samplerate
+            block_frames = int(BLOCK_SECONDS*sr)
+            duration = sound_file.frames/sr
+            silences = get_silences_blocks(sound_file.blocks(blocksize=block_frames, dtype="float32", always_2d=True), sr, min_dB, silence_duration)
+            segments = get_segments(silences, duration)
+
+            manifest_segments = []
+            if not len(segments):
+                shutil.copyfile(inPath, f'{outputDirectory}/{filename}')
+                manifest_segments.append({"file": filename, "start": 0, "end": duration})
+            else:
+                for si, [start, end] in enumerate(segments):
+                    out_fname = f'{filename.split(".wav")[0]}_{str(si).zfill(6)}.wav'
+                    start_frame, end_frame = int(round(start*sr)), int(round(end*sr))
+                    sound_file.seek(start_frame)
+                    with sf.SoundFile(f'{outputDirectory}/{out_fname}', "w", samplerate=sr, channels=sound_file.channels, subtype="PCM_16") as out_file:
+                        for block_start in range(start_frame, end_frame, block_frames):
+                            out_file.write(sound_file.read(min(block_frames, end_frame-block_start), dtype="float32", always_2d=True))
+                    manifest_segments.append({"file": out_fname, "start": start, "end": end})
+
+        entry = {"sample_rate": sr, "duration": duration, "min_dB": float(min_dB), "silence_duration": float(silence_duration), \
+                 "silences": silences, "segments": manifest_segments}
+        return [None, entry]
     except:
-        return f'Command: {command} | Error: {traceback.format_exc()}'
+        return [f'File: {inPath} | Error: {traceback.format_exc()}', None]
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def update_split_manifest (outputDirectory, entries):
+    """Merges {input file name: manifest entry} into the output directory's manifest"""
+    manifest_path = f'{outputDirectory}/{SPLIT_MANIFEST_FNAME}'
+    manifest = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, encoding="utf8") as f:
+                manifest = json.load(f)
+        except:
+            manifest = {}
+    manifest.update(entries)
+    with open(f'{manifest_path}.tmp', "w+", encoding="utf8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+def load_split_manifest (directory):
+    """The cut points manifest of a silence split output directory, or None"""
+    try:
+        with open(f'{directory}/{SPLIT_MANIFEST_FNAME}', encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def benchmark_silence_split (inputDirectory, outputDirectory, min_dB=-15, silence_duration=0.5):
+    """Seconds of audio split per second"""
+    import time
+    input_paths = [f'{inputDirectory}/{fname}' for fname in sorted(os.listdir(inputDirectory)) if not fname.startswith(".")]
+    total_seconds = sum([sf.info(inPath).duration for inPath in input_paths])
+
+    os.makedirs(outputDirectory, exist_ok=True)
+    start = time.time()
+    results = [splitTask([inPath, min_dB, silence_duration, "ffmpeg", outputDirectory]) for inPath in input_paths]
+    elapsed = time.time()-start
+    num_segments = sum([len(entry["segments"]) for err, entry in results if entry is not None])
+    print(f'{len(input_paths)} files, {round(total_seconds/60, 1)} minutes of audio, {num_segments} segments, in {round(elapsed, 2)}s ({round(total_seconds/elapsed)}x real-time)')
+
+
+def get_silences_reference (audio, sr, min_dB, silence_duration):
+    """Sample by sample port of ffmpeg's silencedetect rules, for check_silence_split"""
+    threshold = 10**(float(min_dB)/20)
+    silences = []
+    run_start = None
+    for si in range(audio.shape[0]):
+        if all([abs(value) < threshold for value in audio[si]]):
+            run_start = si if run_start is None else run_start
+        else:
+            if run_start is not None and si-run_start >= float(silence_duration)*sr:
+                silences.append([run_start/sr, si/sr])
+            run_start = None
+    if run_start is not None and audio.shape[0]-run_start >= float(silence_duration)*sr:
+        silences.append([run_start/sr, audio.shape[0]/sr]) # Reported at the end of the stream
+    return silences
+
+def get_segments_baseline (silences, duration):
+    """The segments the original ffmpeg based splitTask cut, from the same silences"""
+    silences = [[start, end, end-start] for start, end in silences if end-start > 2]
+    # -ss {silence_end} -t {next_silence_start - silence_end + 0.25}, which ffmpeg stops at the end of the input
+    return [[silence[1], min(duration, silences[si+1][0] + 0.25)] for si, silence in enumerate(silences[:-1])]
+
+def check_silence_split (ffmpeg_path=None, seed=1234):
+    """Deterministic checks of the block-wise silence splitting: block by block vs whole-file detection, vs a sample by
+    sample port of silencedetect, the segments vs the original splitTask's, and the written segments vs the input
+    samples. With ffmpeg available (ffmpeg_path, or on the PATH), also the silences vs ffmpeg's silencedetect"""
+    import tempfile
+    global BLOCK_SECONDS
+    rng = np.random.RandomState(seed)
+    sr = 8000
+
+    def make_audio (channels, parts):
+        # parts: [seconds, peak level (dB), None for digital silence]
+        out = []
+        for seconds, db in parts:
+            num_frames = int(seconds*sr)
+            out.append(np.zeros((num_frames, channels)) if db is None else np.clip(rng.randn(num_frames, channels)/3, -1, 1)*10**(db/20))
+        return np.concatenate(out).astype(np.float32)
+
+    cases = {
+        "speech, long pauses": [1, [[0.5, None], [3, -6], [2.5, -40], [4, -3], [3.2, None], [1.5, -10], [2.2, -30]]],
+        "stereo": [2, [[2.5, None], [1, -6], [2.6, -35], [2, -6], [2.5, None]]],
+        "short pauses only": [1, [[1, -6], [0.7, None], [1, -6], [0.4, -40], [1, -6]]],
+        "all silent": [1, [[6, None]]],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, (channels, parts) in cases.items():
+            audio = make_audio(channels, parts)
+            duration = audio.shape[0]/sr
+            for min_dB, silence_duration in [[-15, 0.5], [-25, 0.25]]:
+                silences = get_silences(audio, sr, min_dB, silence_duration)
+                ref = get_silences_reference(audio, sr, min_dB, silence_duration)
+                assert silences==ref, f'{name}: {silences} vs silencedetect rules {ref}'
+                for block_frames in [1, 997, sr, 3*sr+11]:
+                    blocks = [audio[start:start+block_frames] for start in range(0, audio.shape[0], block_frames)]
+                    blocks_silences = get_silences_blocks(blocks, sr, min_dB, silence_duration)
+                    assert blocks_silences==silences, f'{name}, {block_frames} frame blocks: {blocks_silences} vs {silences}'
+                assert get_segments(silences, duration)==get_segments_baseline(silences, duration), name
+
+            # End to end, with blocks that don't line up with the segments
+            sf.write(f'{tmp_dir}/{name}.wav', audio, sr, subtype="PCM_16")
+            out_dir = f'{tmp_dir}/{name}'
+            os.makedirs(out_dir)
+            block_seconds, BLOCK_SECONDS = BLOCK_SECONDS, 0.7
+            try:
+                err, entry = splitTask([f'{tmp_dir}/{name}.wav', -15, 0.5, "ffmpeg", out_dir])
+            finally:
+                BLOCK_SECONDS = block_seconds
+            assert err is None, err
+            assert len(entry["segments"])>1 or name!="speech, long pauses", entry["segments"]
+            written, _ = sf.read(f'{tmp_dir}/{name}.wav', dtype="float32", always_2d=True)
+            for segment in entry["segments"]:
+                out, _ = sf.read(f'{out_dir}/{segment["file"]}', dtype="float32", always_2d=True)
+                expected = written[int(round(segment["start"]*sr)):int(round(segment["end"]*sr))]
+                assert np.array_equal(out, expected), f'{name}: {segment}'
+
+        ffmpeg_path = ffmpeg_path if ffmpeg_path is not None else shutil.which("ffmpeg")
+        if ffmpeg_path is None:
+            print(f'Silence splitting matches the silencedetect rules and the original segments ({len(cases)} cases). ffmpeg not found, skipping the comparison against silencedetect')
+            return
+        for name in cases.keys():
+            sp = subprocess.run([ffmpeg_path, "-i", f'{tmp_dir}/{name}.wav', "-af", "silencedetect=noise=-15dB:d=0.5", "-f", "null", "-"], capture_output=True)
+            lines = [line for line in sp.stderr.decode("utf-8").split("\n") if "silence_end" in line]
+            ffmpeg_silences = [[float(line.split("silence_end: ")[1].split(" ")[0])-float(line.split(": ")[-1]), float(line.split("silence_end: ")[1].split(" ")[0])] for line in lines]
+            written, _ = sf.read(f'{tmp_dir}/{name}.wav', dtype="float32", always_2d=True)
+            silences = get_silences(written, sr, -15, 0.5)
+            assert len(silences)==len(ffmpeg_silences) and np.allclose(silences, ffmpeg_silences, atol=1e-3), f'{name}: {silences} vs ffmpeg {ffmpeg_silences}'
+    print(f'Silence splitting matches the silencedetect rules, the original segments, and ffmpeg\'s silencedetect ({len(cases)} cases)')
 
 
 class SilenceSplit(object):
@@ -71,6 +277,7 @@ class SilenceSplit(object):
 
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
 
 
     def load_state_dict (self, ckpt_path, sd):
@@ -85,15 +292,10 @@ class SilenceSplit(object):
 
     async def remove_noise(self, data, websocket):
 
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-
         inPath, outputDirectory = data["inPath"], data["outputDirectory"]
         min_dB = data["toolSettings"]["min_dB"] if "min_dB" in data["toolSettings"].keys() else "-15"
         silence_duration = data["toolSettings"]["silence_duration"] if "silence_duration" in data["toolSettings"].keys() else "0.5"
         useMP = data["toolSettings"]["useMP"] if "useMP" in data["toolSettings"].keys() else False
-        processes = max(1, int(mp.cpu_count()/2)-5) # TODO, figure out why more processes break the websocket
 
 
         ffmpeg_path = f'{"./resources/app" if self.PROD else "."}/python/ffmpeg.exe'
@@ -102,70 +304,42 @@ class SilenceSplit(object):
         if useMP:
 
             input_paths = sorted(os.listdir(inPath))
-            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini")]
+            input_paths = [fpath for fpath in input_paths if not fpath.endswith(".ini") and not fpath.startswith(".")]
 
             workItems = []
             for ip, path in enumerate(input_paths):
                 workItems.append([f'{inPath}/{path}', min_dB, silence_duration, ffmpeg_path, outputDirectory])
 
-            workers = processes if processes>0 else max(1, mp.cpu_count()-1)
-            workers = min(len(workItems), workers)
-            self.logger.info("[mp ffmpeg] workers: "+str(workers))
-
-            pool = mp.Pool(workers)
-            results = pool.map(splitTask, workItems)
-            pool.close()
-            pool.join()
-
-            errs = [items for items in results if items is not None]
-            if len(errs):
-                self.logger.info(errs)
-                if websocket is not None:
-                    await websocket.send(json.dumps({"key": "tasks_error", "data": f'Task done. {len(errs)} items failed (out of: {len(input_paths)})<br>First error (check the server.log for all):<br>{errs[0]}'}))
-
-            if websocket is not None:
-                await websocket.send(json.dumps({"key": "tasks_next"}))
-
-
-
+            results, cancelled = await self.models_manager.run_pool_job("silence_split", splitTask, workItems, websocket, data["toolSettings"], get_error=lambda result: result[0] if isinstance(result, list) else result)
         else:
-            command = f'{ffmpeg_path} -i "{inPath}" -af silencedetect=noise={min_dB}dB:d={silence_duration} -f null -'
-            command_process = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = command_process.communicate()
-            stderr = stderr.decode("utf-8")
-            if len(stderr) and "silence_end" not in stderr:
-                self.logger.info(f'ffmpeg split ERROR: {stderr}')
-            lines = [line for line in stderr.split("\n") if "silence_end" in line]
-            silences = []
-            for line in lines:
-
-                end = line.split("silence_end: ")[1].split(" ")[0]
-                dur = line.split(": ")[-1]
-                start = float(end)-float(dur)
-
-                if float(dur)>2:
-                    silences.append([start, float(end), float(dur)])
-
-            filename = inPath.split("/")[-1]
-
-            if len(silences)<2:
-                shutil.copyfile(inPath, f'{outputDirectory}/{filename}')
-            else:
-                for si, silence in enumerate(silences[:-1]):
-                    silence_end = silence[1]
-                    next_silence_start = silences[si+1][0]
+            input_paths = [inPath]
+            results = [splitTask([inPath, min_dB, silence_duration, ffmpeg_path, outputDirectory])]
+            cancelled = False
 
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        # Items not run (when cancelled) are None, and items whose worker crashed are just the error
+        results = [result if isinstance(result, list) else [result, None] for result in results]
+        update_split_manifest(outputDirectory, {path.split("/")[-1]: entry for path, [err, entry] in zip(input_paths, results) if entry is not None})
 
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
 
-                    out_fname = f'{outputDirectory}/{filename.split(".wav")[0]}_{str(si).zfill(6)}.wav'
+        errs = [err for err, entry in results if err is not None]
+        if len(errs):
+            self.logger.info(errs)
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": f'Task done. {len(errs)} items failed (out of: {len(input_paths)})<br>First error (check the server.log for all):<br>{errs[0]}'}))
 
-                    command = f'{ffmpeg_path} -ss {silence_end} -t {next_silence_start - silence_end + 0.25} -i "{inPath}" "{out_fname}"'
-                    sp = subprocess.Popen(command, startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    stdout, stderr = sp.communicate()
-                    stderr = stderr.decode("utf-8")
+        if websocket is not None:
+            await websocket.send(json.dumps({"key": "tasks_next"}))
 
-            if websocket is not None:
-                await websocket.send(json.dumps({"key": "tasks_next"}))
 
+if __name__ == '__main__':
+    # python model.py <input directory> <output directory>
+    # python model.py check [ffmpeg path]
+    import sys
+    if sys.argv[1]=="check":
+        check_silence_split(sys.argv[2] if len(sys.argv)>2 else None)
+    else:
+        benchmark_silence_split(sys.argv[1], sys.argv[2])
@@ -5,8 +5,6 @@ import json
 import traceback
 
 import faiss
-from resemblyzer import VoiceEncoder, preprocess_wav
-from pathlib import Path
 import numpy as np
 import sklearn
 
@@ -23,10 +21,9 @@ class SpeakerClusterSearch(object):
         self.device = device
         self.ckpt_path = None
 
-        self.encoder = VoiceEncoder()
-
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
 
 
     def load_state_dict (self, ckpt_path, sd):
@@ -49,19 +46,24 @@ class SpeakerClusterSearch(object):
         input_search_files_fnames = [fname.split("/")[-1] for fname in input_search_files]
 
 
-        files = [f'{inPath}/{file}' for file in list(os.listdir(inPath)) if ".wav" in file]
-        embeddings_queries = []
+        speaker_embeddings = self.models_manager.get_speaker_embeddings()
 
-        for fi, file in enumerate(files):
+        files = [f'{inPath}/{file}' for file in list(os.listdir(inPath)) if ".wav" in file]
 
+        async def on_query_progress (done, total):
             if websocket is not None:
-                # await websocket.send(json.dumps({"key": "task_info", "data": f'Encoding query audio files: {fi+1}/{len(files)}  ({(int((fi+1)/len(files)*100*100))/100}%)   '}))
-                websocket.send(json.dumps({"key": "task_info", "data": f'Encoding query audio files: {fi+1}/{len(files)}  ({(int((fi+1)/len(files)*100*100))/100}%)   '}))
+                await websocket.send(json.dumps({"key": "task_info", "data": f'Encoding query audio files: {done}/{total}  ({(int(done/total*100*100))/100}%)   '}))
 
-            fpath = Path(file)
-            wav = preprocess_wav(fpath)
-            embedding = self.encoder.embed_utterance(wav)
-            embeddings_queries.append(embedding)
+        embeddings_queries, errors, cancelled = await speaker_embeddings.embed_files(files, job_id="speaker_cluster_search", on_progress=on_query_progress)
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
+        if len(errors):
+            self.logger.info(errors)
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": f'Could not encode query file {errors[0][0]}:<br>{errors[0][1]}'}))
+            return
 
 
 
@@ -94,11 +96,10 @@ class SpeakerClusterSearch(object):
         folders_with_files = list(folders_with_files)
 
 
+        # All the folders' files are encoded together, so they can share the encoder batches
+        corpus_files = []
+        corpus_files_folderIndex = []
         for fdi, fdname in enumerate(folders_with_files):
-            if websocket is not None:
-                await websocket.send(json.dumps({"key": "task_info", "data": f'Encoding corpus cluster audio files: {fdi+1}/{len(folders_with_files)}  ({(int(fdi+1)/len(folders_with_files)*100*100)/100}%)   '}))
-
-
             # files = [f'{inPath2}/{fdname}/{file}' for file in list(os.listdir(f'{inPath2}/{fdname}')) if ".wav" in file]
             files = [f'{fdname}/{file}' for file in list(os.listdir(fdname)) if ".wav" in file]
 
@@ -108,27 +109,26 @@ class SpeakerClusterSearch(object):
                 files = [fname for fname in files if fname.split("/")[-1] not in input_search_files_fnames]
 
             folders_files.append(files)
+            corpus_files += files
+            corpus_files_folderIndex += [fdi for _ in files]
 
-            for fi, file in enumerate(files):
-                try:
-                    if websocket is not None:
-                        await websocket.send(json.dumps({"key": "task_info", "data": f'Indexing corpus | Folder: {fdi+1}/{len(folders_with_files)} | File: {fi+1}/{len(files)}  ({(int((fdi+1)/len(folders_with_files)*100*100))/100}%)'}))
-                    # print(f'\rIndexing pool | {fdi+1}/{len(folders)} | {fi+1}/{len(files)}  ({(int((fdi+1)/len(folders)*100*100))/100}%)   ', end="", flush=True)
-
-                    fpath = Path(file)
-                    wav = preprocess_wav(fpath)
-
-                    embed = self.encoder.embed_utterance(wav)
-
-                    embeddings_corpus.append(embed)
-                    files_done.append(file)
-                    files_done_folderIndex.append(fdi)
-                except KeyboardInterrupt:
-                    exit()
-                except:
-                    import traceback
-                    print(traceback.format_exc())
-                    self.logger.info(traceback.format_exc())
+        async def on_corpus_progress (done, total):
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "task_info", "data": f'Indexing corpus | Folders: {len(folders_with_files)} | File: {done}/{total}  ({(int(done/total*100*100))/100}%)'}))
+
+        corpus_embeddings, errors, cancelled = await speaker_embeddings.embed_files(corpus_files, job_id="speaker_cluster_search", on_progress=on_corpus_progress)
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
+        for fpath, error in errors:
+            self.logger.info(f'{fpath}: {error}')
+
+        for file, fdi, embed in zip(corpus_files, corpus_files_folderIndex, corpus_embeddings):
+            if embed is not None:
+                embeddings_corpus.append(embed)
+                files_done.append(file)
+                files_done_folderIndex.append(fdi)
 
 
 
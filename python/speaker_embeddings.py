@@ -0,0 +1,223 @@
+import os
+import asyncio
+import threading
+import traceback
+
+import numpy as np
+
+# Shared speaker embedding service, owned by the ModelsManager, for the speaker tools (cluster speakers, speaker search,
+# speaker cluster search), instead of each tool keeping its own Resemblyzer VoiceEncoder and re-encoding every file on
+# every run.
+#
+# The audio decoding and pre-processing (resampling, VAD trimming, mel spectrograms) of each file runs in the shared
+# worker pool. The files' fixed size (1.6s) partial utterance mels are then batched together across files, many per
+# encoder forward pass (in a thread, off the event loop), and averaged back into each file's utterance embedding (the
+# same as VoiceEncoder.embed_utterance).
+#
+# Embeddings are cached on disk, keyed by the file's path, size and mtime, so repeated searches over the same corpus
+# only encode new or changed files:
+#   <app>/python/.speaker_embeddings_cache.npz    {"paths", "stats" ([size, mtime_ns]), "embeddings"}
+
+CACHE_FNAME = ".speaker_embeddings_cache.npz"
+BATCH_PARTIALS = 256 # Partial utterances per encoder forward pass
+PARTIALS_RATE = 1.3 # embed_utterance() defaults
+PARTIALS_MIN_COVERAGE = 0.75
+
+
+def get_file_stat (fpath):
+    stat = os.stat(fpath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def get_partial_mels (fpath):
+    """The (n_partials, frames, channels) mels of the file's partial utterances, as VoiceEncoder.embed_utterance()
+    splits them. Module level, so the worker pool can pickle it"""
+    from pathlib import Path
+    from resemblyzer import VoiceEncoder, preprocess_wav, audio
+    wav = preprocess_wav(Path(fpath))
+    wav_slices, mel_slices = VoiceEncoder.compute_partial_slices(len(wav), PARTIALS_RATE, PARTIALS_MIN_COVERAGE)
+    max_wave_length = wav_slices[-1].stop
+    if max_wave_length >= len(wav):
+        wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
+    mel = audio.wav_to_mel_spectrogram(wav)
+    return np.array([mel[s] for s in mel_slices])
+
+
+class SpeakerEmbeddings(object):
+    def __init__(self, logger, PROD, worker_pool):
+        super(SpeakerEmbeddings, self).__init__()
+        self.logger = logger
+        self.worker_pool = worker_pool
+        self.cache_path = f'{"./resources/app" if PROD else "."}/python/{CACHE_FNAME}'
+        self.encoder = None
+        self.encoder_lock = threading.Lock() # encode_partials() runs in executor threads
+        self.cache = None # path -> [[size, mtime_ns], embedding]
+        self.cache_dirty = False
+
+
+    def get_encoder (self):
+        with self.encoder_lock:
+            if self.encoder is None:
+                from resemblyzer import VoiceEncoder
+                self.encoder = VoiceEncoder()
+        return self.encoder
+
+    def load_cache (self):
+        if self.cache is not None:
+            return
+        self.cache = {}
+        if os.path.exists(self.cache_path):
+            try:
+                data = np.load(self.cache_path)
+                for path, stat, embedding in zip(data["paths"], data["stats"], data["embeddings"]):
+                    self.cache[str(path)] = [[int(stat[0]), int(stat[1])], embedding]
+            except:
+                self.logger.info(f'[speaker embeddings] Could not read the cache, starting a new one: {traceback.format_exc()}')
+                self.cache = {}
+
+    def save_cache (self):
+        if not self.cache_dirty:
+            return
+        paths = list(self.cache.keys())
+        stats = np.array([self.cache[path][0] for path in paths], dtype=np.int64).reshape(-1, 2)
+        embeddings = np.array([self.cache[path][1] for path in paths], dtype=np.float32).reshape(len(paths), -1)
+        with open(f'{self.cache_path}.tmp', "wb") as f:
+            np.savez(f, paths=np.array(paths, dtype=str), stats=stats, embeddings=embeddings)
+        os.replace(f'{self.cache_path}.tmp', self.cache_path)
+        self.cache_dirty = False
+
+
+    def encode_partials (self, partial_mels):
+        """Utterance embeddings, from a list of each file's partial utterance mels, many files per forward pass"""
+        import torch
+        encoder = self.get_encoder()
+        counts = [len(mels) for mels in partial_mels]
+        all_mels = np.concatenate(partial_mels)
+        partial_embeds = []
+        with torch.no_grad():
+            for start in range(0, len(all_mels), BATCH_PARTIALS):
+                batch = torch.from_numpy(all_mels[start:start+BATCH_PARTIALS]).to(encoder.device)
+                partial_embeds.append(encoder(batch).cpu().numpy())
+        partial_embeds = np.concatenate(partial_embeds)
+
+        embeddings = []
+        offset = 0
+        for count in counts:
+            raw_embed = np.mean(partial_embeds[offset:offset+count], axis=0)
+            embeddings.append(raw_embed / np.linalg.norm(raw_embed, 2))
+            offset += count
+        return embeddings
+
+    async def embed_files (self, fpaths, job_id=None, on_progress=None):
+        """Utterance embeddings of the given audio files, from the cache where the files haven't changed
+
+        job_id - the worker pool job id, for cancelling
+        on_progress - optional coroutine fn(files done, total files)
+
+        Returns (embeddings, errors, cancelled). embeddings are in fpaths order, None for files that could not be encoded
+        (or not reached, if cancelled). errors are [[fpath, error], ...]
+        """
+        self.load_cache()
+        embeddings = [None for _ in fpaths]
+        errors = []
+
+        todo = []
+        for fi, fpath in enumerate(fpaths):
+            try:
+                stat = get_file_stat(fpath)
+            except OSError as e:
+                errors.append([fpath, str(e)])
+                continue
+            key = os.path.abspath(fpath)
+            if key in self.cache.keys() and self.cache[key][0]==stat:
+                embeddings[fi] = self.cache[key][1]
+            else:
+                todo.append([fi, key, stat])
+        self.logger.info(f'[speaker embeddings] files: {len(fpaths)} | cached: {len(fpaths)-len(todo)-len(errors)} | to encode: {len(todo)}')
+
+        # Partial mels are gathered from the workers as they finish, and encoded once there's a batch's worth
+        pending = []
+        num_done = [len(fpaths)-len(todo)]
+
+        async def flush ():
+            if not len(pending):
+                return
+            batch = pending[:]
+            pending.clear()
+            # The encoder runs in a thread, so the event loop stays free for the websocket (eg cancelTask) meanwhile
+            batch_embeddings = await asyncio.get_event_loop().run_in_executor(None, self.encode_partials, [mels for _, _, _, mels in batch])
+            for [fi, key, stat, _], embedding in zip(batch, batch_embeddings):
+                embeddings[fi] = embedding
+                self.cache[key] = [stat, embedding]
+            self.cache_dirty = True
+
+        async def on_result (index, result):
+            fi, key, stat = todo[index]
+            if isinstance(result, np.ndarray):
+                pending.append([fi, key, stat, result])
+                if sum([len(mels) for _, _, _, mels in pending]) >= BATCH_PARTIALS:
+                    await flush()
+            else:
+                errors.append([fpaths[fi], result])
+            num_done[0] += 1
+            if on_progress is not None:
+                await on_progress(num_done[0], len(fpaths))
+
+        cancelled = False
+        if len(todo):
+            _, cancelled = await self.worker_pool.map(get_partial_mels, [key for _, key, _ in todo], job_id=job_id, on_result=on_result)
+            # The files done before a cancel are still kept
+            await flush()
+            self.save_cache()
+        return embeddings, errors, cancelled
+
+
+def check_speaker_embeddings (wav_dir, num_files=20):
+    """The batched embeddings against VoiceEncoder.embed_utterance(), one file at a time, then the cache"""
+    import time
+    import asyncio
+    import logging
+    import tempfile
+    from pathlib import Path
+    from resemblyzer import preprocess_wav
+    try:
+        from python.worker_pool import WorkerPool
+    except:
+        from worker_pool import WorkerPool
+
+    fpaths = [f'{wav_dir}/{fname}' for fname in sorted(os.listdir(wav_dir)) if fname.endswith(".wav")][:num_files]
+    logger = logging.getLogger("speaker_embeddings")
+    pool = WorkerPool(logger)
+    loop = asyncio.new_event_loop()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            service = SpeakerEmbeddings(logger, False, pool)
+            service.cache_path = f'{tmp_dir}/{CACHE_FNAME}'
+
+            start = time.time()
+            reference = [service.get_encoder().embed_utterance(preprocess_wav(Path(fpath))) for fpath in fpaths]
+            reference_time = time.time()-start
+
+            start = time.time()
+            embeddings, errors, _ = loop.run_until_complete(service.embed_files(fpaths))
+            batched_time = time.time()-start
+            assert not len(errors), errors
+            max_diff = max([np.max(np.abs(embedding-ref)) for embedding, ref in zip(embeddings, reference)])
+            assert max_diff < 1e-4, max_diff
+
+            # A new service instance, reading the cache back
+            service = SpeakerEmbeddings(logger, False, pool)
+            service.cache_path = f'{tmp_dir}/{CACHE_FNAME}'
+            start = time.time()
+            cached, errors, _ = loop.run_until_complete(service.embed_files(fpaths))
+            cached_time = time.time()-start
+            assert not len(errors) and all([np.array_equal(a, b) for a, b in zip(cached, embeddings)])
+    finally:
+        loop.close()
+        pool.shutdown()
+    print(f'{len(fpaths)} files | one at a time: {round(reference_time, 2)}s | batched: {round(batched_time, 2)}s | cached: {round(cached_time, 3)}s | max diff: {max_diff}')
+
+
+if __name__ == '__main__':
+    # python -m python.speaker_embeddings <directory of wav files>
+    import sys
+    check_speaker_embeddings(sys.argv[1])
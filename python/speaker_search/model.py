@@ -5,8 +5,6 @@ import json
 import traceback
 
 import faiss
-from resemblyzer import VoiceEncoder, preprocess_wav
-from pathlib import Path
 import numpy as np
 import sklearn
 
@@ -23,10 +21,9 @@ class SpeakerSearch(object):
         self.device = device
         self.ckpt_path = None
 
-        self.encoder = VoiceEncoder()
-
         self.model = None
         self.isReady = True
+        self.uses_worker_pool = True # Its tasks run in the background, see server.py
 
 
     def load_state_dict (self, ckpt_path, sd):
@@ -50,17 +47,19 @@ class SpeakerSearch(object):
         input_search_files_fnames = [fname.split("/")[-1] for fname in input_search_files]
 
 
+        speaker_embeddings = self.models_manager.get_speaker_embeddings()
+
         files = [f'{inPath}/{file}' for file in list(os.listdir(inPath)) if ".wav" in file]
-        embeddings_queries = []
 
         if websocket is not None:
             await websocket.send(json.dumps({"key": "task_info", "data": f'Encoding query audio files...'}))
 
-        for fi, file in enumerate(files):
-            fpath = Path(file)
-            wav = preprocess_wav(fpath)
-            embedding = self.encoder.embed_utterance(wav)
-            embeddings_queries.append(embedding)
+        embeddings_queries, errors, cancelled = await speaker_embeddings.embed_files(files, job_id="speaker_search")
+        if len(errors) and not cancelled:
+            self.logger.info(errors)
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_error", "data": f'Could not encode query file {errors[0][0]}:<br>{errors[0][1]}'}))
+            return
 
 
         files = [f'{inPath2}/{file}' for file in list(os.listdir(inPath2)) if ".wav" in file]
@@ -68,24 +67,20 @@ class SpeakerSearch(object):
         if SKIP_SAME_QUERY_NAMES:
             files = [fname for fname in files if fname.split("/")[-1] not in input_search_files_fnames]
 
-        embeddings_corpus = []
-        files_done = []
-
+        async def on_progress (done, total):
+            if websocket is not None and (done%10==0 or done==total):
+                await websocket.send(json.dumps({"key": "task_info", "data": f'Encoding corpus audio files: {done}/{total}  ({(int(done)/total*100*100)/100}%)   '}))
 
-        for fi, file in enumerate(files):
-
-            try:
-                if fi%10==0 or fi==len(files)-1:
-                    if websocket is not None:
-                        await websocket.send(json.dumps({"key": "task_info", "data": f'Encoding corpus audio files: {fi+1}/{len(files)}  ({(int(fi+1)/len(files)*100*100)/100}%)   '}))
-
-                fpath = Path(file)
-                wav = preprocess_wav(fpath)
-                embedding = self.encoder.embed_utterance(wav)
-                embeddings_corpus.append(embedding)
-                files_done.append(file)
-            except:
-                self.logger.info(traceback.format_exc())
+        if not cancelled:
+            file_embeddings, errors, cancelled = await speaker_embeddings.embed_files(files, job_id="speaker_search", on_progress=on_progress)
+        if cancelled:
+            if websocket is not None:
+                await websocket.send(json.dumps({"key": "tasks_cancelled"}))
+            return
+        for fpath, error in errors:
+            self.logger.info(f'{fpath}: {error}')
+        files_done = [file for file, embedding in zip(files, file_embeddings) if embedding is not None]
+        embeddings_corpus = [embedding for embedding in file_embeddings if embedding is not None]
 
 
 
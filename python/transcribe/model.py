@@ -1,12 +1,16 @@
 
 import os
 import json
+import time
 import traceback
+import dataclasses
 
+import numpy as np
 
-# Not a model, but it was easier to just integrate the code this way
 
+# Not a model, but it was easier to just integrate the code this way
 
+import torch
 import whisper
 
 lang_names_to_codes = {
@@ -44,6 +48,152 @@ lang_names_to_codes = {
 }
 
 
+# Batched whisper transcription. Audio is loaded ahead in a thread pool, and the 30s mel windows are decoded several at
+# a time, in one forward pass. Short clips can also be packed together into the same 30s window (with some silence
+# between them), and their text split back out by the decoded timestamps
+WHISPER_SR = 16000
+WHISPER_WINDOW_SECONDS = 30
+WHISPER_BATCH_SIZE = 8
+PACK_GAP_SECONDS = 1.0 # Silence between packed clips, so whisper starts a new timestamped segment for each
+PREFETCH_WORKERS = 4
+
+def end_punctuate (transcript):
+    return transcript if transcript.endswith("?") or transcript.endswith("!") or transcript.endswith(".") or transcript.endswith(",") else f'{transcript}.'
+
+def prefetch (items, load_fn, workers=PREFETCH_WORKERS, ahead=32):
+    """Yields (item, load_fn(item) or the exception) in order, loading up to `ahead` items in advance in a thread pool"""
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = deque()
+        items = iter(items)
+        for item in items:
+            futures.append([item, executor.submit(load_fn, item)])
+            if len(futures)>=ahead:
+                break
+        while len(futures):
+            item, future = futures.popleft()
+            next_item = next(items, None)
+            if next_item is not None:
+                futures.append([next_item, executor.submit(load_fn, next_item)])
+            try:
+                yield item, future.result()
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                yield item, e
+
+def trim_silent_edges (audio, threshold_db=-40, frame=320, margin=0.1):
+    """Drops the leading and trailing 20ms frames quieter than threshold_db (keeping margin seconds), for packing"""
+    num_frames = len(audio)//frame
+    if not num_frames:
+        return audio
+    rms = np.sqrt(np.mean(audio[:num_frames*frame].reshape(num_frames, frame)**2, axis=1))
+    voiced = np.flatnonzero(rms > 10**(threshold_db/20))
+    if not len(voiced):
+        return audio
+    start = max(0, voiced[0]*frame - int(margin*WHISPER_SR))
+    end = min(len(audio), (voiced[-1]+1)*frame + int(margin*WHISPER_SR))
+    return audio[start:end]
+
+def pack_clips (durations, window_seconds=WHISPER_WINDOW_SECONDS, gap_seconds=PACK_GAP_SECONDS):
+    """Greedily packs clips, in order, into windows. Returns [[[clip index, start offset (s)], ...], ...]. Clips too
+    long to share a window get one of their own"""
+    windows = []
+    window, offset = [], 0
+    for ci, duration in enumerate(durations):
+        if len(window) and offset+duration > window_seconds:
+            windows.append(window)
+            window, offset = [], 0
+        window.append([ci, offset])
+        offset += duration + gap_seconds
+    if len(window):
+        windows.append(window)
+    return windows
+
+def demux_packed_tokens (tokens, timestamp_begin, spans, decode_fn):
+    """Splits a packed window's decoded tokens back into each clip's text. spans: [start, end] (s) of each clip in the
+    window. Each timestamped segment goes to the clip its middle falls in (or the nearest one). Returns None if the
+    tokens had no timestamps to go by. Clips that can't be split out (left with no text, eg when whisper merged them
+    with a neighbour into one segment across the gap, or covered by such a merged segment) are None in the list, for
+    re-decoding on their own"""
+    segments = []
+    segment_start, text_tokens = None, []
+    for token in tokens:
+        if token >= timestamp_begin:
+            seconds = (token-timestamp_begin)*0.02
+            if segment_start is None:
+                segment_start = seconds
+            else:
+                segments.append([segment_start, seconds, text_tokens])
+                segment_start, text_tokens = None, []
+        else:
+            text_tokens.append(token)
+    if segment_start is not None and len(text_tokens):
+        segments.append([segment_start, segment_start, text_tokens]) # Cut off before its closing timestamp
+    if not len(segments):
+        return None
+
+    clip_tokens = [[] for _ in spans]
+    merged = set()
+    for start, end, text_tokens in segments:
+        overlapped = [si for si, [span_start, span_end] in enumerate(spans) if start<span_end and end>span_start]
+        if len(overlapped)>1:
+            merged.update(overlapped)
+            continue
+        middle = (start+end)/2
+        distances = [0 if span_start<=middle<=span_end else min(abs(middle-span_start), abs(middle-span_end)) for span_start, span_end in spans]
+        clip_tokens[int(np.argmin(distances))] += text_tokens
+
+    texts = []
+    for ci, tokens in enumerate(clip_tokens):
+        text = decode_fn(tokens).strip() if len(tokens) else ""
+        texts.append(text if len(text) and ci not in merged else None)
+    return texts
+
+
+# Transcripts are appended to a journal next to metadata.csv as they are generated, instead of re-writing the whole
+# metadata.csv every few files. The journal is replayed when resuming, and compacted into metadata.csv at the end
+TRANSCRIPT_JOURNAL_FNAME = ".metadata_journal.csv"
+
+class TranscriptJournal(object):
+    def __init__(self, path):
+        super(TranscriptJournal, self).__init__()
+        self.path = path
+
+    def load (self):
+        """{file name: transcript} of the journal's complete lines. A last line cut off by a crash is dropped (and
+        truncated away, so appends don't run into it)"""
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "rb") as f:
+            data = f.read()
+        valid_len = data.rfind(b"\n")+1
+        for line in data[:valid_len].decode("utf8").split("\n"):
+            if "|" in line:
+                fname, text = line.split("|", 1)
+                entries[fname] = text
+        if valid_len < len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_len)
+        return entries
+
+    def append (self, entries):
+        """Appends [[file name, transcript], ...], and flushes them to disk"""
+        if not len(entries):
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf8") as f:
+            f.write("".join([f'{fname}|{text.replace(chr(10), " ")}\n' for fname, text in entries]))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove (self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class Wav2Vec2PlusPuncTranscribe(object):
     def __init__(self, logger, PROD, device, models_manager):
         super(Wav2Vec2PlusPuncTranscribe, self).__init__()
@@ -91,6 +241,8 @@ class Wav2Vec2PlusPuncTranscribe(object):
         ignore_existing_transcript = data["toolSettings"]["ignore_existing_transcript"] if "ignore_existing_transcript" in data["toolSettings"] else False
         transcription_model = data["toolSettings"]["transcription_model"] if "transcription_model" in data["toolSettings"] else "whisper_medium"
         whisper_lang = data["toolSettings"]["whisper_lang"] if "whisper_lang" in data["toolSettings"] else "en"
+        self.whisper_batch_size = int(data["toolSettings"]["whisper_batch_size"]) if "whisper_batch_size" in data["toolSettings"] else WHISPER_BATCH_SIZE
+        self.whisper_pack = data["toolSettings"]["whisper_pack"] if "whisper_pack" in data["toolSettings"] else False
         # useMP = data["toolSettings"]["useMP"] if "useMP" in data["toolSettings"].keys() else False
         # useMP_num_workers = int(data["toolSettings"]["useMP_num_workers"]) if "useMP_num_workers" in data["toolSettings"].keys() else 2
         # processes = max(1, int(mp.cpu_count()/2)-5) # TODO, figure out why more processes break the websocket
@@ -132,6 +284,15 @@ class Wav2Vec2PlusPuncTranscribe(object):
                                 finished_transcript[fname] = text
         self.inPathParent = inPathParent
 
+        # Transcripts from an interrupted run
+        self.journal = TranscriptJournal(f'{self.get_metadata_dir()}/{TRANSCRIPT_JOURNAL_FNAME}')
+        if ignore_existing_transcript:
+            self.journal.remove()
+        else:
+            journal_entries = self.journal.load()
+            self.logger.info(f'[transcribe] {len(journal_entries.keys())} transcript lines resumed from the journal')
+            finished_transcript.update(journal_entries)
+
 
 
 
@@ -187,6 +348,7 @@ class Wav2Vec2PlusPuncTranscribe(object):
 
 
         self.dump_to_file(finished_transcript)
+        self.journal.remove()
 
 
 
@@ -205,121 +367,130 @@ class Wav2Vec2PlusPuncTranscribe(object):
 
 
 
+    def get_metadata_dir (self):
+        return self.outputDirectory if self.outputDirectory and len(self.outputDirectory) else self.inPathParent
+
     def dump_to_file (self, transcript):
+        """Compacts the transcript into metadata.csv. Written to a temporary file first, so a crash part way through
+        leaves the old metadata.csv (and the journal) intact"""
         metadata = []
         for fname in list(transcript.keys()):
             metadata.append(f'{fname if ".wav" in fname else fname+".wav"}|{transcript[fname]}')
 
         if self.outputDirectory and len(self.outputDirectory):
             os.makedirs(self.outputDirectory, exist_ok=True)
-        with open(f'{self.outputDirectory if self.outputDirectory and len(self.outputDirectory) else self.inPathParent}/metadata.csv', "w+", encoding="utf8") as f:
+        metadata_path = f'{self.get_metadata_dir()}/metadata.csv'
+        with open(f'{metadata_path}.tmp', "w+", encoding="utf8") as f:
             f.write("\n".join(metadata))
+        os.replace(f'{metadata_path}.tmp', metadata_path)
 
 
-    def handle_whisper(self, finished_transcript, input_files):
-
-        finished_transcript_keys = list(finished_transcript.keys())
-
-        self.logger.info(f"[WHISPER] transcript finished_transcript_keys {finished_transcript_keys}")
-
-
-        for fi, file in enumerate(input_files):
-
-            if fi%3==0 and self.websocket is not None:
-                with open(f'{"./resources/app" if self.PROD else "."}/python/transcribe/.progress.txt', "w+") as f:
-                    f.write(f'{fi+1}/{len(input_files)} | {round(  int(fi+1) / len(input_files)*100  , 2)}%')
-
-            new_name = file.split("/")[-1]
-            if new_name in finished_transcript_keys:
+    def write_progress (self, done, total, start_time):
+        if self.websocket is not None:
+            clips_per_s = done/max(time.time()-start_time, 1e-3)
+            with open(f'{"./resources/app" if self.PROD else "."}/python/transcribe/.progress.txt', "w+") as f:
+                f.write(f'{done}/{total} | {round(done/max(total, 1)*100, 2)}% | {round(clips_per_s, 2)} clips/s')
+
+    def decode_whisper_batch (self, audios, options):
+        """Decodes a list of up to 30s audios, each padded to its own 30s window, in one forward pass"""
+        mels = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio)) for audio in audios]).to(self.model.device)
+        return whisper.decode(self.model, mels, options)
+
+    def transcribe_whisper_batch (self, audios):
+        """Transcripts of a batch of audios. With packing, short clips share windows, and are split back out by the
+        decoded timestamps (clips that can't be, or whole windows without usable timestamps, are decoded again, one clip
+        per window)"""
+        if not self.whisper_pack:
+            return [result.text for result in self.decode_whisper_batch(audios, self.options)]
+
+        audios = [trim_silent_edges(audio) for audio in audios]
+        gap = np.zeros((int(PACK_GAP_SECONDS*WHISPER_SR),), dtype=np.float32)
+        windows = pack_clips([len(audio)/WHISPER_SR for audio in audios])
+        window_audios = [np.concatenate([part for ci, offset in window for part in [audios[ci], gap]][:-1]) for window in windows]
+
+        options = dataclasses.replace(self.options, without_timestamps=False)
+        tokenizer = whisper.tokenizer.get_tokenizer(self.model.is_multilingual, language=options.language, task=options.task)
+        transcripts = [None for _ in audios]
+        unpacked = []
+        for window, result in zip(windows, self.decode_whisper_batch(window_audios, options)):
+            if len(window)==1:
+                transcripts[window[0][0]] = result.text
                 continue
-
-            # load audio and pad/trim it to fit 30 seconds
-
-            audio = whisper.load_audio(file, ffmpeg_path=self.ffmpeg_path)
-            audio = whisper.pad_or_trim(audio)
-
-            # make log-Mel spectrogram and move to the same device as the model
-            mel = whisper.log_mel_spectrogram(audio).to(self.model.device)
-
-            result = whisper.decode(self.model, mel, self.options)
-            transcript = result.text
-
-
-            transcript = transcript if transcript.endswith("?") or transcript.endswith("!") or transcript.endswith(".") or transcript.endswith(",") else f'{transcript}.'
-            transcript_punct = transcript if transcript.endswith("?") or transcript.endswith("!") or transcript.endswith(".")  or transcript.endswith(",") else f'{transcript}.'
-            finished_transcript[new_name] = transcript_punct
+            spans = [[offset, offset+len(audios[ci])/WHISPER_SR] for ci, offset in window]
+            texts = demux_packed_tokens(result.tokens, tokenizer.timestamp_begin, spans, tokenizer.decode)
+            if texts is None:
+                unpacked += [ci for ci, offset in window]
+            else:
+                for [ci, offset], text in zip(window, texts):
+                    if text is None:
+                        unpacked.append(ci)
+                    else:
+                        transcripts[ci] = text
+        if len(unpacked):
+            for ci, result in zip(unpacked, self.decode_whisper_batch([audios[ci] for ci in unpacked], self.options)):
+                transcripts[ci] = result.text
+        return transcripts
 
 
+    def handle_whisper(self, finished_transcript, input_files):
 
-            if fi==0 or (fi+1)%10==0:
-                self.dump_to_file(finished_transcript)
+        self.logger.info(f"[WHISPER] {len(finished_transcript.keys())} existing transcript lines")
+
+        todo_files = [file for file in input_files if file.split("/")[-1] not in finished_transcript]
+        num_done = 0
+        start_time = time.time()
+        self.logger.info(f"[WHISPER] batch size: {self.whisper_batch_size}, packing: {self.whisper_pack}")
+
+        def load_audio (file):
+            return whisper.load_audio(file, ffmpeg_path=self.ffmpeg_path)
+
+        batch_files, batch_audios = [], []
+        audio_stream = prefetch(todo_files, load_audio)
+        while True:
+            file, audio = next(audio_stream, [None, None])
+            if file is not None:
+                if isinstance(audio, Exception):
+                    self.logger.info(f'[WHISPER] Could not load {file}: {audio}')
+                else:
+                    batch_files.append(file)
+                    batch_audios.append(audio)
+                if len(batch_files)<self.whisper_batch_size:
+                    continue
+            if not len(batch_files):
+                break
+
+            transcripts = self.transcribe_whisper_batch(batch_audios)
+            new_entries = [[file.split("/")[-1], end_punctuate(transcript)] for file, transcript in zip(batch_files, transcripts)]
+            finished_transcript.update(new_entries)
+            self.journal.append(new_entries)
+
+            num_done += len(batch_files)
+            self.write_progress(num_done, len(todo_files), start_time)
+            batch_files, batch_audios = [], []
 
         return finished_transcript
 
     def handle_wav2vec(self, finished_transcript, input_files):
 
-        for fi, file in enumerate(input_files):
+        from python.transcribe.wav2vec2.model import clean_transcript
 
-            if fi%3==0 and self.websocket is not None:
-                with open(f'{"./resources/app" if self.PROD else "."}/python/transcribe/.progress.txt', "w+") as f:
-                    f.write(f'{fi+1}/{len(input_files)} | {round(  int(fi+1) / len(input_files)*100  , 2)}%')
+        # .wem is dropped from the names. Helps avoid some issues, later down the line
+        todo_files = [file for file in input_files if file.split("/")[-1].replace(".wem", "") not in finished_transcript]
+        start_time = time.time()
+        num_done = 0
 
-            new_name = file.split("/")[-1].replace(".wem", "") # Helps avoid some issues, later down the line
-            if new_name in list(finished_transcript.keys()):
-                continue
-            new_name = new_name.replace("_16khz", "")
-
-            transcript = self.wav2vec.infer(file)
-
-            if self.wav2vec.language=="en":
-                transcript = (" "+transcript.lower()+" ")\
-                    .replace(" on't ", " don't ")\
-                    .replace(" on't ", " don't ")\
-                    .replace(" do n't ", " don't ")\
-                    .replace(" i 'm ", " i'm ")\
-                    .replace('"', "")\
-                    .replace("hasn '. T", "hansn't")\
-                    .replace("hasn '. t", "hansn't")\
-                    .replace("you 've", "you've")\
-                    .replace("you 're", "you're")\
-                    .replace("does n't", "doesn't")\
-                    .replace(" will' ", " we'll ")\
-                    .replace("i don '", "i don't")\
-                    .replace("it ' ", "it's")\
-                    .replace(" '", "'")\
-                    .replace("i,'ve' ", "i've")\
-                    .replace("would n't", "wouldn't")\
-                    .replace("ca n't", "can't")\
-                    .replace("that,'s", "that's")\
-                    .replace("they ve", "they've")\
-                    .replace("we,'re", "we're")\
-                    .replace("did n't", "didn't")\
-                    .replace(" wo n't ", " won't ")\
-                    .replace(" is n't ", " isn't ")\
-                    .replace(" should n't ", " shouldn't ")\
-                    .replace("it s ", "it's ")\
-                    .replace(" have n't ", " haven't ")\
-                    .replace(" was n't ", " wasn't ")\
-                    .replace(" there s ", " there's ")\
-                    .replace(" are n't ", " aren't ")\
-                    .replace(" ai n't ", " ain't ")\
-                    .replace(" i ve ", " i've ")\
-                    .replace(" was nt ", " wasn't ")\
-                    .replace(" didn t ", " didn't ")\
-                    .replace(" weren t ", " weren't ")\
-                    .replace(" you re ", " you're ")\
-                    .replace(" ddon't ", " don't ")\
-                    .strip()
-            else:
-                transcript = transcript.lower().strip()
-
-            transcript = transcript if transcript.endswith("?") or transcript.endswith("!") or transcript.endswith(".") or transcript.endswith(",") else f'{transcript}.'
-            transcript_punct = transcript if transcript.endswith("?") or transcript.endswith("!") or transcript.endswith(".")  or transcript.endswith(",") else f'{transcript}.'
-            finished_transcript[new_name] = transcript_punct
+        for batch_files, transcripts, failed in self.wav2vec.infer_batch(todo_files):
+            for file, e in failed:
+                self.logger.info(f'[WAV2VEC2] Could not load {file}: {e}')
+            num_done += len(failed)
+            new_entries = []
+            for file, transcript in zip(batch_files, transcripts):
+                new_name = file.split("/")[-1].replace(".wem", "").replace("_16khz", "")
+                new_entries.append([new_name, end_punctuate(clean_transcript(transcript, self.wav2vec.language))])
+            finished_transcript.update(new_entries)
+            self.journal.append(new_entries)
 
-            if fi==0 or (fi+1)%10==0:
-                self.dump_to_file(finished_transcript)
+            num_done += len(batch_files)
+            self.write_progress(num_done, len(todo_files), start_time)
 
         return finished_transcript
-
-
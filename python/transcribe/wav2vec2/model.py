@@ -1,8 +1,136 @@
+import re
+import random
+from concurrent.futures import ThreadPoolExecutor
+
 import ffmpeg
 from transformers import Wav2Vec2Processor, Wav2Vec2ForCTC
+import numpy as np
 import soundfile as sf
 import torch
 
+
+# Batches are built from inputs sorted by length, so little of each batch is padding, and capped by their padded size
+MAX_BATCH_SAMPLES = 16000*120
+MAX_BATCH_SIZE = 32
+CONVERT_WORKERS = 4
+
+
+# English contraction fix-ups, in the order they used to be applied, as a chain of .replace() calls
+CONTRACTION_FIXES = [
+    [" on't ", " don't "],
+    [" do n't ", " don't "],
+    [" i 'm ", " i'm "],
+    ['"', ""],
+    ["hasn '. T", "hansn't"],
+    ["hasn '. t", "hansn't"],
+    ["you 've", "you've"],
+    ["you 're", "you're"],
+    ["does n't", "doesn't"],
+    [" will' ", " we'll "],
+    ["i don '", "i don't"],
+    ["it ' ", "it's"],
+    [" '", "'"],
+    ["i,'ve' ", "i've"],
+    ["would n't", "wouldn't"],
+    ["ca n't", "can't"],
+    ["that,'s", "that's"],
+    ["they ve", "they've"],
+    ["we,'re", "we're"],
+    ["did n't", "didn't"],
+    [" wo n't ", " won't "],
+    [" is n't ", " isn't "],
+    [" should n't ", " shouldn't "],
+    ["it s ", "it's "],
+    [" have n't ", " haven't "],
+    [" was n't ", " wasn't "],
+    [" there s ", " there's "],
+    [" are n't ", " aren't "],
+    [" ai n't ", " ain't "],
+    [" i ve ", " i've "],
+    [" was nt ", " wasn't "],
+    [" didn t ", " didn't "],
+    [" weren t ", " weren't "],
+    [" you re ", " you're "],
+    [" ddon't ", " don't "],
+]
+
+def compile_contraction_fixes (fixes):
+    """Compiles the ordered .replace() chain into one regex alternation, applied in a single pass. Word boundary spaces
+    become lookarounds, so back to back matches don't compete for the space between them. What the earlier links of
+    the chain did to the text is folded into the later patterns: once " '" is joined up, a space can't be followed by
+    a quote, and a space eaten by an earlier fix can't start a later match"""
+    # A fix can also complete a later fix's pattern with the text after it (eg "hasn '. that,'s" -> "hansn'that,'s" ->
+    # "hansn'that's"). Those get a combined fix of their own, in the later fix's place
+    fixes = [[pattern, replacement] for pattern, replacement in fixes]
+    for fi in range(len(fixes)-1, -1, -1):
+        pattern, replacement = fixes[fi]
+        for fj in range(len(fixes)-1, fi, -1):
+            later_pattern, later_replacement = fixes[fj]
+            for overlap in range(1, min(len(replacement), len(later_pattern))):
+                if replacement.endswith(later_pattern[:overlap]) and " " not in later_pattern[:overlap]:
+                    fixes.insert(fj, [pattern+later_pattern[overlap:], replacement[:-overlap]+later_replacement])
+
+    patterns = {}
+    joined_quotes = False
+    eaten_spaces = [] # Patterns whose trailing space the fix removes
+    for pattern, replacement in fixes:
+        if pattern=='"':
+            continue # Stripped up-front
+        joined_quotes = joined_quotes or pattern==" '"
+        leading = pattern.startswith(" ") and replacement.startswith(" ")
+        trailing = pattern.endswith(" ") and replacement.endswith(" ")
+        core_pattern = pattern[1 if leading else 0:len(pattern)-(1 if trailing else 0)]
+        core_replacement = replacement[1 if leading else 0:len(replacement)-(1 if trailing else 0)]
+
+        regex = re.escape(core_pattern)
+        if leading:
+            regex = "(?<= )" + "".join([f'(?<!{re.escape(eaten)})' for eaten in eaten_spaces]) + regex
+        if trailing:
+            regex += "(?= (?!'))" if joined_quotes else "(?= )"
+        elif joined_quotes and core_pattern.endswith(" "):
+            regex += "(?!')"
+        if regex not in patterns.keys():
+            patterns[regex] = [core_pattern, core_replacement]
+        if pattern.endswith(" ") and not replacement.endswith(" "):
+            eaten_spaces.append(pattern)
+
+    # Longest first, so the alternation prefers the longest fix at any position
+    regexes = sorted(patterns.keys(), key=lambda regex: -len(patterns[regex][0]))
+    return re.compile("|".join([f'({regex})' for regex in regexes])), [patterns[regex][1] for regex in regexes]
+
+CONTRACTION_REGEX, CONTRACTION_REPLACEMENTS = compile_contraction_fixes(CONTRACTION_FIXES)
+
+def fix_contractions (transcript):
+    transcript = " "+transcript.lower().replace('"', "")+" "
+    return CONTRACTION_REGEX.sub(lambda match: CONTRACTION_REPLACEMENTS[match.lastindex-1], transcript).strip()
+
+def fix_contractions_chain (transcript):
+    """The .replace() chain, for check_contraction_fixes. Links with a space at both ends are run until they no longer
+    match (the old chain missed the second of two back to back matches, eg " ddon't ddon't ", as the first one used up
+    the space between them)"""
+    transcript = " "+transcript.lower()+" "
+    for pattern, replacement in CONTRACTION_FIXES:
+        transcript = transcript.replace(pattern, replacement)
+        while pattern.startswith(" ") and pattern.endswith(" ") and pattern in transcript:
+            transcript = transcript.replace(pattern, replacement)
+    return transcript.strip()
+
+def check_contraction_fixes (num_sentences=200000, seed=1234):
+    """The single-pass table against the chain, over random sentences of the words the fixes are made of"""
+    rng = random.Random(seed)
+    words = "i you it that they we there would could do does did is was were are have has will should ai wo ca don on " \
+            "the a go s t ve re m nt n't 't ' 'm 've 're 's '. , i,'ve' that,'s we,'re \" on't ddon't didn weren hasn".split(" ")
+    for _ in range(num_sentences):
+        sentence = " ".join([rng.choice(words) for _ in range(rng.randint(1, 8))])
+        assert fix_contractions(sentence)==fix_contractions_chain(sentence), f'"{sentence}": "{fix_contractions(sentence)}" vs "{fix_contractions_chain(sentence)}"'
+    print(f'Single-pass contraction fixes match the .replace() chain, over {num_sentences} sentences')
+
+def clean_transcript (transcript, language):
+    if language=="en":
+        return fix_contractions(transcript)
+    return transcript.lower().strip()
+
+
 class Wav2Vec2(object):
     def __init__(self, logger, PROD, device, models_manager, language="en"):
         super(Wav2Vec2, self).__init__()
@@ -35,13 +163,17 @@ class Wav2Vec2(object):
         self.ckpt_path = ckpt_path
 
 
-    def infer (self, audiopath):
+    def to_16khz (self, audiopath):
         if "_16khz.wav" not in audiopath:
             stream = ffmpeg.input(audiopath)
             ffmpeg_options = {"ar": "16000", "ac": "1"}
             stream = ffmpeg.output(stream, audiopath.replace(".wav", "_16khz.wav"), **ffmpeg_options)
             out, err = (ffmpeg.run(stream, cmd=self.ffmpeg_path, capture_stdout=True, capture_stderr=True, overwrite_output=True))
             audiopath = audiopath.replace(".wav", "_16khz.wav")
+        return audiopath
+
+    def infer (self, audiopath):
+        audiopath = self.to_16khz(audiopath)
 
         audio_input, sample_rate = sf.read(audiopath)
 
@@ -54,6 +186,92 @@ class Wav2Vec2(object):
         transcription = self.processor.decode(predicted_ids[0]).lower()
         return transcription
 
+    def get_16khz_length (self, audiopath):
+        """The input's length in samples once at 16kHz, read from its header, or None if soundfile can't read it"""
+        try:
+            info = sf.info(audiopath)
+        except KeyboardInterrupt:
+            raise
+        except:
+            return None
+        return int(info.frames*16000/info.samplerate)
+
+    def load_16khz (self, audiopath):
+        return sf.read(self.to_16khz(audiopath))[0]
+
+    def infer_batch (self, audiopaths, max_batch_samples=MAX_BATCH_SAMPLES, max_batch_size=MAX_BATCH_SIZE):
+        """Yields ([audiopath, ...], [transcript, ...], [[failed audiopath, exception], ...]) batches, covering all the
+        audiopaths (in length order, not input order). The inputs are sorted by length, then batched so that the padded
+        batch (longest input x batch size) stays under max_batch_samples. Each batch is converted to 16kHz just before
+        it is decoded (the next batch's conversions run while the current one is decoded). Inputs that fail to convert
+        or read are returned as failed, and left out of their batch"""
+        lengths = [self.get_16khz_length(path) for path in audiopaths]
+
+        with ThreadPoolExecutor(max_workers=CONVERT_WORKERS) as executor:
+            failed = []
+
+            # Only the inputs soundfile can't read (eg .wem) need converting first, to know their length
+            unknown = [index for index, length in enumerate(lengths) if length is None]
+            for index, future in [[index, executor.submit(self.to_16khz, audiopaths[index])] for index in unknown]:
+                try:
+                    lengths[index] = sf.info(future.result()).frames
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    failed.append([audiopaths[index], e])
+
+            batches = []
+            batch = []
+            for index in sorted([index for index in range(len(audiopaths)) if lengths[index] is not None], key=lambda index: -lengths[index]):
+                # Longest first, so the batch's padded length is that of its first input
+                if len(batch) and (len(batch)+1)*lengths[batch[0]] > max_batch_samples or len(batch)>=max_batch_size:
+                    batches.append(batch)
+                    batch = []
+                batch.append(index)
+            if len(batch):
+                batches.append(batch)
+
+            if len(failed):
+                yield [], [], failed
+            if not len(batches):
+                return
+
+            next_futures = [executor.submit(self.load_16khz, audiopaths[index]) for index in batches[0]]
+            for bi, batch in enumerate(batches):
+                futures = next_futures
+                if bi+1<len(batches):
+                    next_futures = [executor.submit(self.load_16khz, audiopaths[index]) for index in batches[bi+1]]
+
+                loaded = []
+                audios = []
+                failed = []
+                for index, future in zip(batch, futures):
+                    try:
+                        audios.append(future.result())
+                        loaded.append(index)
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception as e:
+                        failed.append([audiopaths[index], e])
+                if not len(loaded):
+                    yield [], [], failed
+                    continue
+
+                inputs = self.processor(audios, sampling_rate=16000, return_tensors="pt", padding="longest")
+                attention_mask = inputs["attention_mask"].to(self.model.device) if "attention_mask" in inputs.keys() else None
+                with torch.no_grad():
+                    logits = self.model(inputs.input_values.to(self.model.device), attention_mask=attention_mask).logits
+                predicted_ids = torch.argmax(logits, dim=-1).cpu()
+
+                # Drop the frames that only cover each input's padding
+                num_frames = self.model._get_feat_extract_output_lengths(torch.tensor([len(audio) for audio in audios]))
+                transcripts = [self.processor.decode(predicted_ids[ai, :int(num_frames[ai])]).lower() for ai in range(len(loaded))]
+                yield [audiopaths[index] for index in loaded], transcripts, failed
+
     def set_device (self, device):
         self.device = device
         self.model = self.model.to(device)
+
+
+if __name__ == '__main__':
+    check_contraction_fixes()
@@ -1,5 +1,7 @@
 
+import os
 import json
+import tempfile
 import traceback
 
 import subprocess
@@ -7,6 +9,24 @@ import subprocess
 # Not a model, but it was easier to just integrate the code this way
 
 
+def wem2oggDecode (inPath, tool_path):
+    """Decoded audio of a .wem file, for audio pipelines: as float32 (samples, channels), and its sample rate. ww2ogg can
+    only write to a file, so this goes through a temporary .ogg"""
+    import soundfile as sf
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    fd, ogg_path = tempfile.mkstemp(suffix=".ogg")
+    os.close(fd)
+    try:
+        sp = subprocess.Popen(f'{tool_path}/ww2ogg/ww2ogg.exe "{inPath}" -o "{ogg_path}" --pcb {tool_path}/ww2ogg/packed_codebooks_aoTuV_603.bin', startupinfo=startupinfo, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = sp.communicate()
+        if sp.returncode!=0:
+            raise Exception(f'ww2ogg error: {stderr.decode("utf-8")}')
+        return sf.read(ogg_path, dtype="float32", always_2d=True)
+    finally:
+        os.remove(ogg_path)
+
+
 class Wem2Ogg(object):
     def __init__(self, logger, PROD, device, models_manager):
         super(Wem2Ogg, self).__init__()
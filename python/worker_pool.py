@@ -0,0 +1,176 @@
+import asyncio
+import traceback
+import multiprocessing as mp
+
+# One long-lived process pool, owned by the ModelsManager, shared by the batch audio tools (formatting, normalize,
+# silence cut/split, cut padding), instead of each tool starting up a fresh mp.Pool per task.
+#
+# Jobs are submitted from the websocket event loop, and awaited without blocking it (the old pool.map() calls blocked
+# the loop for the whole batch, which is what broke the websocket with more processes). Work items are fed to the pool
+# a few at a time, so a job can be cancelled part way through: items already running finish, no new ones get started.
+
+
+class WorkerPool(object):
+    def __init__(self, logger, workers=None):
+        super(WorkerPool, self).__init__()
+        self.logger = logger
+        self.workers = max(1, mp.cpu_count()-1) if workers is None else max(1, int(workers))
+        self.pool = None
+        self.pool_workers = None
+        self.jobs = {} # job id -> {"cancelled": bool}
+
+
+    def get_pool (self):
+        if self.pool is not None and self.pool_workers!=self.workers and not len(self.jobs):
+            self.shutdown() # The worker count was changed. Re-start the pool with it, now that it's idle
+        if self.pool is None:
+            self.logger.info(f'[worker pool] workers: {self.workers}')
+            self.pool = mp.Pool(self.workers)
+            self.pool_workers = self.workers
+        return self.pool
+
+    def set_workers (self, workers):
+        """Takes effect from the next job, once no jobs are running"""
+        self.workers = max(1, int(workers))
+
+    def shutdown (self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+    def cancel (self, job_id=None):
+        """Cancels the given job (or all of them). Returns True if any running job was cancelled"""
+        cancelled = False
+        for jid, job in self.jobs.items():
+            if job_id is None or jid==job_id:
+                job["cancelled"] = True
+                cancelled = True
+        return cancelled
+
+    def is_running (self, job_id):
+        return job_id in self.jobs.keys()
+
+
+    async def map (self, fn, work_items, job_id=None, concurrency=None, on_result=None):
+        """Runs fn (a picklable, module level function) over the work items in the pool
+
+        job_id - for cancel()ing the job. Only one job per id can run at a time
+        concurrency - the max number of the job's items in the pool at once. Defaults to enough to keep all workers busy
+        on_result - optional fn(item index, result), or coroutine fn, called as each item finishes
+
+        Returns (results, cancelled). results are in work_items order, None for items not run. An item whose fn raised
+        gets the exception's traceback (including the worker's), as a string, for its result
+        """
+        job_id = id(work_items) if job_id is None else job_id
+        if job_id in self.jobs.keys():
+            raise Exception(f'A "{job_id}" job is already running')
+
+        loop = asyncio.get_event_loop()
+        pool = self.get_pool()
+        job = {"cancelled": False}
+        self.jobs[job_id] = job
+
+        in_flight = 2*self.pool_workers if concurrency is None else max(1, int(concurrency))
+        results = [None for _ in work_items]
+
+        def resolve (future, result):
+            if not future.done():
+                future.set_result(result)
+
+        try:
+            pending = set()
+            future_indexes = {}
+            next_index = 0
+            while True:
+                while not job["cancelled"] and next_index<len(work_items) and len(pending)<in_flight:
+                    future = loop.create_future()
+                    pool.apply_async(fn, (work_items[next_index],), \
+                        callback=lambda result, future=future: loop.call_soon_threadsafe(resolve, future, result), \
+                        error_callback=lambda e, future=future: loop.call_soon_threadsafe(resolve, future, "".join(traceback.format_exception(type(e), e, e.__traceback__))))
+                    future_indexes[future] = next_index
+                    pending.add(future)
+                    next_index += 1
+
+                if not len(pending):
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in sorted(done, key=lambda future: future_indexes[future]):
+                    index = future_indexes.pop(future)
+                    results[index] = future.result()
+                    if on_result is not None:
+                        callback_out = on_result(index, results[index])
+                        if asyncio.iscoroutine(callback_out):
+                            await callback_out
+        finally:
+            del self.jobs[job_id]
+
+        return results, job["cancelled"]
+
+
+def check_task (item):
+    # Module level, so the pool can pickle it
+    import time
+    if item=="raise":
+        raise ValueError("check_task failure")
+    time.sleep(item)
+    return item
+
+
+def check_worker_pool (workers=2):
+    """Deterministic checks of the pool jobs: results in order, worker errors as results, one job per id, and
+    cancellation (no new items start once cancelled, items already running finish, the id is free again afterwards)"""
+    import logging
+    pool = WorkerPool(logging.getLogger("worker_pool"), workers=workers)
+
+    async def run_checks ():
+        items = [0.05*(i%3) for i in range(8)]
+        results, cancelled = await pool.map(check_task, items, job_id="check")
+        assert results==items and not cancelled, results
+        assert not pool.is_running("check") and not pool.cancel("check")
+
+        results, cancelled = await pool.map(check_task, [0.01, "raise", 0.01], job_id="check")
+        assert results[0]==0.01 and results[2]==0.01 and "check_task failure" in results[1], results
+
+        # Cancelled from the on_result callback, after the 2nd item. At most concurrency items were in the pool then
+        concurrency = 3
+        finished = []
+        def on_result (index, result):
+            finished.append(index)
+            if len(finished)==2:
+                assert pool.cancel("check")
+        results, cancelled = await pool.map(check_task, [0.1 for _ in range(12)], job_id="check", concurrency=concurrency, on_result=on_result)
+        run = [ri for ri, result in enumerate(results) if result is not None]
+        assert cancelled and sorted(finished)==run, (finished, run)
+        assert run==list(range(len(run))) and 2<=len(run)<=2+concurrency, run
+        assert not pool.is_running("check")
+
+        # Cancelled from outside the job, while it runs. Only one job per id at a time
+        job = asyncio.ensure_future(pool.map(check_task, [0.1 for _ in range(12)], job_id="check", concurrency=2))
+        await asyncio.sleep(0.25)
+        try:
+            await pool.map(check_task, [0], job_id="check")
+            assert False, "A second job with the same id ran"
+        except Exception as e:
+            assert "already running" in str(e), e
+        assert pool.cancel()
+        results, cancelled = await job
+        assert cancelled and 0<len([result for result in results if result is not None])<12, results
+
+        # The id can be re-used after the cancellation
+        results, cancelled = await pool.map(check_task, [0, 0], job_id="check")
+        assert results==[0, 0] and not cancelled
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_checks())
+    finally:
+        loop.close()
+        pool.shutdown()
+    print(f'Worker pool jobs and cancellation OK ({workers} workers)')
+
+
+if __name__ == '__main__':
+    check_worker_pool()
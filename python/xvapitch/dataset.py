@@ -1,6 +1,7 @@
 import collections
 import os
 import random
+import threading
 import traceback
 from typing import Dict, List
 
@@ -18,6 +19,9 @@ try:
     from python.xvapitch.speaker_representation.main import ResNetSpeakerEncoder
     from python.xvapitch.text import get_text_preprocessor, lang_names
     from python.xvapitch.stft import STFT
+    from python.xvapitch.feature_store import FeatureStore
+    from python.xvapitch.sample_cache import SampleCache
+    from python.xvapitch.speaker_embs import load_emb_manifest, save_emb_manifest, extract_embeddings, update_emb_matrix, EmbeddingStore
 except:
     from audio import AudioProcessor
     from util import text_to_sequence, prepare_data, prepare_stop_target, prepare_tensor, sequence_mask
@@ -25,6 +29,9 @@ except:
     from speaker_representation.main import ResNetSpeakerEncoder
     from text import get_text_preprocessor, lang_names
     from stft import STFT
+    from feature_store import FeatureStore
+    from sample_cache import SampleCache
+    from speaker_embs import load_emb_manifest, save_emb_manifest, extract_embeddings, update_emb_matrix, EmbeddingStore
 
 class TacotronSTFT(torch.nn.Module):
     def __init__(self, filter_length=1024, hop_length=256, win_length=1024,
@@ -70,6 +77,57 @@ def dynamic_range_compression(x, C=1, clip_val=1e-5):
 def dynamic_range_decompression(x, C=1):
     return torch.exp(x) / C
 
+class CollateBuffers(object):
+    """Output tensors for TTSDataset.collate_fn.
+
+    In DataLoader workers, batches are handed over to the main process through shared memory (and then pinned by the
+    DataLoader), so a buffer can't be re-used while an earlier batch may still be in flight. There, a fresh tensor is
+    allocated per field. When collating in the main process with CUDA available, a small ring of pinned buffers is
+    re-used instead, only growing when a batch needs more space than any before it.
+
+    Each dataset (so each DataLoader) has its own ring. With a DevicePrefetcher on the loader, up to 4 of its batches can
+    hold a slot at once: the one being trained on (its non_blocking copy may still be pending), the one queued, the one
+    staged and waiting to be queued, and the one being collated - hence the 4 slots. Collation holds the lock, in case
+    two threads ever collate through the same dataset.
+    """
+    def __init__(self, num_slots=4):
+        super(CollateBuffers, self).__init__()
+        self.num_slots = num_slots
+        self.slot = 0
+        self.buffers = [{} for _ in range(num_slots)]
+        self.use_pinned = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["buffers"] = [{} for _ in range(self.num_slots)]
+        state["use_pinned"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, name, shape, dtype):
+        if self.use_pinned is None:
+            self.use_pinned = torch.utils.data.get_worker_info() is None and torch.cuda.is_available()
+        if not self.use_pinned:
+            return torch.zeros(shape, dtype=dtype)
+
+        numel = int(np.prod(shape))
+        buffer = self.buffers[self.slot].get(name, None)
+        if buffer is None or buffer.dtype!=dtype or buffer.numel()<numel:
+            buffer = torch.empty(int(numel*1.25)+1, dtype=dtype).pin_memory() # Some headroom, to avoid re-allocating for every slightly longer batch
+            self.buffers[self.slot][name] = buffer
+        out = buffer[:numel].view(shape)
+        out.zero_()
+        return out
+
+    def next_slot(self):
+        self.slot = (self.slot+1) % self.num_slots
+
+
 class TTSDataset(Dataset):
     def __init__(
         self,
@@ -79,7 +137,9 @@ class TTSDataset(Dataset):
         meta_data_finetune=None,
         min_seq_len: int = 0,
         lang_override = None,
-        is_ft = False
+        is_ft = False,
+        use_feature_store = False,
+        cache_bytes = 0
     ):
         super().__init__()
         self.args = args
@@ -139,17 +199,11 @@ class TTSDataset(Dataset):
 
 
         self.dataset_cache = {}
-        self.dataset_cache["mel"] = {}
-        self.dataset_cache["wav"] = {}
-        self.dataset_cache["text"] = {}
-        self.dataset_cache["pitch"] = {}
         self.dataset_cache["text_too_short"] = {}
         self.dataset_cache["text_too_long"] = {}
-        self.dataset_cache["speaker_embedding"] = {}
-        self.total_cached_samples = 0
-        self.MAX_CACHE_SAMPLES = 30000
-        self.MAX_CACHE_SAMPLES = 10000
-        self.MAX_CACHE_SAMPLES = 0 # costs RAM
+        # Byte-bounded LRU caches for wav/mel/linear/text/speaker_embedding (0 bytes disables them, as it costs RAM). The
+        # feature store serves the wav/mel/linear features itself, so then only the text/embeddings are worth caching
+        self.sample_cache = SampleCache(cache_bytes, kinds=["text", "speaker_embedding"] if use_feature_store else None)
 
         # self.pitch_mean = torch.Tensor([214.72203]) # LJSpeech
         # self.pitch_std = torch.Tensor([65.72038]) # LJSpeech
@@ -160,6 +214,33 @@ class TTSDataset(Dataset):
         if self.args.fp_emels:
             self.stft = TacotronSTFT(filter_length=1024, hop_length=256, win_length=1024, n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0, mel_fmax=8000)
 
+        # Pre-extracted (memory-mapped) wav/mel/linear features. Populated via extract_features()
+        self.feature_store = FeatureStore(self.ap) if use_feature_store else None
+        self.emb_store = EmbeddingStore()
+        self.item_lengths = {}
+
+    def extract_features(self, workers=1, trainer=None, cmd_training=True):
+        if self.feature_store is None:
+            return
+        wav_files = [item[1] for item in self.items]
+        self.feature_store.extract(wav_files, workers=workers, trainer=trainer, cmd_training=cmd_training)
+
+    def get_item_lengths(self):
+        # (Approximate) mel lengths of the items, for length-bucketed batching. Taken from the feature store when
+        # available, otherwise estimated from the 16 bit PCM wav file size (ignoring the silence trimming)
+        lengths = []
+        for item in self.items:
+            wav_file = item[1].replace("\\","/")
+            if wav_file not in self.item_lengths.keys():
+                num_frames = self.feature_store.get_num_frames(wav_file) if self.feature_store is not None else None
+                if num_frames is None:
+                    try:
+                        num_frames = int(max(0, os.path.getsize(wav_file)-44) / 2 / self.ap.hop_length) + 1
+                    except OSError:
+                        num_frames = 0
+                self.item_lengths[wav_file] = num_frames
+            lengths.append(self.item_lengths[wav_file])
+        return lengths
 
     def calibrate_loss_sampling(self, loss_sampling_dict):
 
@@ -237,18 +318,28 @@ class TTSDataset(Dataset):
         if len(text)==9 and text=="TOO SHORT":
             return self.load_data(random.randint(0, len(self.items)))
 
-        wav = self.get_wav(wav_file)
-        if wav is None:
-            print("wav is None")
-            return self.load_data(random.randint(0, len(self.items)))
+        features = self.feature_store.get(wav_file) if self.feature_store is not None else None
+        if features is not None:
+            wav, mel, linear = features["wav"], features["mel"], features["linear"]
+        else:
+            wav = self.get_wav(wav_file)
+            if wav is None:
+                print("wav is None")
+                return self.load_data(random.randint(0, len(self.items)))
 
 
-        try:
-            mel = self.ap.melspectrogram(wav).astype("float32")
-        except:
-            print(f'wav_file, {wav_file}')
-            raise
-        linear = self.ap.spectrogram(wav).astype("float32")
+            mel = self.sample_cache.get("mel", wav_file)
+            if mel is None:
+                try:
+                    mel = self.ap.melspectrogram(wav).astype("float32")
+                except:
+                    print(f'wav_file, {wav_file}')
+                    raise
+                self.sample_cache.put("mel", wav_file, mel)
+            linear = self.sample_cache.get("linear", wav_file)
+            if linear is None:
+                linear = self.ap.spectrogram(wav).astype("float32")
+                self.sample_cache.put("linear", wav_file, linear)
 
         if mel.shape[1]<self.spec_segment_size:
             self.dataset_cache["text_too_short"][raw_text] = "x"
@@ -295,67 +386,57 @@ class TTSDataset(Dataset):
         if raw_text in self.dataset_cache["text_too_short"].keys():
             return "TOO SHORT"
 
-        try:
-            text = self.dataset_cache["text"][raw_text]
+        text = self.sample_cache.get("text", raw_text)
+        if text is not None:
             return text
-        except:
-            try:
-                text, _ = self.tp[lang].text_to_sequence(raw_text)
-            except:
-                print(f'File: {wav_file}')
-                raise
-
-            space = [self.tp[lang].ALL_SYMBOLS.index("_")]
-
-            if self.prepend_space_to_text:
-                text = space + text
 
-            if self.append_space_to_text:
-                text = text + space
-
-            text = np.asarray(text)
+        try:
+            text, _ = self.tp[lang].text_to_sequence(raw_text)
+        except:
+            print(f'File: {wav_file}')
+            raise
 
+        space = [self.tp[lang].symbol_to_id["_"]]
 
+        if self.prepend_space_to_text:
+            text = space + text
 
+        if self.append_space_to_text:
+            text = text + space
 
-        if self.total_cached_samples < self.MAX_CACHE_SAMPLES:
-            self.total_cached_samples += 1
-            self.dataset_cache["text"][raw_text] = text
+        text = np.asarray(text)
 
+        self.sample_cache.put("text", raw_text, text)
         return text
 
     def get_wav(self, filename, retryCount=0):
-        if filename in self.dataset_cache["wav"].keys():
-            wav = self.dataset_cache["wav"][filename]
+        wav = self.sample_cache.get("wav", filename)
+        if wav is not None:
             return wav
-        else:
-            if not os.path.exists(filename):
-                return None
-            wav = self.ap.load_wav(filename)
-            if wav is None:
-                print("==DEL_BAD_FILE==")
-                os.remove(filename)
-                return None
 
-        if self.total_cached_samples < self.MAX_CACHE_SAMPLES:
-            self.total_cached_samples += 1
-            self.dataset_cache["wav"][filename] = wav
+        if not os.path.exists(filename):
+            return None
+        wav = self.ap.load_wav(filename)
+        if wav is None:
+            print("==DEL_BAD_FILE==")
+            os.remove(filename)
+            return None
 
-        return np.asarray(wav, dtype=np.float32)
+        wav = np.asarray(wav, dtype=np.float32)
+        self.sample_cache.put("wav", filename, wav)
+        return wav
 
     def get_embedding(self, wav_file):
         emb_path = wav_file.replace("/wavs_postprocessed/", "/wavs/")
         emb_path = emb_path.replace("/wavs/", "/se_embs/").replace(".wav", ".npy")
-        try:
-            emb = self.dataset_cache["speaker_embedding"][emb_path]
+        emb = self.sample_cache.get("speaker_embedding", emb_path)
+        if emb is not None:
             return emb
-        except:
-            emb = np.load(emb_path)
-
-        if self.total_cached_samples < self.MAX_CACHE_SAMPLES:
-            self.total_cached_samples += 1
-            self.dataset_cache["speaker_embedding"][emb_path] = emb
 
+        emb = self.emb_store.get(wav_file) # From the dataset's consolidated embeddings matrix
+        if emb is None:
+            emb = np.load(emb_path)
+        self.sample_cache.put("speaker_embedding", emb_path, emb)
         return emb
 
 
@@ -402,6 +483,112 @@ class TTSDataset(Dataset):
 
     def collate_fn(self, batch):
         r"""
+        Perform preprocessing and create a final data batch:
+        1. Sort batch instances by text-length
+        2. Allocate the output tensors once, at the batch maxima (re-used pinned memory when collating in the main process)
+        3. Write each field's items directly into them, without intermediate numpy padding/stacking/transposing
+        """
+
+        # Puts each data field into a tensor with outer dimension batch size
+        if isinstance(batch[0], collections.abc.Mapping):
+
+            text_lengths = np.array([len(d["text"]) for d in batch])
+
+            # sort items with text input length for RNN efficiency
+            batch, text_lengths, ids_sorted_decreasing = self._sort_batch(batch, text_lengths)
+            batch_size = len(batch)
+
+            # get language ids from language names
+            if self.language_id_mapping is not None:
+                language_ids = torch.LongTensor([self.language_id_mapping[d["language_name"]] for d in batch])
+            else:
+                language_ids = None
+            wav_files_names = [d["item_idx"] for d in batch]
+
+            d_vectors = torch.from_numpy(np.stack([d["d_vectors"] for d in batch]).astype(np.float32))
+
+            mel_lengths = torch.LongTensor([d["mel"].shape[1] for d in batch])
+            # lengths adjusted by the reduction factor
+            mel_lengths_adjusted = ((mel_lengths + self.outputs_per_step - 1) // self.outputs_per_step) * self.outputs_per_step
+            max_mel_len = int(mel_lengths_adjusted.max())
+
+            buffers = self.get_collate_buffers()
+            with buffers.lock:
+
+                # Text - a single masked scatter of all the (concatenated) sequences
+                text = buffers.get("text", (batch_size, int(text_lengths.max())), torch.long)
+                text[sequence_mask(text_lengths)] = torch.from_numpy(np.concatenate([d["text"] for d in batch]).astype(np.int64))
+
+                # Linear spectrograms - written as B x D x T, and returned as the B x T x D view, which the model transposes straight back
+                linear_dim = batch[0]["linear"].shape[0]
+                linear = buffers.get("linear", (batch_size, linear_dim, max_mel_len), torch.float32)
+                for i, d in enumerate(batch):
+                    linear[i, :, :d["linear"].shape[1]] = torch.from_numpy(np.ascontiguousarray(d["linear"]))
+                linear = linear.transpose(1, 2)
+
+                # Waveforms, cut to the (adjusted) mel length, and edge-padded by one hop
+                hop_length = self.ap.hop_length
+                wav_lengths = torch.LongTensor([d["wav"].shape[0] for d in batch])
+                wav_padded = buffers.get("waveform", (batch_size, max_mel_len * hop_length, 1), torch.float32)
+                for i, d in enumerate(batch):
+                    w = d["wav"]
+                    max_len = int(mel_lengths_adjusted[i]) * hop_length
+                    num_samples = min(w.shape[0], max_len)
+                    wav_padded[i, :num_samples, 0] = torch.from_numpy(np.ascontiguousarray(w[:num_samples]))
+                    num_edge = min(hop_length * self.outputs_per_step, max_len - num_samples)
+                    if num_edge > 0:
+                        wav_padded[i, num_samples:num_samples+num_edge, 0] = float(w[-1])
+
+                mel_mask = sequence_mask(mel_lengths)
+
+                pitch_padded = torch.tensor([0])
+                energy_padded = torch.tensor([0])
+
+                if self.args.pitch:
+                    # Right zero-pad pitch to the mel length
+                    n_formants = batch[0]["pitch"].shape[-2]
+                    max_target_len = int(mel_lengths.max())
+                    pitch_padded = buffers.get("pitch", (batch_size, n_formants, max_target_len), torch.float32)
+                    for i, d in enumerate(batch):
+                        pitch = torch.squeeze(d["pitch"], 0)[:, :max_target_len]
+                        pitch_padded[i, :, :pitch.shape[-1]] = pitch
+
+                buffers.next_slot()
+
+            return {
+                "text": text,
+                "text_lengths": text_lengths,
+                "linear": linear,
+                "pitch_padded": pitch_padded,
+                "energy_padded": energy_padded,
+                "mel_lengths": mel_lengths,
+                "mel_mask": mel_mask,
+                "d_vectors": d_vectors,
+                "waveform": wav_padded,
+                "language_ids": language_ids,
+                "wav_files_names": wav_files_names,
+                "cache_stats": self.sample_cache.get_stats(),
+            }
+
+        raise TypeError(
+            (
+                "batch must contain tensors, numbers, dicts or lists;\
+                         found {}".format(
+                    type(batch[0])
+                )
+            )
+        )
+
+    def get_collate_buffers(self):
+        # Created lazily, so each DataLoader worker (or the main process) gets its own
+        if getattr(self, "collate_buffers", None) is None:
+            self.collate_buffers = CollateBuffers()
+        return self.collate_buffers
+
+    def collate_fn_legacy(self, batch):
+        r"""
+        Original (numpy padding based) collation. Kept for reference/benchmarking against collate_fn.
+
         Perform preprocessing and create a final data batch:
         1. Sort batch instances by text-length
         2. Convert Audio signal to features.
@@ -524,6 +711,7 @@ class TTSDataset(Dataset):
                 "waveform": wav_padded,
                 "language_ids": language_ids,
                 "wav_files_names": wav_files_names,
+                "cache_stats": self.sample_cache.get_stats(),
             }
 
         raise TypeError(
@@ -585,17 +773,12 @@ def normalize_pitch(pitch, mean, std):
     return pitch
 
 
-def read_datasets (languages, dataset_roots, extract_embs, device, data_mult=1, trainer=None, cmd_training=True, is_ft=False):
+def read_datasets (languages, dataset_roots, extract_embs, device, data_mult=1, trainer=None, cmd_training=True, is_ft=False, workers=None):
 
     languages_loaded = set()
 
-    # if extract_embs:
     if device is None:
         device = torch.device("cpu")
-    model = ResNetSpeakerEncoder()
-    model = model.to(device)
-
-    metadata = []
 
     # is_single_dataset
 
@@ -614,14 +797,16 @@ def read_datasets (languages, dataset_roots, extract_embs, device, data_mult=1,
                 languages_loaded.add(fname.split("_")[0])
     # print(f'all_datasets, {len(all_datasets)}')
 
-    # Go through each dataset's metadata.csv file, and read in the lines. Optionally extract embeddings for the wav files
+    # Go through each dataset's metadata.csv file, and read in the lines. Files with no (or a stale) embedding in the
+    # dataset's embeddings manifest are queued up for extraction
+    datasets_items = [] # Per dataset: [[text, wav_path, speaker_name, language], ...]
+    manifests = []
+    to_extract = [] # [[dataset index, wav file name, [size, mtime]], ...]
     for di,dataset_path in enumerate(all_datasets):
 
         speaker_name = dataset_path.split("/")[-1]
         language = speaker_name.split("_")[0]
 
-        embs_folder_exists = os.path.exists(f'{dataset_path}/se_embs')
-
         with open(f'{dataset_path}/metadata.csv', encoding="utf8") as f:
             lines = f.read().split("\n")[:-2]
 
@@ -629,17 +814,26 @@ def read_datasets (languages, dataset_roots, extract_embs, device, data_mult=1,
             print_line = f'Reading datasets | Dataset {di+1}/{len(all_datasets)} | Items {len(lines)}     '
             trainer.training_log_live_line = print_line
             trainer.print_and_log(save_to_file=trainer.dataset_output)
+        elif cmd_training:
+            print_line = f'Reading datasets | Dataset {di+1}/{len(all_datasets)} | Items {len(lines)}     '
+            print(f'\r{print_line}', end="", flush=True)
+
+        wavs_folder = f'{dataset_path}/{"wavs_postprocessed" if is_ft else "wavs"}'
+        old_manifest = load_emb_manifest(dataset_path)
+        if old_manifest is None:
+            # No manifest yet (eg datasets with embeddings extracted before the manifest existed). Trust any existing .npy files once
+            old_manifest = {}
+            existing_embs = set(os.listdir(f'{dataset_path}/se_embs')) if os.path.exists(f'{dataset_path}/se_embs') else set()
+        else:
+            existing_embs = set()
+        manifest = {}
 
-        for li,line in enumerate(lines):
+        items = []
+        for line in lines:
 
             if not len(line) or "|" not in line:
                 continue
 
-            if cmd_training and li%(10 if extract_embs else 1000)==0:
-                print_line = f'Reading datasets | Dataset {di+1}/{len(all_datasets)} | Item {li+1}/{len(lines)}     '
-                print(f'\r{print_line}', end="", flush=True)
-
-
             try:
                 text = line.split("|")[1]
             except:
@@ -648,29 +842,59 @@ def read_datasets (languages, dataset_roots, extract_embs, device, data_mult=1,
             wav_file = line.split("|")[0]
             if not wav_file.endswith(".wav"):
                 wav_file = wav_file + ".wav"
-            wav_path = f'{dataset_path}/{"wavs_postprocessed" if is_ft else "wavs"}/{wav_file}'
-
-            if os.path.exists(wav_path):
-
-                emb_path = wav_path.replace("/wavs_postprocessed/" if is_ft else "/wavs/", "/se_embs/").replace(".wav", ".npy")
-
-                if os.path.exists(emb_path):
-                    metadata.append([text, wav_path, speaker_name, language])
-                else:
-                    if extract_embs or not embs_folder_exists:
-                        os.makedirs(f'{dataset_path}/se_embs/', exist_ok=True)
-                        try:
-                            embedding = model.compute_embedding(wav_path)
-                            embedding = embedding.squeeze().cpu().detach().numpy()
-                            np.save(emb_path, embedding)
-                            metadata.append([text, wav_path, speaker_name, language])
-                        except KeyboardInterrupt:
-                            raise
-                        except:
-                            print(f'BAD: {wav_path}')
-
-    # if extract_embs:
-    del model
+            wav_path = f'{wavs_folder}/{wav_file}'
+
+            try:
+                stat = os.stat(wav_path)
+            except OSError:
+                continue
+            wav_stat = [stat.st_size, stat.st_mtime]
+
+            if old_manifest.get(wav_file)==wav_stat or (wav_file not in old_manifest.keys() and wav_file.replace(".wav", ".npy") in existing_embs):
+                manifest[wav_file] = wav_stat
+            elif extract_embs:
+                to_extract.append([di, wav_file, wav_stat])
+            else:
+                continue
+            items.append([text, wav_path, speaker_name, language])
+
+        datasets_items.append(items)
+        manifests.append(manifest)
+
+
+    # Batched extraction of the missing embeddings, over all the datasets at once
+    failed = set()
+    if len(to_extract):
+        model = ResNetSpeakerEncoder()
+        model = model.to(device) # Left in train mode, as the existing se_embs were extracted (see compute_embedding_batch)
+
+        def progress_fn (done, total):
+            print_line = f'Extracting speaker embeddings | Item {done}/{total}     '
+            if not cmd_training and trainer:
+                trainer.training_log_live_line = print_line
+                trainer.print_and_log(save_to_file=trainer.dataset_output)
+            else:
+                print(f'\r{print_line}', end="", flush=True)
+
+        wav_paths = [f'{all_datasets[di]}/{"wavs_postprocessed" if is_ft else "wavs"}/{wav_file}' for di, wav_file, _ in to_extract]
+        failed = extract_embeddings(model, wav_paths, workers=workers, progress_fn=progress_fn)
+        del model
+
+        for (di, wav_file, wav_stat), wav_path in zip(to_extract, wav_paths):
+            if wav_path not in failed:
+                manifests[di][wav_file] = wav_stat
+
+    # Saving only the entries of the files currently in the metadata.csv also drops those of removed files
+    for di, (dataset_path, manifest) in enumerate(zip(all_datasets, manifests)):
+        save_emb_manifest(dataset_path, manifest)
+        if not cmd_training and trainer:
+            trainer.training_log_live_line = f'Consolidating speaker embeddings | Dataset {di+1}/{len(all_datasets)}     '
+            trainer.print_and_log(save_to_file=trainer.dataset_output)
+        update_emb_matrix(dataset_path)
+
+    metadata = []
+    for items in datasets_items:
+        metadata += [item for item in items if item[1] not in failed]
 
     if not cmd_training and trainer:
         trainer.training_log_live_line = ""
@@ -679,8 +903,6 @@ def read_datasets (languages, dataset_roots, extract_embs, device, data_mult=1,
     for _ in range(data_mult):
         all_metadata += metadata
 
-    with open(f'{dataset_roots[0]}/.has_extracted_embs', "w+") as f: # TODO, detect dataset changes, to invalidate this? md5?
-        f.write("")
     return all_metadata, len(all_datasets), data_mult, sorted(languages_loaded)
 
 
@@ -718,4 +940,80 @@ def pre_cache_g2p (dataset_roots, lang=None):
 
                 if "|" in line:
                     text = line.split("|")[1]
-                    text, _ = tp[lang].text_to_sequence(text)
\ No newline at end of file
+                    text, _ = tp[lang].text_to_sequence(text)
+
+    # Compact the new g2p cache entries into the cache files
+    for lang_code in languages:
+        tp[lang_code].save_g2p_cache()
+
+def make_collate_test_dataset (seed=1234):
+    # A bare TTSDataset with just what the collate functions use, and a synthetic sample maker, shaped like real training
+    # samples (80 mels, 513 linear bins, hop 256, ~1-10s clips)
+    import argparse
+    rng = np.random.RandomState(seed)
+
+    dataset = TTSDataset.__new__(TTSDataset)
+    dataset.args = argparse.Namespace(pitch=0)
+    dataset.outputs_per_step = 1
+    dataset.language_id_mapping = {name: i for i, name in enumerate(sorted(list(lang_names.keys())))}
+    dataset.ap = argparse.Namespace(hop_length=256)
+    dataset.sample_cache = SampleCache(0)
+    dataset.collate_buffers = None
+
+    def make_sample ():
+        num_frames = rng.randint(86, 860)
+        return {
+            "text": rng.randint(1, 100, size=rng.randint(15, 200)),
+            "wav": rng.uniform(-1, 1, size=num_frames*256-rng.randint(0, 256)).astype(np.float32),
+            "mel": rng.randn(80, num_frames).astype(np.float32),
+            "pitch": [0],
+            "energy": [0],
+            "linear": rng.randn(513, num_frames).astype(np.float32),
+            "d_vectors": rng.randn(512).astype(np.float32),
+            "item_idx": f'wavs/file_{rng.randint(0, 100000)}.wav',
+            "language_name": sorted(list(lang_names.keys()))[rng.randint(0, len(lang_names))],
+            "dataset_name": "en_dataset",
+            "wav_file_name": "file.wav",
+        }
+    return dataset, make_sample
+
+def check_collate (num_batches=12, seed=1234):
+    """Deterministic check of collate_fn against collate_fn_legacy, over batches of varying sizes. Each batch's
+    tensors are compared again after later batches were collated, as the (pinned) buffers get re-used"""
+    dataset, make_sample = make_collate_test_dataset(seed)
+    batch_sizes = [1, 2, 7, 16, 32] + [16]*(num_batches-5)
+    batches = [[make_sample() for _ in range(batch_size)] for batch_size in batch_sizes]
+    keys = ["text", "text_lengths", "linear", "mel_lengths", "mel_mask", "d_vectors", "waveform", "language_ids"]
+
+    outputs = []
+    for batch in batches:
+        new = dataset.collate_fn(batch)
+        legacy = dataset.collate_fn_legacy(batch)
+        for key in keys:
+            assert new[key].shape==legacy[key].shape, key
+            assert torch.equal(legacy[key].to(new[key].dtype), new[key]), key
+        assert new["wav_files_names"]==legacy["wav_files_names"]
+        outputs.append([{key: new[key] for key in keys}, {key: legacy[key] for key in keys}])
+
+        # The batches still in flight (see CollateBuffers) are untouched by the later collations
+        for new_old, legacy_old in outputs[-(dataset.get_collate_buffers().num_slots):]:
+            for key in keys:
+                assert torch.equal(legacy_old[key].to(new_old[key].dtype), new_old[key]), key
+    print("collate_fn matches collate_fn_legacy")
+
+def benchmark_collate (batch_size=32, num_batches=50, seed=1234):
+    # Micro-benchmark of TTSDataset.collate_fn against the original numpy-padding based collate_fn_legacy
+    dataset, make_sample = make_collate_test_dataset(seed)
+    batches = [[make_sample() for _ in range(batch_size)] for _ in range(num_batches)]
+
+    for name, collate in [["collate_fn_legacy", dataset.collate_fn_legacy], ["collate_fn", dataset.collate_fn]]:
+        start = time.time()
+        for batch in batches:
+            collate(batch)
+        elapsed = time.time() - start
+        print(f'{name}: {round(num_batches/elapsed, 2)} batches/s ({round(elapsed/num_batches*1000, 2)} ms/batch)')
+
+
+if __name__ == '__main__':
+    check_collate()
+    benchmark_collate()
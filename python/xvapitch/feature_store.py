@@ -0,0 +1,261 @@
+import os
+import json
+import hashlib
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+# Pre-computed training features (trimmed wav, mel, linear), extracted once and read back memory-mapped by the
+# TTSDataset, instead of re-loading, re-trimming and re-running the STFTs for every sample of every epoch.
+#
+# One store per dataset folder:   <dataset>/.feature_store/<params signature>/
+#   index.json                    {"wavs/file.wav": [size, mtime, md5, mel frames], ...}
+#   <md5>.wav.npy, <md5>.mel.npy, <md5>.linear.npy
+#
+# Features are keyed by the audio content hash, and the folder by a signature of the AudioProcessor parameters, so
+# changing the STFT/trim settings or editing a file simply misses the store, and the dataset falls back to computing
+# the features on the fly.
+
+FEATURE_KINDS = ["wav", "mel", "linear"]
+
+
+def get_params_signature (ap):
+    params = [ap.sample_rate, ap.fft_size, ap.win_length, ap.hop_length, ap.num_mels, ap.mel_fmin, ap.mel_fmax,
+              ap.stft_pad_mode, ap.do_trim_silence, ap.trim_db, ap.ref_level_db, ap.min_level_db, ap.log_func,
+              ap.spec_gain, ap.signal_norm, ap.symmetric_norm, ap.max_norm, ap.clip_norm, ap.do_sound_norm,
+              ap.do_rms_norm, ap.db_level, ap.resample, ap.preemphasis]
+    return hashlib.md5(json.dumps(params).encode("utf8")).hexdigest()[:12]
+
+def get_dataset_dir (wav_file):
+    return "/".join(wav_file.replace("\\", "/").split("/")[:-2])
+
+def get_index_key (wav_file):
+    return "/".join(wav_file.replace("\\", "/").split("/")[-2:])
+
+def file_md5 (fpath):
+    md5 = hashlib.md5()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def save_npy_atomic (fpath, data):
+    with open(f'{fpath}.tmp', "wb") as f:
+        np.save(f, data)
+    os.replace(f'{fpath}.tmp', fpath)
+
+
+_worker_ap = None
+def _init_extract_worker (ap):
+    global _worker_ap
+    _worker_ap = ap
+
+def extract_features_task (data):
+    [wav_file, store_dir] = data
+    try:
+        stat = os.stat(wav_file)
+        md5 = file_md5(wav_file)
+
+        if all([os.path.exists(f'{store_dir}/{md5}.{kind}.npy') for kind in FEATURE_KINDS]):
+            num_frames = np.load(f'{store_dir}/{md5}.mel.npy', mmap_mode="r").shape[1]
+            return [wav_file, stat.st_size, stat.st_mtime, md5, num_frames, None]
+
+        wav = _worker_ap.load_wav(wav_file)
+        if wav is None:
+            # Un-trimmable file. Record it without features, so the dataset falls back to its own bad-file handling
+            return [wav_file, stat.st_size, stat.st_mtime, None, None, None]
+        wav = np.asarray(wav, dtype=np.float32)
+        mel = _worker_ap.melspectrogram(wav).astype("float32")
+        linear = _worker_ap.spectrogram(wav).astype("float32")
+
+        save_npy_atomic(f'{store_dir}/{md5}.wav.npy', wav)
+        save_npy_atomic(f'{store_dir}/{md5}.mel.npy', mel)
+        save_npy_atomic(f'{store_dir}/{md5}.linear.npy', linear)
+        return [wav_file, stat.st_size, stat.st_mtime, md5, mel.shape[1], None]
+    except KeyboardInterrupt:
+        raise
+    except:
+        return [wav_file, None, None, None, None, traceback.format_exc()]
+
+
+class FeatureStore(object):
+    def __init__(self, ap):
+        super(FeatureStore, self).__init__()
+        self.ap = ap
+        self.params_sig = get_params_signature(ap)
+        self.indexes = {} # dataset dir -> {"wavs/file.wav": [size, mtime, md5, mel frames]}
+
+    def get_store_dir (self, dataset_dir):
+        return f'{dataset_dir}/.feature_store/{self.params_sig}'
+
+    def get_index (self, dataset_dir):
+        if dataset_dir not in self.indexes.keys():
+            index = {}
+            index_path = f'{self.get_store_dir(dataset_dir)}/index.json'
+            if os.path.exists(index_path):
+                try:
+                    with open(index_path, encoding="utf8") as f:
+                        index = json.load(f)
+                except:
+                    print(f'Feature store index could not be read, re-extracting: {index_path}')
+            self.indexes[dataset_dir] = index
+        return self.indexes[dataset_dir]
+
+    def save_index (self, dataset_dir):
+        index_path = f'{self.get_store_dir(dataset_dir)}/index.json'
+        with open(f'{index_path}.tmp', "w+", encoding="utf8") as f:
+            json.dump(self.indexes[dataset_dir], f)
+        os.replace(f'{index_path}.tmp', index_path)
+
+    def is_stored (self, wav_file, stat=None):
+        try:
+            entry = self.get_index(get_dataset_dir(wav_file))[get_index_key(wav_file)]
+            stat = os.stat(wav_file) if stat is None else stat
+            return entry[0]==stat.st_size and entry[1]==stat.st_mtime
+        except (KeyError, OSError):
+            return False
+
+    def get_num_frames (self, wav_file):
+        """Returns the stored mel length of the file, or None if the file is not (validly) stored"""
+        try:
+            entry = self.get_index(get_dataset_dir(wav_file))[get_index_key(wav_file)]
+        except KeyError:
+            return None
+        if len(entry)<4 or entry[2] is None or not self.is_stored(wav_file):
+            return None
+        return entry[3]
+
+    def get (self, wav_file):
+        """Returns {"wav", "mel", "linear"} as read-only memory-mapped arrays, or None if the file is not (validly) stored"""
+        dataset_dir = get_dataset_dir(wav_file)
+        try:
+            entry = self.get_index(dataset_dir)[get_index_key(wav_file)]
+        except KeyError:
+            return None
+        md5 = entry[2]
+        if md5 is None or not self.is_stored(wav_file):
+            return None
+
+        store_dir = self.get_store_dir(dataset_dir)
+        try:
+            return {kind: np.load(f'{store_dir}/{md5}.{kind}.npy', mmap_mode="r") for kind in FEATURE_KINDS}
+        except (OSError, ValueError):
+            return None
+
+
+    def extract (self, wav_files, workers=1, trainer=None, cmd_training=True):
+        """One-time feature extraction over the given wav files. Only files not already (validly) in the store are processed"""
+
+        wav_files = sorted(set([wav_file.replace("\\", "/") for wav_file in wav_files]))
+        todo = [wav_file for wav_file in wav_files if os.path.exists(wav_file) and not self.is_stored(wav_file)]
+        if not len(todo):
+            return
+
+        dataset_dirs = sorted(set([get_dataset_dir(wav_file) for wav_file in todo]))
+        for dataset_dir in dataset_dirs:
+            os.makedirs(self.get_store_dir(dataset_dir), exist_ok=True)
+
+        work_items = [[wav_file, self.get_store_dir(get_dataset_dir(wav_file))] for wav_file in todo]
+        workers = max(1, min(workers, len(work_items)))
+
+        errs = []
+        pool = mp.Pool(workers, initializer=_init_extract_worker, initargs=(self.ap,))
+        try:
+            for wi, result in enumerate(pool.imap_unordered(extract_features_task, work_items, chunksize=8)):
+                wav_file, size, mtime, md5, num_frames, err = result
+                if err is not None:
+                    errs.append(f'{wav_file}: {err}')
+                else:
+                    self.get_index(get_dataset_dir(wav_file))[get_index_key(wav_file)] = [size, mtime, md5, num_frames]
+
+                if wi==0 or (wi+1)%100==0 or (wi+1)==len(work_items):
+                    print_line = f'Extracting features | Item {wi+1}/{len(work_items)}     '
+                    if not cmd_training and trainer:
+                        trainer.training_log_live_line = print_line
+                        trainer.print_and_log(save_to_file=trainer.dataset_output)
+                    else:
+                        print(f'\r{print_line}', end="", flush=True)
+
+                # Periodically save the indexes, so that an interrupted extraction can resume where it left off
+                if (wi+1)%2000==0:
+                    for dataset_dir in dataset_dirs:
+                        self.save_index(dataset_dir)
+        finally:
+            pool.close()
+            pool.join()
+
+        for dataset_dir in dataset_dirs:
+            self.save_index(dataset_dir)
+
+        if not cmd_training and trainer:
+            trainer.training_log_live_line = ""
+        else:
+            print("")
+        if len(errs):
+            print(f'Feature extraction failed for {len(errs)} files. First error: {errs[0]}')
+
+
+def check_feature_store (num_files=4, seed=1234):
+    """Deterministic check of the feature store against the on the fly features it replaces (TTSDataset.get_wav() and
+    the AudioProcessor STFTs), on synthetic wav files in a temporary dataset folder. Also checks that an edited file
+    misses the store, and is re-extracted"""
+    import shutil
+    import tempfile
+    from scipy.io.wavfile import write
+    try:
+        from python.xvapitch.audio import AudioProcessor
+    except:
+        from audio import AudioProcessor
+
+    # Same parameters as the TTSDataset's
+    ap = AudioProcessor(fft_size= 1024, win_length= 1024, hop_length= 256, frame_shift_ms= None, frame_length_ms= None, stft_pad_mode= "reflect", sample_rate= 22050, resample= False, preemphasis= 0.0, ref_level_db= 20, do_sound_norm= False, log_func= "np.log", do_trim_silence= True, trim_db= 45, do_rms_norm= False, db_level= None, power= 1.5, griffin_lim_iters= 60, num_mels= 80, mel_fmin= 0.0, mel_fmax= 8000.0, spec_gain= 1, do_amp_to_db_linear= False, do_amp_to_db_mel= True, signal_norm= False, min_level_db= -100, symmetric_norm= True, max_norm= 4.0, clip_norm= True, stats_path= None)
+
+    rng = np.random.RandomState(seed)
+    def make_wav (fpath):
+        # A tone with some noise, and silence to trim on either side
+        num_samples = rng.randint(22050, 22050*3)
+        t = np.arange(num_samples)/22050
+        audio = 0.3*np.sin(2*np.pi*rng.uniform(100, 400)*t) + rng.randn(num_samples)*0.01
+        audio = np.concatenate([np.zeros(rng.randint(1000, 5000)), audio, np.zeros(rng.randint(1000, 5000))])
+        write(fpath, 22050, (audio*32767).astype(np.int16))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dataset_dir = f'{tmp_dir}/en_dataset'
+        os.makedirs(f'{dataset_dir}/wavs')
+        wav_files = [f'{dataset_dir}/wavs/file_{fi}.wav' for fi in range(num_files)]
+        for wav_file in wav_files:
+            make_wav(wav_file)
+
+        def check_matches (store):
+            for wav_file in wav_files:
+                features = store.get(wav_file)
+                assert features is not None, wav_file
+                wav = np.asarray(ap.load_wav(wav_file), dtype=np.float32)
+                expected = {"wav": wav, "mel": ap.melspectrogram(wav).astype("float32"), "linear": ap.spectrogram(wav).astype("float32")}
+                for kind in FEATURE_KINDS:
+                    assert np.array_equal(np.asarray(features[kind]), expected[kind]), f'{wav_file} {kind}'
+                assert store.get_num_frames(wav_file)==expected["mel"].shape[1], wav_file
+
+        store = FeatureStore(ap)
+        assert store.get(wav_files[0]) is None # Nothing extracted yet
+        store.extract(wav_files, workers=2)
+        check_matches(store)
+        check_matches(FeatureStore(ap)) # Read back from the saved index
+
+        # An edited file misses the store (falling back to the on the fly features), until re-extracted
+        os.remove(wav_files[0])
+        make_wav(wav_files[0])
+        os.utime(wav_files[0], (0, 0))
+        store = FeatureStore(ap)
+        assert store.get(wav_files[0]) is None and store.get_num_frames(wav_files[0]) is None
+        store.extract(wav_files, workers=1)
+        check_matches(store)
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Feature store matches the on the fly features")
+
+
+if __name__ == '__main__':
+    check_feature_store()
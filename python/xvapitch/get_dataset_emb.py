@@ -3,6 +3,13 @@ import numpy as np
 import random
 from sklearn.cluster import KMeans
 
+try:
+    from python.xvapitch.speaker_embs import update_emb_matrix
+    from python.xvapitch.priors_ann import PriorsANNIndex, ANN_DIRNAME, read_transcripts
+except:
+    from speaker_embs import update_emb_matrix
+    from priors_ann import PriorsANNIndex, ANN_DIRNAME, read_transcripts
+
 
 def get_emb(dataset_embs_path, main_emb_outpath, other_embs_outpath):
 
@@ -15,14 +22,11 @@ def get_emb(dataset_embs_path, main_emb_outpath, other_embs_outpath):
                 other_centroids.append(np.array([float(v) for v in line.split(",")]))
 
     else:
-        embs = sorted(os.listdir(dataset_embs_path))
-        embs_fnames = [emb for emb in embs if emb.endswith(".npy")]
-
-        embs = []
-        for ei,emb in enumerate(embs_fnames):
-            print(f'\rLoading embeddings {ei+1}/{len(embs_fnames)}  ', end="", flush=True)
-            embs.append(np.load(f'{dataset_embs_path}/{emb}'))
-        print("")
+        print(f'Loading embeddings...')
+        _, embs_matrix = update_emb_matrix(os.path.dirname(dataset_embs_path.rstrip("/")))
+        if embs_matrix is None or not len(embs_matrix):
+            raise Exception(f'No speaker embeddings were found for the dataset, in: {dataset_embs_path}')
+        embs = list(np.asarray(embs_matrix))
 
         try:
             n_clusters = 10
@@ -52,7 +56,7 @@ def get_emb(dataset_embs_path, main_emb_outpath, other_embs_outpath):
 
         except BaseException:
             centroid_emb = random.sample(embs, 1)[0]
-            other_centroids = random.sample(embs, 10)
+            other_centroids = random.sample(embs, min(10, len(embs)))
 
 
         with open(main_emb_outpath, "w+") as f:
@@ -67,9 +71,7 @@ def get_emb(dataset_embs_path, main_emb_outpath, other_embs_outpath):
 
 
 
-import pickle
 def get_similar_priors(target_emb, dataset_roots, output_path, languages):
-    import faiss
 
     cache_samples_path = f'{output_path}/similar_priors_datalist.txt'
     if os.path.exists(cache_samples_path):
@@ -89,63 +91,25 @@ def get_similar_priors(target_emb, dataset_roots, output_path, languages):
 
     languages = [lang for lang in sorted(list(langs_datasets.keys())) if lang in languages]
     for lang in languages:
-        # language_samples = []
-        # print(f'Gathering similar sounding samples to target voice from the multi-lingual priors datasets | Language: {lang}')
-
-        cache_path = f'{output_path}/emb_cache_{lang}.pkl'
-        if os.path.exists(cache_path):
-            print(f'\rLoading cached similar sounding samples to target voice from the multi-lingual priors datasets | Language: {lang}    ', end="", flush=True)
-            with open(cache_path, "rb") as f:
-                data = pickle.load(f)
-                language_data_transcript, language_data_paths, language_data_embs = data
-        else:
-            language_data_transcript = {}
-            language_data_paths = []
-            language_data_embs = []
-
-            for di,dataset in enumerate(langs_datasets[lang]):
-                emb_files = sorted(os.listdir(f'{dataset}/se_embs'))
-                language_data_transcript[dataset.split("/")[-1]] = {}
-
-                with open(f'{dataset}/metadata.csv') as f:
-                    metadata = f.read().split("\n")
-                    for line in metadata:
-                        if "|" in line:
-                            language_data_transcript[dataset.split("/")[-1]][line.split("|")[0]] = line.split("|")[1]
-
-                for ei,emb_file in enumerate(emb_files):
-                    if emb_file.replace(".npy", ".wav") in language_data_transcript[dataset.split("/")[-1]].keys():
-                        emb = np.load(f'{dataset}/se_embs/{emb_file}')
-
-                        if ei==0 or ei%1000 or (ei+1)==len(emb_files):
-                            print(f'\rGathering similar sounding samples to target voice from the multi-lingual priors datasets | Language: {lang} | Dataset {di+1}/{len(langs_datasets[lang])} ({round((ei+1)/len(emb_files)*100)}%)     ', end="", flush=True)
-
-                        language_data_paths.append(f'{dataset}/wavs/{emb_file.replace(".npy", ".wav")}')
-                        language_data_embs.append(emb)
-
-            with open(cache_path, "wb+") as f:
-                pickle.dump([language_data_transcript, language_data_paths, language_data_embs], f)
-
-
-        language_data_embs = np.array(language_data_embs)
-        print(f'\nBuilding faiss index over {language_data_embs.shape[0]} items...')
-        language_data_embs = language_data_embs.astype(np.float32)
-        index = faiss.IndexFlatL2(language_data_embs.shape[1])
-        index.add(language_data_embs)
-
-        target_num_samples = 2000
-
-        query_emb = np.stack([target_emb]).astype(np.float32)
-        D, I = index.search(query_emb, target_num_samples)
 
-        results = I[0, :]
-        # query_index = results[0]
-        results_indexes = results[1:]
+        # Persisted per-language ANN index, only updated for the datasets that changed since the last run
+        def progress_fn (done, total):
+            print(f'\rUpdating the similar priors search index | Language: {lang} | Dataset {done}/{total}     ', end="", flush=True)
+        index = PriorsANNIndex(f'{dataset_roots[0]}/{ANN_DIRNAME}', lang)
+        index.update(langs_datasets[lang], progress_fn=progress_fn)
+        if index.index is None or index.index.ntotal==0:
+            continue
+        print(f'\rGathering similar sounding samples to target voice from the multi-lingual priors datasets | Language: {lang} | {index.index.ntotal} items     ')
 
-        for ri,res_ind in enumerate(results_indexes):
-            dataset = language_data_paths[ri].split("/")[-3]
-            fname = language_data_paths[ri].split("/")[-1]
-            datalist.append(f'{language_data_transcript[dataset][fname]}|{language_data_paths[ri]}|{dataset}|{lang}')
+        target_num_samples = 2000
+        results = index.search(np.stack([target_emb]), target_num_samples)[0]
+
+        language_data_transcript = {}
+        for dataset_path, fname, _ in results[1:]:
+            dataset = dataset_path.split("/")[-1]
+            if dataset not in language_data_transcript.keys():
+                language_data_transcript[dataset] = read_transcripts(dataset_path)
+            datalist.append(f'{language_data_transcript[dataset][fname]}|{dataset_path}/wavs/{fname}|{dataset}|{lang}')
 
     with open(cache_samples_path, "w+", encoding="utf8") as f:
         f.write("\n".join(datalist))
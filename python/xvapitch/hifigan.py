@@ -78,21 +78,29 @@ class ResBlock1(torch.nn.Module):
             ]
         )
 
-    def forward(self, x):
+    def forward(self, x, x_mask=None):
         """
         Args:
             x (Tensor): input tensor.
+            x_mask (Tensor): optional mask of the padding, for batched inference.
         Returns:
             Tensor: output tensor.
         Shapes:
             x: [B, C, T]
+            x_mask: [B, 1, T]
         """
         for c1, c2 in zip(self.convs1, self.convs2):
             xt = F.leaky_relu(x, LRELU_SLOPE)
+            if x_mask is not None:
+                xt = xt * x_mask
             xt = c1(xt)
             xt = F.leaky_relu(xt, LRELU_SLOPE)
+            if x_mask is not None:
+                xt = xt * x_mask
             xt = c2(xt)
             x = xt + x
+        if x_mask is not None:
+            x = x * x_mask
         return x
 
     def remove_weight_norm(self):
@@ -144,11 +152,15 @@ class ResBlock2(torch.nn.Module):
             ]
         )
 
-    def forward(self, x):
+    def forward(self, x, x_mask=None):
         for c in self.convs:
             xt = F.leaky_relu(x, LRELU_SLOPE)
+            if x_mask is not None:
+                xt = xt * x_mask
             xt = c(xt)
             x = xt + x
+        if x_mask is not None:
+            x = x * x_mask
         return x
 
     def remove_weight_norm(self):
@@ -230,31 +242,40 @@ class HifiganGenerator(torch.nn.Module):
         if not conv_post_weight_norm:
             remove_weight_norm(self.conv_post)
 
-    def forward(self, x, g=None):
+    def forward(self, x, g=None, x_mask=None):
         """
         Args:
             x (Tensor): feature input tensor.
             g (Tensor): global conditioning input tensor.
+            x_mask (Tensor): optional mask of the padding, for batched inference. Every layer's output gets masked (and
+                the mask upsampled along with it), so each sequence's convolutions see zeros past its end, the same as
+                they would in a batch of one.
 
         Returns:
             Tensor: output waveform.
 
         Shapes:
             x: [B, C, T]
+            x_mask: [B, 1, T]
             Tensor: [B, 1, T]
         """
         o = self.conv_pre(x)
         if hasattr(self, "cond_layer") and g is not None:
             o = o + self.cond_layer(g)
+        if x_mask is not None:
+            o = o * x_mask
         for i in range(self.num_upsamples):
             o = F.leaky_relu(o, LRELU_SLOPE)
             o = self.ups[i](o)
+            if x_mask is not None:
+                x_mask = x_mask.repeat_interleave(o.shape[2] // x_mask.shape[2], dim=2)
+                o = o * x_mask
             z_sum = None
             for j in range(self.num_kernels):
                 if z_sum is None:
-                    z_sum = self.resblocks[i * self.num_kernels + j](o)
+                    z_sum = self.resblocks[i * self.num_kernels + j](o, x_mask=x_mask)
                 else:
-                    z_sum += self.resblocks[i * self.num_kernels + j](o)
+                    z_sum += self.resblocks[i * self.num_kernels + j](o, x_mask=x_mask)
             o = z_sum / self.num_kernels
         o = F.leaky_relu(o)
         o = self.conv_post(o)
@@ -598,6 +598,100 @@ class xVAPitch(nn.Module):
         # o = self.waveform_decoder((z * y_mask)[:, :, : self.max_inference_len], g=conditioning)
         return o
 
+
+    # The text encoder and duration predictor stage of infer_batch(). Its y_lengths are the utterances' predicted mel
+    # frame counts, which the vocoder's cost scales with, for batching utterances of similar lengths together
+    def infer_batch_durations (self, input_symbols, x_lengths, language_ids, embeddings, pacing=1):
+
+        aux_input = {
+            "d_vectors": embeddings,
+            "language_ids": language_ids,
+        }
+        sid, g, lid = self._set_cond_input(aux_input) # g: [B, 512, 1]
+
+        lang_emb = self.emb_l(lid).unsqueeze(-1) # [B, lang_dim, 1]
+        lang_emb = lang_emb * self.args.lang_w
+
+        x, x_emb, x_mask = self.text_encoder(input_symbols, x_lengths, lang_emb=lang_emb, stats=False)
+        m_p, logs_p = self.text_encoder(x, x_lengths, lang_emb=lang_emb, stats=True, x_mask=x_mask)
+
+        logw = self.duration_predictor(x, x_mask, g=g, reverse=True, noise_scale=self.inference_noise_scale_dp, lang_emb=lang_emb)
+
+        pacing = torch.as_tensor(pacing, dtype=logw.dtype, device=logw.device).view(-1, 1, 1)
+        w = torch.exp(logw) * x_mask * self.length_scale
+        w = w * pacing
+        w_ceil = torch.ceil(w)
+
+        y_lengths = torch.clamp_min(torch.sum(w_ceil, [1, 2]), 1).long()
+        return g, lang_emb, x, x_mask, m_p, logs_p, w_ceil, y_lengths
+
+    # Batched version of infer(), for many utterances at once, each with their own language, speaker embedding, and pacing
+    #   input_symbols: [B, T] symbol ids, padded (eg TextPreprocessor.texts_to_padded_sequences)
+    #   x_lengths: [B]
+    #   language_ids: [B]
+    #   embeddings: [B, 512]
+    #   pacing: a number, or [B]
+    # Every stage, vocoder included, is masked by the per-utterance lengths, so the padding doesn't leak into the shorter
+    # utterances. Returns a list of the [1, 1, T_wav] waveforms, trimmed to their own lengths. The SDP noise is still random
+    # per utterance, so outputs only match infer()'s exactly with inference_noise_scale_dp=0.
+    # (No per-symbol lang_emb_full language mixing here; use infer() for that)
+    def infer_batch (self, input_symbols, x_lengths, language_ids, embeddings, pacing=1):
+
+        g, lang_emb, x, x_mask, m_p, logs_p, w_ceil, y_lengths = self.infer_batch_durations(input_symbols, x_lengths, language_ids, embeddings, pacing=pacing)
+        y_mask = torch.unsqueeze(sequence_mask(y_lengths, None), 1).to(x_mask.dtype) # [B, 1, T_y]
+
+        attn_mask = torch.unsqueeze(x_mask, 2) * torch.unsqueeze(y_mask, -1)
+        attn = generate_path(w_ceil.squeeze(1), attn_mask.squeeze(1).transpose(1, 2)) # [B, T_x, T_y]
+
+        m_p = torch.matmul(attn.transpose(1, 2), m_p.transpose(1, 2)).transpose(1, 2)
+        logs_p = torch.matmul(attn.transpose(1, 2), logs_p.transpose(1, 2)).transpose(1, 2)
+
+        # The per-symbol pitch/energy get expanded through the same alignment path, rather than expand_pitch_energy()'s per-frame loop
+        if self.args.ow_flow:
+            pitch_pred = self.pitch_predictor(x.permute(0, 2, 1), x_lengths, speaker_emb=g, stats=False)
+            pitch_pred = torch.matmul(pitch_pred, attn)
+
+            energy_pred = self.energy_predictor(x.permute(0, 2, 1), x_lengths, speaker_emb=g, stats=False)
+            energy_pred = torch.matmul(energy_pred, attn)
+            energy_pred = torch.log(1.0 + energy_pred)
+            energy_pred = energy_pred / 10
+
+            m_p[:,0,:] = pitch_pred.squeeze(dim=1)
+            m_p[:,1,:] = energy_pred.squeeze(dim=1)
+
+        else:
+            if self.args.pitch:
+                pitch_scaling = self.args.pe_scaling
+                pitch_pred = self.pitch_predictor(x.permute(0, 2, 1), x_lengths, speaker_emb=g, stats=False)
+                pitch_pred = torch.matmul(pitch_pred, attn)
+                pitch_pred = self.pitch_emb(pitch_pred)
+
+                if not self.args.expanded_flow:
+                    m_p += pitch_pred * pitch_scaling
+
+            if self.args.energy and not self.args.energy_sp:
+                energy_scaling = self.args.pe_scaling
+                energy_pred = self.energy_predictor(x.permute(0, 2, 1), x_lengths, speaker_emb=g, stats=False)
+                energy_pred = torch.matmul(energy_pred, attn)
+                energy_pred = self.energy_emb(energy_pred)
+
+                if not self.args.expanded_flow:
+                    m_p -= energy_pred * energy_scaling
+
+        self.inference_noise_scale = 0
+        z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * self.inference_noise_scale
+
+        conditioning = torch.cat([g, lang_emb], dim=1) if self.args.flc else g
+
+        z = self.flow(z_p, y_mask, g=conditioning, reverse=True)
+        z_masked = (z*y_mask)[:, :, : self.max_inference_len]
+
+        o = self.waveform_decoder(z_masked, g=g, x_mask=y_mask[:, :, : self.max_inference_len])
+
+        hop_length = o.shape[2] // z_masked.shape[2]
+        wav_lengths = torch.clamp_max(y_lengths, z_masked.shape[2]) * hop_length
+        return [o[b:b+1, :, :int(wav_lengths[b])] for b in range(o.shape[0])]
+
     # def voice_conversion(self, y, y_lengths=None, speaker_cond_src=None, speaker_cond_tgt=None, spk1_emb=None, spk2_emb=None):
     def voice_conversion(self, y, y_lengths=None, spk1_emb=None, spk2_emb=None):
 
@@ -1691,3 +1785,59 @@ class ConvReLUNorm(torch.nn.Module):
         out = F.relu(self.conv(signal))
         out = self.norm(out.transpose(1, 2)).transpose(1, 2).to(signal.dtype)
         return self.dropout(out)
+
+
+def check_infer_batch (num_utterances=12, max_symbols=120, batch_size=4, seed=1234):
+    """infer_batch() against one infer() call per utterance, on a randomly initialised model (with the SDP noise off, so
+    the durations are deterministic): same lengths, same audio, and the time taken. Batched both as one padded batch,
+    and as xVAPitchModel.infer_batch() does off CPU, in batches of utterances sorted by their predicted frames"""
+    import argparse
+    torch.manual_seed(seed)
+    rng = np.random.RandomState(seed)
+
+    # The params xVAPitchModel uses
+    args = argparse.Namespace(pitch=1, pe_scaling=0.1, expanded_flow=0, expanded_flow_dim=32, ow_flow=0, energy=0, energy_sp=0, mltts_rc=0, lang_w=1, big=1, flc=0, hifi_only=0)
+    model = xVAPitch(args).eval()
+    model.inference_noise_scale_dp = 0
+
+    lengths = [int(rng.randint(3, max_symbols)) for _ in range(num_utterances)]
+    sequences = [torch.tensor(rng.randint(0, len(ALL_SYMBOLS)-2, length)) for length in lengths]
+    language_ids = torch.tensor(rng.randint(0, len(list(lang_names.keys())), num_utterances))
+    embeddings = torch.randn(num_utterances, 512)
+    pacings = torch.tensor(rng.uniform(0.6, 1.6, num_utterances)).float()
+
+    def run_batch (indexes):
+        padded = torch.zeros((len(indexes), max([lengths[i] for i in indexes])), dtype=torch.long)
+        for bi, i in enumerate(indexes):
+            padded[bi, :lengths[i]] = sequences[i]
+        indexes = torch.tensor(indexes)
+        return padded, torch.tensor(lengths)[indexes], language_ids[indexes], embeddings[indexes], pacings[indexes]
+
+    with torch.no_grad():
+        start = time.time()
+        singles = [model.infer(sequence.unsqueeze(0), language_ids[i], embeddings[i], pacing=float(pacings[i])) for i, sequence in enumerate(sequences)]
+        single_time = time.time()-start
+
+        start = time.time()
+        batched = model.infer_batch(*run_batch(list(range(num_utterances))))
+        batch_time = time.time()-start
+
+        start = time.time()
+        frames = model.infer_batch_durations(*run_batch(list(range(num_utterances))))[-1].tolist()
+        by_frames = [None for _ in range(num_utterances)]
+        order = sorted(range(num_utterances), key=lambda i: -frames[i])
+        for b in range(0, num_utterances, batch_size):
+            for i, wav in zip(order[b:b+batch_size], model.infer_batch(*run_batch(order[b:b+batch_size]))):
+                by_frames[i] = wav
+        frames_time = time.time()-start
+
+    max_diff = 0
+    for single, wav, wav_frames in zip(singles, batched, by_frames):
+        assert single.shape==wav.shape==wav_frames.shape, f'{single.shape} vs {wav.shape} vs {wav_frames.shape}'
+        max_diff = max(max_diff, float((single-wav).abs().max()), float((single-wav_frames).abs().max()))
+    assert max_diff < 1e-4, max_diff
+    print(f'{num_utterances} utterances, same lengths | max diff: {max_diff:.2e} | one by one: {single_time:.2f}s | one batch: {batch_time:.2f}s | batches of {batch_size} by frames: {frames_time:.2f}s')
+
+
+if __name__ == '__main__':
+    check_infer_batch()
@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+
+import numpy as np
+
+try:
+    from python.xvapitch.speaker_embs import update_emb_matrix, MATRIX_FNAME, MANIFEST_FNAME
+except:
+    from speaker_embs import update_emb_matrix, MATRIX_FNAME, MANIFEST_FNAME
+
+# Persisted approximate nearest neighbour index over the priors datasets' speaker embeddings, one per language, for
+# get_similar_priors(). Saved next to the priors data:
+#   <priors root>/.priors_ann/<lang>.index      faiss index. IVF (flat, for small languages), with ids
+#   <priors root>/.priors_ann/<lang>.json       manifest: {"datasets": {dataset path: {"stamp", "id_start", "files"}}, ...}
+#
+# Each dataset owns a contiguous range of ids in the index. A dataset's "stamp" is the size/mtime of its consolidated
+# embeddings matrix index, its embeddings manifest (which changes when embeddings get (re-)extracted, even before the
+# matrix is updated) and its metadata.csv file. When that changes, only that dataset's id range is removed and
+# re-added. Datasets with no embeddings are recorded too (with no ids), so they aren't re-read every run. Datasets added/removed are likewise added/removed. The IVF coarse quantizer is re-trained when the index has
+# grown well past what it was trained over.
+
+ANN_DIRNAME = ".priors_ann"
+IVF_MIN_ITEMS = 20000 # Below this, a flat (exact) index is fast enough
+RETRAIN_GROWTH = 4 # Re-train the IVF centroids once the index grows to this many times the size it was trained over
+DEFAULT_NPROBE = 16
+PROBE_OVERSAMPLING = 6 # Probe enough IVF lists to hold this many times k items, since top-k for large k spans many lists
+
+
+def get_dataset_stamp (dataset_path):
+    stamp = []
+    for fpath in [f'{dataset_path}/{MATRIX_FNAME}.json', f'{dataset_path}/{MANIFEST_FNAME}', f'{dataset_path}/metadata.csv']:
+        try:
+            stat = os.stat(fpath)
+            stamp.append([stat.st_size, stat.st_mtime])
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+def read_transcripts (dataset_path):
+    transcripts = {}
+    with open(f'{dataset_path}/metadata.csv') as f:
+        for line in f.read().split("\n"):
+            if "|" in line:
+                transcripts[line.split("|")[0]] = line.split("|")[1]
+    return transcripts
+
+def get_dataset_embs (dataset_path):
+    """The dataset's wav file names and embeddings, for the files present in its metadata.csv"""
+    emb_files, embs_matrix = update_emb_matrix(dataset_path)
+    if emb_files is None:
+        return [], None
+    transcripts = read_transcripts(dataset_path)
+    rows = [ei for ei,emb_file in enumerate(emb_files) if emb_file.replace(".npy", ".wav") in transcripts.keys()]
+    return [emb_files[ei].replace(".npy", ".wav") for ei in rows], np.asarray(embs_matrix[rows], dtype=np.float32)
+
+
+class PriorsANNIndex(object):
+    def __init__(self, index_dir, lang, nprobe=DEFAULT_NPROBE):
+        super(PriorsANNIndex, self).__init__()
+        self.index_dir = index_dir
+        self.lang = lang
+        self.nprobe = nprobe
+        self.index = None
+        self.manifest = None
+        self.id_starts = None # Sorted [[id_start, dataset path], ...], for mapping search results back
+
+    def get_paths (self):
+        return f'{self.index_dir}/{self.lang}.index', f'{self.index_dir}/{self.lang}.json'
+
+    def load (self):
+        import faiss
+        index_path, manifest_path = self.get_paths()
+        self.index = None
+        self.manifest = {"datasets": {}, "next_id": 0, "trained_on": 0}
+        if os.path.exists(index_path) and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, encoding="utf8") as f:
+                    self.manifest = json.load(f)
+                self.index = faiss.read_index(index_path)
+            except:
+                print(f'Priors ANN index could not be read, rebuilding: {index_path}')
+                self.index = None
+                self.manifest = {"datasets": {}, "next_id": 0, "trained_on": 0}
+        self.build_id_starts()
+
+    def save (self):
+        import faiss
+        os.makedirs(self.index_dir, exist_ok=True)
+        index_path, manifest_path = self.get_paths()
+        faiss.write_index(self.index, f'{index_path}.tmp')
+        os.replace(f'{index_path}.tmp', index_path)
+        with open(f'{manifest_path}.tmp', "w+", encoding="utf8") as f:
+            json.dump(self.manifest, f)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+    def build_id_starts (self):
+        # Datasets with no embeddings own no ids (and would share their id_start with the next dataset)
+        self.id_starts = sorted([[info["id_start"], dataset_path] for dataset_path, info in self.manifest["datasets"].items() if len(info["files"])])
+
+
+    def create_index (self, train_embs, num_items):
+        import faiss
+        dim = train_embs.shape[1]
+        if num_items < IVF_MIN_ITEMS:
+            index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        else:
+            nlist = int(min(np.sqrt(num_items), len(train_embs)/39))
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_L2)
+            index.train(train_embs)
+        return index
+
+    def rebuild (self, datasets, progress_fn=None):
+        all_files = {}
+        all_embs = []
+        for di,dataset_path in enumerate(datasets):
+            if progress_fn is not None:
+                progress_fn(di+1, len(datasets))
+            files, embs = get_dataset_embs(dataset_path)
+            all_files[dataset_path] = files
+            all_embs.append(embs)
+        if not sum([len(files) for files in all_files.values()]):
+            self.index = None
+            return
+
+        embs = np.concatenate([dataset_embs for dataset_embs in all_embs if dataset_embs is not None and len(dataset_embs)], axis=0)
+        train_embs = embs[np.random.RandomState(0).permutation(len(embs))[:256*int(np.sqrt(len(embs)))]]
+        self.index = self.create_index(train_embs, len(embs))
+        self.manifest = {"datasets": {}, "next_id": 0, "trained_on": len(embs)}
+        for dataset_path, dataset_embs in zip(all_files.keys(), all_embs):
+            self.add_dataset(dataset_path, all_files[dataset_path], dataset_embs)
+
+    def add_dataset (self, dataset_path, files, embs):
+        id_start = self.manifest["next_id"]
+        if len(files):
+            self.index.add_with_ids(embs, np.arange(id_start, id_start+len(files)).astype(np.int64))
+        self.manifest["datasets"][dataset_path] = {"stamp": get_dataset_stamp(dataset_path), "id_start": id_start, "files": files}
+        self.manifest["next_id"] = id_start + len(files)
+
+    def remove_dataset (self, dataset_path):
+        import faiss
+        info = self.manifest["datasets"].pop(dataset_path)
+        self.index.remove_ids(faiss.IDSelectorRange(info["id_start"], info["id_start"]+len(info["files"])))
+
+
+    def update (self, datasets, progress_fn=None):
+        """Brings the index up to date with the given dataset folders. Returns True if anything changed"""
+        if self.manifest is None:
+            self.load()
+
+        if self.index is None:
+            self.rebuild(datasets, progress_fn)
+        else:
+            current = set(datasets)
+            removed = [dataset_path for dataset_path in self.manifest["datasets"].keys() if dataset_path not in current]
+            changed = [dataset_path for dataset_path in datasets if dataset_path not in self.manifest["datasets"].keys() or \
+                       self.manifest["datasets"][dataset_path]["stamp"]!=get_dataset_stamp(dataset_path)]
+            if not len(removed) and not len(changed):
+                return False
+
+            for dataset_path in removed:
+                self.remove_dataset(dataset_path)
+            for di,dataset_path in enumerate(changed):
+                if progress_fn is not None:
+                    progress_fn(di+1, len(changed))
+                if dataset_path in self.manifest["datasets"].keys():
+                    self.remove_dataset(dataset_path)
+                files, embs = get_dataset_embs(dataset_path)
+                self.add_dataset(dataset_path, files, embs)
+
+            # The index has outgrown its (IVF) clustering, or is now big enough to need one
+            is_flat = not hasattr(self.index, "nlist")
+            if (is_flat and self.index.ntotal >= IVF_MIN_ITEMS) or (not is_flat and self.index.ntotal > RETRAIN_GROWTH*self.manifest["trained_on"]):
+                self.rebuild(datasets, progress_fn)
+
+        if self.index is not None:
+            self.save()
+        self.build_id_starts()
+        return True
+
+
+    def search (self, query_embs, k):
+        """Returns, per query, a list of [dataset path, wav file name, distance], closest first"""
+        if hasattr(self.index, "nprobe"):
+            avg_list_size = max(1, self.index.ntotal/self.index.nlist)
+            self.index.nprobe = int(min(self.index.nlist, max(self.nprobe, np.ceil(PROBE_OVERSAMPLING*k/avg_list_size))))
+        D, I = self.index.search(np.asarray(query_embs, dtype=np.float32).reshape(-1, self.index.d), k)
+        id_starts = np.array([id_start for id_start, _ in self.id_starts])
+        datasets_I = np.searchsorted(id_starts, I, side="right")-1
+
+        results = []
+        for qi in range(I.shape[0]):
+            query_results = []
+            for dist, item_id, dataset_i in zip(D[qi].tolist(), I[qi].tolist(), datasets_I[qi].tolist()):
+                if item_id < 0:
+                    continue # Fewer than k items found in the probed lists
+                dataset_path = self.id_starts[dataset_i][1]
+                info = self.manifest["datasets"][dataset_path]
+                query_results.append([dataset_path, info["files"][item_id-info["id_start"]], dist])
+            results.append(query_results)
+        return results
+
+
+
+def benchmark_ann (dataset_roots, languages, k=2000, num_queries=20, nprobes=[1, 16, 64]):
+    """recall@k and query latency of the persisted ANN index, vs an exhaustive faiss.IndexFlatL2 search"""
+    import faiss
+
+    for lang in languages:
+        datasets = []
+        for dataset_root in dataset_roots:
+            datasets += [f'{dataset_root}/{dataset}' for dataset in sorted(os.listdir(dataset_root)) if dataset.startswith(f'{lang}_') and "." not in dataset]
+        if not len(datasets):
+            continue
+
+        start = time.time()
+        ann = PriorsANNIndex(f'{dataset_roots[0]}/{ANN_DIRNAME}', lang)
+        ann.update(datasets)
+        print(f'[{lang}] ANN index ready in {round(time.time()-start, 2)}s | {ann.index.ntotal} items | {type(ann.index).__name__}')
+
+        all_keys = []
+        all_embs = []
+        for dataset_path in datasets:
+            files, embs = get_dataset_embs(dataset_path)
+            all_keys += [f'{dataset_path}/{fname}' for fname in files]
+            if len(files):
+                all_embs.append(embs)
+        all_embs = np.concatenate(all_embs, axis=0)
+
+        start = time.time()
+        flat = faiss.IndexFlatL2(all_embs.shape[1])
+        flat.add(all_embs)
+        print(f'[{lang}] Flat index built in {round(time.time()-start, 2)}s')
+
+        queries = all_embs[np.random.RandomState(0).choice(len(all_embs), min(num_queries, len(all_embs)), replace=False)]
+        k_lang = min(k, len(all_embs))
+
+        # One query at a time, like get_similar_priors(). After a warm-up query each
+        flat.search(queries[:1], k_lang)
+        ann.search(queries[:1], k_lang)
+        start = time.time()
+        flat_I = np.concatenate([flat.search(queries[qi:qi+1], k_lang)[1] for qi in range(len(queries))], axis=0)
+        flat_ms = (time.time()-start)/len(queries)*1000
+        print(f'[{lang}] Flat      | {round(flat_ms, 2)} ms/query')
+
+        # nprobe is a lower bound: search() probes at least enough lists to cover k items
+        for nprobe in (nprobes if hasattr(ann.index, "nprobe") else [None]):
+            ann.nprobe = nprobe
+            start = time.time()
+            ann_results = [ann.search(queries[qi:qi+1], k_lang)[0] for qi in range(len(queries))]
+            ann_ms = (time.time()-start)/len(queries)*1000
+
+            recalls = []
+            for qi in range(len(queries)):
+                flat_keys = set([all_keys[item_id] for item_id in flat_I[qi] if item_id>=0])
+                ann_keys = set([f'{dataset_path}/{fname}' for dataset_path, fname, _ in ann_results[qi]])
+                recalls.append(len(flat_keys & ann_keys)/max(1, len(flat_keys)))
+            print(f'[{lang}] ANN{f" nprobe {ann.index.nprobe}" if nprobe else ""} | {round(ann_ms, 2)} ms/query | recall@{k_lang}: {round(float(np.mean(recalls)), 4)}')
+
+
+if __name__ == '__main__':
+    # python priors_ann.py <priors datasets root> [languages, comma separated]
+    benchmark_ann([sys.argv[1]], sys.argv[2].split(",") if len(sys.argv)>2 else ["en"])
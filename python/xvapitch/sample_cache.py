@@ -0,0 +1,184 @@
+import collections
+
+import numpy as np
+import torch
+
+# Byte-bounded LRU caching of per-sample data in the TTSDataset. Each feature kind gets its own sub-cache and share of
+# the byte budget, so that eg large linear spectrograms can't evict all the (cheap to store, slow to compute) text.
+#
+# DataLoader workers are separate processes, each with their own copy of the dataset, so the budget is split evenly
+# between them (per-worker budgets) the first time a worker touches the cache. Hit/miss stats are therefore also per
+# worker, and get sent back to the trainer along with each batch (see TTSDataset.collate_fn), for aggregation.
+
+# Fraction of the total byte budget given to each feature kind
+CACHE_BUDGET_SPLIT = {
+    "wav": 0.25,
+    "mel": 0.1,
+    "linear": 0.55,
+    "text": 0.05,
+    "speaker_embedding": 0.05,
+}
+
+
+def get_nbytes (value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if torch.is_tensor(value):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (list, tuple)):
+        return sum([get_nbytes(v) for v in value])
+    return 64
+
+
+class LRUCache(object):
+    def __init__(self, max_bytes):
+        super(LRUCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get (self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key][0]
+        self.misses += 1
+        return None
+
+    def put (self, key, value):
+        nbytes = get_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.data:
+            self.total_bytes -= self.data.pop(key)[1]
+        while self.total_bytes+nbytes > self.max_bytes and len(self.data):
+            _, (_, evicted_nbytes) = self.data.popitem(last=False)
+            self.total_bytes -= evicted_nbytes
+            self.evictions += 1
+        self.data[key] = (value, nbytes)
+        self.total_bytes += nbytes
+
+    def get_stats (self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.data),
+            "bytes": self.total_bytes,
+        }
+
+
+class SampleCache(object):
+    def __init__(self, max_bytes=0, kinds=None):
+        # kinds - the feature kinds that actually get cached (default all), sharing the whole budget between them. Eg
+        # with the feature store, the wav/mel/linear features are read from disk, so only text/speaker_embedding are
+        super(SampleCache, self).__init__()
+        self.max_bytes = int(max_bytes)
+        self.kinds = list(CACHE_BUDGET_SPLIT.keys()) if kinds is None else list(kinds)
+        self.enabled = self.max_bytes > 0 and len(self.kinds) > 0
+        self.caches = None
+        self.worker_id = 0
+
+    def init_caches (self):
+        # Done lazily, so it runs inside the DataLoader worker (if any), where the number of workers is known
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = 1
+        if worker_info is not None:
+            num_workers = worker_info.num_workers
+            self.worker_id = worker_info.id
+        worker_budget = self.max_bytes / num_workers
+        total_split = sum([CACHE_BUDGET_SPLIT[kind] for kind in self.kinds])
+        self.caches = {kind: LRUCache(int(worker_budget*CACHE_BUDGET_SPLIT[kind]/total_split)) for kind in self.kinds}
+
+    def get (self, kind, key):
+        if not self.enabled:
+            return None
+        if self.caches is None:
+            self.init_caches()
+        if kind not in self.caches.keys():
+            return None
+        return self.caches[kind].get(key)
+
+    def put (self, kind, key, value):
+        if not self.enabled:
+            return
+        if self.caches is None:
+            self.init_caches()
+        if kind in self.caches.keys():
+            self.caches[kind].put(key, value)
+
+    def get_stats (self):
+        if self.caches is None:
+            return None
+        return {"worker_id": self.worker_id, "kinds": {kind: cache.get_stats() for kind, cache in self.caches.items()}}
+
+
+def merge_cache_stats (workers_stats):
+    # workers_stats - a dict of worker_id -> latest SampleCache.get_stats() output from that worker
+    merged = {}
+    for stats in workers_stats.values():
+        for kind, kind_stats in stats["kinds"].items():
+            if kind not in merged.keys():
+                merged[kind] = {key: 0 for key in kind_stats.keys()}
+            for key, val in kind_stats.items():
+                merged[kind][key] += val
+    return merged
+
+def format_cache_stats (merged):
+    parts = []
+    for kind, stats in merged.items():
+        total = stats["hits"]+stats["misses"]
+        hit_rate = round(stats["hits"]/total*100, 1) if total else 0
+        parts.append(f'{kind}: {hit_rate}% hits, {stats["entries"]} items, {round(stats["bytes"]/1024/1024)}MB')
+    return " | ".join(parts)
+
+
+def check_sample_cache (num_ops=5000, seed=1234):
+    """Deterministic check of the LRU byte accounting, against a plain list based LRU, over random get/puts of
+    differently sized arrays. Also checks the budget split between the cached kinds"""
+    rng = np.random.RandomState(seed)
+    max_bytes = 64*1024
+    cache = LRUCache(max_bytes)
+    reference = [] # [[key, nbytes], ...], least recently used first
+    values = {key: np.zeros(rng.randint(1, 4096), dtype=np.float32) for key in range(64)}
+
+    for _ in range(num_ops):
+        key = int(rng.randint(0, 64))
+        if rng.rand() < 0.5:
+            value = cache.get(key)
+            ref_index = [ri for ri, (ref_key, _) in enumerate(reference) if ref_key==key]
+            assert (value is not None)==bool(len(ref_index)), key
+            if len(ref_index):
+                assert value is values[key]
+                reference.append(reference.pop(ref_index[0]))
+        else:
+            nbytes = values[key].nbytes
+            cache.put(key, values[key])
+            if nbytes <= max_bytes:
+                reference = [[ref_key, ref_nbytes] for ref_key, ref_nbytes in reference if ref_key!=key]
+                while sum([ref_nbytes for _, ref_nbytes in reference])+nbytes > max_bytes:
+                    reference.pop(0)
+                reference.append([key, nbytes])
+
+        assert cache.total_bytes==sum([nbytes for _, nbytes in cache.data.values()])
+        assert cache.total_bytes==sum([nbytes for _, nbytes in reference])
+        assert cache.total_bytes <= max_bytes
+        assert list(cache.data.keys())==[key for key, _ in reference]
+
+    # Items over the budget are never cached
+    cache.put("too_big", np.zeros(max_bytes+1, dtype=np.uint8))
+    assert cache.get("too_big") is None
+
+    # The whole budget goes to the cached kinds, and other kinds are never cached
+    sample_cache = SampleCache(1024*1024, kinds=["text", "speaker_embedding"])
+    sample_cache.put("linear", "file.wav", np.zeros(10))
+    assert sample_cache.get("linear", "file.wav") is None
+    assert sum([cache.max_bytes for cache in sample_cache.caches.values()]) >= 1024*1024-len(sample_cache.caches)
+    print("Sample cache byte accounting matches the reference LRU")
+
+
+if __name__ == '__main__':
+    check_sample_cache()
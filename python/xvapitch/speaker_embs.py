@@ -0,0 +1,214 @@
+import os
+import json
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+try:
+    from python.xvapitch.speaker_representation.main import load_audio
+except:
+    from speaker_representation.main import load_audio
+
+# Speaker embedding (se_embs/*.npy) extraction for the training datasets.
+#
+# Each dataset folder keeps a manifest of the wav files whose embedding has been extracted:
+#   <dataset>/.se_embs_manifest.json     {"file.wav": [size, mtime], ...}
+# A wav file needs (re-)extracting if it's missing from the manifest, or its size/mtime changed. This replaces the
+# old root-level .has_extracted_embs marker file, which could not detect dataset changes.
+#
+# Extraction decodes the audio in a pool of worker processes, while the main process runs the speaker encoder over the
+# decoded utterances (one utterance's crops per forward pass, as the encoder is used in train mode).
+#
+# The extracted se_embs/*.npy files are then consolidated into one contiguous float32 matrix per dataset, read back
+# memory-mapped, instead of loading tens of thousands of small files:
+#   <dataset>/se_embs_matrix.npy         N x emb dim
+#   <dataset>/se_embs_matrix.json        {"files": ["file.npy", ...], "stamps": [manifest [size, mtime] of the wav, ...]}
+# The matrix is updated incrementally: rows of unchanged files are carried over, and only new/changed .npy files are read
+
+MANIFEST_FNAME = ".se_embs_manifest.json"
+MATRIX_FNAME = "se_embs_matrix"
+
+
+def get_emb_path (wav_path):
+    return wav_path.replace("/wavs_postprocessed/", "/se_embs/").replace("/wavs/", "/se_embs/").replace(".wav", ".npy")
+
+
+def load_emb_manifest (dataset_path):
+    manifest_path = f'{dataset_path}/{MANIFEST_FNAME}'
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, encoding="utf8") as f:
+                return json.load(f)
+        except:
+            print(f'Speaker embeddings manifest could not be read, re-checking the dataset: {manifest_path}')
+    return None
+
+def save_emb_manifest (dataset_path, manifest):
+    manifest_path = f'{dataset_path}/{MANIFEST_FNAME}'
+    with open(f'{manifest_path}.tmp', "w+", encoding="utf8") as f:
+        json.dump(manifest, f)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+def load_emb_audio_task (wav_path):
+    try:
+        wav = load_audio(wav_path).astype(np.float32)
+        if not len(wav):
+            return [wav_path, None, "Empty audio"]
+        return [wav_path, wav, None]
+    except KeyboardInterrupt:
+        raise
+    except:
+        return [wav_path, None, traceback.format_exc()]
+
+
+def extract_embeddings (model, wav_paths, workers=None, batch_size=64, progress_fn=None):
+    """Extracts and saves the se_embs .npy files for the given wav files
+
+    model - a ResNetSpeakerEncoder, already on the target device
+    batch_size - the number of decoded utterances collected before running the encoder over them and saving them
+    progress_fn - optional fn(done, total)
+
+    Returns the set of wav paths that failed to extract
+    """
+    failed = set()
+    if not len(wav_paths):
+        return failed
+
+    workers = max(1, int(mp.cpu_count()/2)-5) if workers is None else workers
+    workers = max(1, min(workers, len(wav_paths)))
+
+    for emb_dir in set([os.path.dirname(get_emb_path(wav_path)) for wav_path in wav_paths]):
+        os.makedirs(emb_dir, exist_ok=True)
+
+    batch_paths = []
+    batch_wavs = []
+    num_done = 0
+
+    def flush ():
+        embeddings = model.compute_embedding_batch(batch_wavs).cpu().numpy()
+        for wav_path, embedding in zip(batch_paths, embeddings):
+            np.save(get_emb_path(wav_path), embedding)
+        batch_paths.clear()
+        batch_wavs.clear()
+
+    pool = mp.Pool(workers)
+    try:
+        for wav_path, wav, err in pool.imap(load_emb_audio_task, wav_paths, chunksize=4):
+            num_done += 1
+            if err is not None:
+                print(f'BAD: {wav_path}')
+                failed.add(wav_path)
+            else:
+                batch_paths.append(wav_path)
+                batch_wavs.append(wav)
+                if len(batch_paths)>=batch_size:
+                    flush()
+
+            if progress_fn is not None and (num_done==1 or num_done%100==0 or num_done==len(wav_paths)):
+                progress_fn(num_done, len(wav_paths))
+        if len(batch_paths):
+            flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return failed
+
+
+def load_emb_matrix (dataset_path):
+    """Returns (files, memory-mapped matrix) of the dataset's consolidated embeddings, or (None, None) if there isn't one"""
+    try:
+        with open(f'{dataset_path}/{MATRIX_FNAME}.json', encoding="utf8") as f:
+            files = json.load(f)["files"]
+        matrix = np.load(f'{dataset_path}/{MATRIX_FNAME}.npy', mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None, None
+    if matrix.shape[0]!=len(files):
+        return None, None
+    return files, matrix
+
+
+def update_emb_matrix (dataset_path):
+    """(Re-)builds the dataset's consolidated embeddings matrix from its se_embs/*.npy files, re-using the rows of files
+    that haven't changed. Returns (files, memory-mapped matrix)"""
+    if not os.path.exists(f'{dataset_path}/se_embs'):
+        return None, None
+
+    manifest = load_emb_manifest(dataset_path)
+    emb_files = sorted([fname for fname in os.listdir(f'{dataset_path}/se_embs') if fname.endswith(".npy")])
+    if manifest is not None:
+        # Only embeddings of files currently known to be up to date
+        emb_files = [fname for fname in emb_files if fname.replace(".npy", ".wav") in manifest.keys()]
+    stamps = [manifest[fname.replace(".npy", ".wav")] if manifest is not None else None for fname in emb_files]
+
+    old_rows = {}
+    old_files, old_matrix = load_emb_matrix(dataset_path)
+    if old_files is not None:
+        try:
+            with open(f'{dataset_path}/{MATRIX_FNAME}.json', encoding="utf8") as f:
+                old_stamps = json.load(f)["stamps"]
+            old_rows = {fname: [ri, stamp] for ri, (fname, stamp) in enumerate(zip(old_files, old_stamps))}
+        except (OSError, ValueError, KeyError):
+            old_rows = {}
+
+    # Nothing added, removed, or re-extracted
+    if old_files==emb_files and all([fname in old_rows.keys() and old_rows[fname][1]==stamp for fname, stamp in zip(emb_files, stamps)]):
+        return old_files, old_matrix
+
+    rows = []
+    kept_files = []
+    kept_stamps = []
+    for fname, stamp in zip(emb_files, stamps):
+        if fname in old_rows.keys() and old_rows[fname][1]==stamp:
+            rows.append(np.asarray(old_matrix[old_rows[fname][0]]))
+        else:
+            try:
+                rows.append(np.load(f'{dataset_path}/se_embs/{fname}').astype(np.float32).reshape(-1))
+            except (OSError, ValueError):
+                print(f'BAD: {dataset_path}/se_embs/{fname}')
+                continue
+        kept_files.append(fname)
+        kept_stamps.append(stamp)
+
+    matrix = np.stack(rows).astype(np.float32) if len(rows) else np.zeros((0, 512), dtype=np.float32)
+    del rows, old_matrix # Release the old memory-mapped file before replacing it
+
+    # Write the matrix first, then the index, each atomically. A crash in between leaves a row count mismatch, which
+    # load_emb_matrix() treats as no matrix
+    with open(f'{dataset_path}/{MATRIX_FNAME}.npy.tmp', "wb") as f:
+        np.save(f, matrix)
+    os.replace(f'{dataset_path}/{MATRIX_FNAME}.npy.tmp', f'{dataset_path}/{MATRIX_FNAME}.npy')
+    with open(f'{dataset_path}/{MATRIX_FNAME}.json.tmp', "w+", encoding="utf8") as f:
+        json.dump({"files": kept_files, "stamps": kept_stamps}, f)
+    os.replace(f'{dataset_path}/{MATRIX_FNAME}.json.tmp', f'{dataset_path}/{MATRIX_FNAME}.json')
+
+    return load_emb_matrix(dataset_path)
+
+
+class EmbeddingStore(object):
+    """Per-row lookups of the speaker embeddings of wav files, from their dataset's consolidated matrix"""
+    def __init__(self):
+        super(EmbeddingStore, self).__init__()
+        self.datasets = {} # dataset dir -> [{"file.npy": row}, matrix]
+
+    def __getstate__(self):
+        # Don't send the memory-mapped matrices to the DataLoader workers. They re-open them themselves
+        state = self.__dict__.copy()
+        state["datasets"] = {}
+        return state
+
+    def get (self, wav_path):
+        """Returns the embedding of the wav file, or None if it's not in its dataset's matrix"""
+        wav_path = wav_path.replace("\\", "/")
+        dataset_path = "/".join(wav_path.split("/")[:-2])
+        if dataset_path not in self.datasets.keys():
+            files, matrix = load_emb_matrix(dataset_path)
+            self.datasets[dataset_path] = [{fname: ri for ri, fname in enumerate(files or [])}, matrix]
+        rows, matrix = self.datasets[dataset_path]
+
+        row = rows.get(wav_path.split("/")[-1].replace(".wav", ".npy"))
+        if row is None:
+            return None
+        return np.array(matrix[row])
@@ -260,6 +260,30 @@ class ResNetSpeakerEncoder(nn.Module):
             embeddings = torch.mean(embeddings, dim=0, keepdim=True)
         return embeddings
 
+    @torch.no_grad()
+    def compute_embedding_batch(self, wavs, device=None, num_frames=250, num_eval=10, l2_norm=True):
+        """
+        compute_embedding() over a list of already loaded (see load_audio) waveforms
+        Each utterance's crops go through the encoder on their own, as the se_embs are extracted in train mode, where the
+        BatchNorm layers normalize over the batch. Only the audio decoding (extract_embeddings' worker pool) is parallelised
+        Returns a len(wavs) x proj_dim tensor of the mean embeddings
+        """
+        if device is None:
+            device = self.conv1.weight.device
+
+        if self.use_torch_spec:
+            num_frames = num_frames * 160
+
+        embeddings = torch.zeros((len(wavs), self.proj_dim), device=device)
+        for wi, wav in enumerate(wavs):
+            crop_len = min(num_frames, len(wav))
+            offsets = np.linspace(0, len(wav) - crop_len, num=num_eval)
+            crops = np.stack([wav[int(offset):int(offset)+crop_len] for offset in offsets])
+            crops_embs = self.inference(torch.from_numpy(crops).float().to(device), l2_norm=l2_norm)
+            embeddings[wi] = crops_embs.float().sum(dim=0)
+
+        return embeddings / num_eval
+
     # def load_checkpoint(self, config: dict, checkpoint_path: str, eval: bool = False, use_cuda: bool = False, cuda_device: int = 0):
     def load_checkpoint(self, checkpoint_path: str, eval: bool = False, use_cuda: bool = False, cuda_device: int = 0):
         # state = load_fsspec(checkpoint_path, map_location=torch.device("cpu"))
@@ -1,6 +1,6 @@
 from .ipa_to_xvaarpabet import ALL_SYMBOLS
 # import text_prep.phonecode_tables
-from .text_preprocessing import get_text_preprocessor
+from .text_preprocessing import get_text_preprocessor, pad_sequences
 
 lang_names = {
     "am": "Amharic",
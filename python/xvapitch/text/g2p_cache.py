@@ -0,0 +1,241 @@
+import os
+import glob
+import time
+import zlib
+import atexit
+
+# g2p cache store: the sorted "word|phones" cache file, plus an append-only journal of the entries learned since its last
+# compaction, instead of re-writing the whole sorted file for every new word
+#
+#   espeak_cache_en.txt                 word|phones, sorted. Only ever replaced atomically, by a compaction
+#   espeak_cache_en.txt.journal         \nword|phones|crc32 records, one per new entry, appended as they're learned
+#   espeak_cache_en.txt.lock            held while compacting
+#   espeak_cache_en.txt.journal.<pid>   a journal being folded into the sorted file by a compaction (or left over from
+#                                       one that crashed, to be picked up by the next load/compaction)
+#
+# Each journal entry is one small append, so several (eg DataLoader worker) processes can write to the same journal.
+# Records start with their line break, so one appended after a truncated line (a crash mid-write) still starts a line of
+# its own. Records are only read back if they're complete and their checksum matches, so the truncated line, or records
+# garbled by racing writers, are skipped (and get re-learned). The journal is compacted into the sorted file once it grows
+# past COMPACT_BYTES, and at exit by the processes that added entries. Compactions take turns, through the lock file.
+
+COMPACT_BYTES = 4*1024*1024
+LOCK_TIMEOUT = 30 # seconds to wait for another process' compaction, before leaving it for later
+STALE_LOCK_AGE = 120 # seconds after which a lock is assumed to be left over from a crash
+
+
+def read_cache_lines (lines, cache):
+    for line in lines:
+        if "|" in line:
+            word = line.split("|")[0]
+            phones = "|".join(line.split("|")[1:])
+            cache[word.lower().strip()] = phones.strip()
+    return cache
+
+def get_crc (entry):
+    return f'{zlib.crc32(entry.encode("utf8")):08x}'
+
+def format_journal_record (word, phones):
+    entry = f'{word}|{phones}'
+    return f'\n{entry}|{get_crc(entry)}'
+
+def read_journal (journal_path, cache):
+    """Reads the journal's complete, checksum matching records into the cache. Returns the number read"""
+    if not os.path.exists(journal_path):
+        return 0
+    with open(journal_path, "rb") as f:
+        data = f.read()
+    num_read = 0
+    for line in data.split(b"\n"):
+        try:
+            line = line.decode("utf8")
+        except UnicodeDecodeError:
+            continue
+        if line.count("|")<2:
+            continue
+        entry, crc = line.rsplit("|", 1)
+        if len(crc)!=8 or crc!=get_crc(entry):
+            continue
+        word, phones = entry.split("|", 1)
+        if len(word):
+            cache[word] = phones
+            num_read += 1
+    return num_read
+
+
+class G2PCache(object):
+    def __init__(self, cache_path, compact_bytes=COMPACT_BYTES):
+        super(G2PCache, self).__init__()
+        self.cache_path = cache_path
+        self.journal_path = f'{cache_path}.journal'
+        self.compact_bytes = compact_bytes
+        self.has_new_entries = False
+        self.cache = {}
+        atexit.register(self.close)
+
+    def load (self, cache=None):
+        """Reads the sorted file, then any journals, into (and returns) the cache dict"""
+        self.cache = {} if cache is None else cache
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, encoding="utf8") as f:
+                read_cache_lines(f.read().split("\n"), self.cache)
+        else:
+            print(f'g2p cache file not found at: {self.cache_path}')
+        for journal_path in sorted(glob.glob(glob.escape(self.journal_path)+".*")) + [self.journal_path]:
+            try:
+                read_journal(journal_path, self.cache)
+            except OSError:
+                pass # Finished compacting, by another process
+        return self.cache
+
+    def add (self, word, phones):
+        self.cache[word] = phones
+        self.has_new_entries = True
+        with open(self.journal_path, "ab") as f:
+            f.write(format_journal_record(word, phones).encode("utf8"))
+            journal_bytes = f.tell()
+        if journal_bytes>=self.compact_bytes:
+            self.compact()
+
+    def lock (self):
+        lock_path = f'{self.cache_path}.lock'
+        start = time.time()
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time()-os.path.getmtime(lock_path) > STALE_LOCK_AGE:
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    pass
+                if time.time()-start > LOCK_TIMEOUT:
+                    return False
+                time.sleep(0.01)
+
+    def unlock (self):
+        try:
+            os.remove(f'{self.cache_path}.lock')
+        except OSError:
+            pass
+
+    def compact (self):
+        """Folds the journal(s) into the sorted file"""
+        if not self.lock():
+            return
+        try:
+            self.compact_locked()
+        finally:
+            self.unlock()
+
+    def compact_locked (self):
+        # Move the journal out of the way first, so entries appended from now on go to a new one, and aren't lost
+        rotated_path = f'{self.journal_path}.{os.getpid()}'
+        try:
+            if os.path.exists(self.journal_path):
+                os.replace(self.journal_path, rotated_path)
+        except OSError:
+            return # Eg still open in another process, on Windows. Left for later
+
+        # Merge with the latest state on disk, which other processes may have added to
+        merged = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, encoding="utf8") as f:
+                read_cache_lines(f.read().split("\n"), merged)
+        rotated_paths = sorted(glob.glob(glob.escape(self.journal_path)+".*"))
+        for journal_path in rotated_paths:
+            try:
+                read_journal(journal_path, merged)
+            except OSError:
+                pass
+        merged.update(self.cache)
+
+        cache_out = []
+        for key in sorted(list(merged.keys())):
+            cache_out.append(f'{key}|{merged[key]}')
+        with open(f'{self.cache_path}.{os.getpid()}.tmp', "w+", encoding="utf8") as f:
+            f.write("\n".join(cache_out))
+        os.replace(f'{self.cache_path}.{os.getpid()}.tmp', self.cache_path)
+
+        for journal_path in rotated_paths:
+            try:
+                os.remove(journal_path)
+            except OSError:
+                pass
+        self.has_new_entries = False
+
+    def close (self):
+        if self.has_new_entries:
+            try:
+                self.compact()
+            except OSError:
+                pass # The journal is still there, for the next compaction
+
+
+def check_g2p_cache (num_words=20000, num_workers=4, seed=1234):
+    """Concurrent writer processes, a truncated last journal line, and compaction against the old full re-write per word"""
+    import random
+    import tempfile
+    import multiprocessing as mp
+
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz'"
+    words = sorted(set(["".join([rng.choice(letters) for _ in range(rng.randint(2, 12))]) for _ in range(num_words)]))
+    entries = {word: " ".join(reversed(word)) for word in words}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = f'{tmp_dir}/espeak_cache_xx.txt'
+        with open(cache_path, "w+", encoding="utf8") as f:
+            f.write("\n".join([f'{word}|{entries[word]}' for word in words[:100]]))
+
+        # Concurrent writers, with small journals, so they also compact while the others are appending
+        start = time.time()
+        chunks = [words[100+wi::num_workers] for wi in range(num_workers)]
+        with mp.Pool(num_workers) as pool:
+            pool.map(check_g2p_cache_writer, [[cache_path, chunk, 64*1024] for chunk in chunks])
+        journal_time = time.time()-start
+
+        store = G2PCache(cache_path)
+        cache = store.load()
+        assert cache==entries, f'{len(cache)} vs {len(entries)} entries'
+
+        # A crash mid-write: the truncated last line is skipped, and the entries before it kept
+        store.add("zzcomplete", "z z")
+        with open(store.journal_path, "ab") as f:
+            f.write(format_journal_record("zztruncated", "z z t").encode("utf8")[:-4])
+        cache = G2PCache(cache_path).load()
+        assert "zzcomplete" in cache.keys() and "zztruncated" not in cache.keys()
+        store.add("zzafter", "z z a") # Appended after the truncated bytes
+        cache = G2PCache(cache_path).load()
+        assert cache["zzafter"]=="z z a" and "zztruncated" not in cache.keys()
+
+        store.compact()
+        assert not os.path.exists(store.journal_path)
+        with open(cache_path, encoding="utf8") as f:
+            keys = [line.split("|")[0] for line in f.read().split("\n")]
+        assert keys==sorted(keys) and len(keys)==len(entries)+2
+
+        # The old way: the whole sorted file re-written for every new word
+        num_rewrites = min(2000, len(words))
+        rewrite_cache = {}
+        start = time.time()
+        for word in words[:num_rewrites]:
+            rewrite_cache[word] = entries[word]
+            with open(f'{tmp_dir}/rewrite.txt', "w+", encoding="utf8") as f:
+                f.write("\n".join([f'{key}|{rewrite_cache[key]}' for key in sorted(list(rewrite_cache.keys()))]))
+        rewrite_time = time.time()-start
+    print(f'{len(words)-100} new words, {num_workers} writers: {int((len(words)-100)/journal_time)} words/s | full re-write per word: {int(num_rewrites/rewrite_time)} words/s (first {num_rewrites} words)')
+
+def check_g2p_cache_writer (args):
+    cache_path, words, compact_bytes = args
+    store = G2PCache(cache_path, compact_bytes=compact_bytes)
+    store.load()
+    for word in words:
+        store.add(word, " ".join(reversed(word)))
+    store.close()
+
+
+if __name__ == '__main__':
+    check_g2p_cache()
@@ -1,7 +1,10 @@
+import os
 import logging
 import abc
 import sys
 import re
+import atexit
+import threading
 import subprocess
 from typing import Dict, List, Tuple
 # import phonecode_tables
@@ -297,6 +300,131 @@ def _espeak_exe(base_dir, args: List, sync=False) -> List[str]:
         print(base_dir)
         raise
 
+def _espeak_args (language, tie=False) -> List[str]:
+    args = ["-v", f"{language}"]
+    # espeak and espeak-ng parses `ipa` differently
+    if tie:
+        args.append("--ipa=1")
+    else:
+        args.append("--ipa=1")
+    if tie:
+        args.append("--tie=%s" % tie)
+    return args
+
+def _espeak_lines_to_phonemes (lines, separator) -> str:
+    phonemes = ""
+    for line in lines:
+        logging.debug("line: %s", repr(line))
+        # phonemes += line.decode("utf8").strip()[self.num_skip_chars :]  # skip initial redundant characters
+        phonemes += line.decode("utf8").strip()
+    phonemes = re.sub(r"(\([a-z][a-z]\))", "", phonemes)
+    return phonemes.replace("_", separator)
+
+
+# Long-running espeak-ng processes, instead of one launch per word. Text is streamed through --stdin, which espeak-ng
+# reads (and phonemizes, and flushes) one line at a time. Each line of text is followed by a sentinel line, whose
+# phonemes (read once, at start-up) mark the end of the text's output
+ESPEAK_STREAM_SENTINEL = "8413975062"
+ESPEAK_STREAM_MAX_BYTES = 900 # espeak-ng reads --stdin lines into a 1000 byte buffer, longer ones would get split
+
+class ESpeakProcess(object):
+    def __init__(self, base_dir, args):
+        super(ESpeakProcess, self).__init__()
+        self.pid = os.getpid() # Not shared with forked (eg DataLoader worker) processes
+        self.lock = threading.Lock()
+        cmd = [f'{base_dir}/eSpeak_NG/espeak-ng.exe', f'--path={base_dir}/eSpeak_NG', "-q", "-b", "1"] + args + ["--stdin"]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        # The sentinel's phonemes, which have to come out as one line, the same every time
+        self.sentinel_line = None
+        self.process.stdin.write(f'{ESPEAK_STREAM_SENTINEL}\n{ESPEAK_STREAM_SENTINEL}\n'.encode("utf8"))
+        self.process.stdin.flush()
+        first, second = self.read_line(), self.read_line()
+        if not len(first) or first!=second:
+            self.close()
+            raise Exception(f'Unexpected espeak-ng --stdin output: {first} {second}')
+        self.sentinel_line = first
+
+    @staticmethod
+    def can_stream (text):
+        return "\n" not in text and "\r" not in text and ESPEAK_STREAM_SENTINEL not in text and len(text.encode("utf8"))<ESPEAK_STREAM_MAX_BYTES
+
+    def read_line (self):
+        line = self.process.stdout.readline()
+        while line.strip()==b"":
+            if line==b"":
+                raise Exception("The espeak-ng process exited")
+            line = self.process.stdout.readline()
+        return line.strip()
+
+    def run (self, texts):
+        """The raw output lines of each of the texts, as _espeak_exe() returns them"""
+        with self.lock:
+            def write ():
+                try:
+                    for text in texts:
+                        self.process.stdin.write(f'{text}\n{ESPEAK_STREAM_SENTINEL}\n'.encode("utf8"))
+                    self.process.stdin.flush()
+                except OSError:
+                    pass # The reads will find the process gone
+
+            # Written from a thread when there's more than a line's worth, so neither end blocks on a full pipe
+            writer = None
+            if len(texts)>1:
+                writer = threading.Thread(target=write, daemon=True)
+                writer.start()
+            else:
+                write()
+
+            outputs = []
+            for _ in texts:
+                lines = []
+                line = self.process.stdout.readline()
+                while line.strip()!=self.sentinel_line:
+                    if line==b"":
+                        raise Exception("The espeak-ng process exited")
+                    lines.append(line)
+                    line = self.process.stdout.readline()
+                outputs.append(lines)
+            if writer is not None:
+                writer.join()
+        return outputs
+
+    def close (self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except:
+            self.process.kill()
+
+_espeak_processes = {}
+
+def get_espeak_process (base_dir, args):
+    """The (base_dir, args) espeak-ng process of this (OS) process, started on first use. None if it can't be started"""
+    key = (os.getpid(), base_dir, tuple(args))
+    if key not in _espeak_processes.keys():
+        try:
+            _espeak_processes[key] = ESpeakProcess(base_dir, args)
+        except:
+            logging.warning(f'Could not start a long-running espeak-ng process, running it once per word instead: {sys.exc_info()[1]}')
+            _espeak_processes[key] = None
+    return _espeak_processes[key]
+
+def close_espeak_process (base_dir, args):
+    """Closes a broken process, leaving the per-call path for the rest of the session"""
+    key = (os.getpid(), base_dir, tuple(args))
+    if key in _espeak_processes.keys() and _espeak_processes[key] is not None:
+        _espeak_processes[key].close()
+    _espeak_processes[key] = None
+
+@atexit.register
+def close_espeak_processes ():
+    for key, process in list(_espeak_processes.items()):
+        if process is not None and process.pid==os.getpid():
+            process.close()
+    _espeak_processes.clear()
+
+
 class BasePhonemizer(abc.ABC):
     """Base phonemizer class
     Phonemization follows the following steps:
@@ -445,9 +573,10 @@ class ESpeak(BasePhonemizer):
     # _ESPEAK_LIB = _DEF_ESPEAK_LIB
 
     # def __init__(self, language: str, backend=None, punctuations=Punctuation.default_puncs(), keep_puncs=True):
-    def __init__(self, base_dir, language: str, backend=None, punctuations=None, keep_puncs=True):
+    def __init__(self, base_dir, language: str, backend=None, punctuations=None, keep_puncs=True, persistent=True):
 
         self.base_dir = base_dir
+        self.persistent = persistent # Stream text through a long-running espeak-ng process, rather than one per call
 
         super().__init__(language, punctuations=punctuations, keep_puncs=keep_puncs)
         if backend is not None:
@@ -462,27 +591,32 @@ class ESpeak(BasePhonemizer):
                 consecutive characters of a single phoneme. Else separate phoneme
                 with '_'. This option requires espeak>=1.49. Default to False.
         """
-        # set arguments
-        args = ["-v", f"{self._language}"]
-        # espeak and espeak-ng parses `ipa` differently
-        if tie:
-            args.append("--ipa=1")
-        else:
-            args.append("--ipa=1")
-        if tie:
-            args.append("--tie=%s" % tie)
-
-        args.append('"' + text + '"')
-        # compute phonemes
-        phonemes = ""
-
-
-        for line in _espeak_exe(self.base_dir, args, sync=True):
-            logging.debug("line: %s", repr(line))
-            # phonemes += line.decode("utf8").strip()[self.num_skip_chars :]  # skip initial redundant characters
-            phonemes += line.decode("utf8").strip()
-        phonemes = re.sub(r"(\([a-z][a-z]\))", "", phonemes)
-        return phonemes.replace("_", separator)
+        return self.phonemize_espeak_batch([text], separator, tie=tie)[0]
+
+    def phonemize_espeak_batch(self, texts: List[str], separator: str = "|", tie=False) -> List[str]:
+        """phonemize_espeak() for many texts, streamed through the long-running espeak-ng process where possible"""
+        args = _espeak_args(self._language, tie)
+        outputs = [None for _ in texts]
+
+        process = get_espeak_process(self.base_dir, args) if self.persistent else None
+        streamed = [ti for ti, text in enumerate(texts) if ESpeakProcess.can_stream(text)] if process is not None else []
+        if len(streamed):
+            try:
+                for ti, lines in zip(streamed, process.run([texts[ti] for ti in streamed])):
+                    outputs[ti] = lines
+            except:
+                logging.warning(f'The espeak-ng process failed, running it once per word instead: {sys.exc_info()[1]}')
+                close_espeak_process(self.base_dir, args)
+                outputs = [None for _ in texts]
+
+        for ti, text in enumerate(texts):
+            if outputs[ti] is None:
+                outputs[ti] = _espeak_exe(self.base_dir, args + ['"' + text + '"'], sync=True)
+        return [_espeak_lines_to_phonemes(lines, separator) for lines in outputs]
+
+    def phonemize_batch(self, texts: List[str], separator="|") -> List[str]:
+        """phonemize(), for many texts at once"""
+        return self.phonemize_espeak_batch([text.strip() for text in texts], separator, tie=False)
 
     def _phonemize(self, text, separator=None):
         return self.phonemize_espeak(text, separator, tie=False)
@@ -810,3 +944,40 @@ def ipa2xvaarpabet (ipa_text):
     return " ".join(phones_final_post)
 
 
+
+def check_espeak_stream (base_dir, language="en", num_words=1000, seed=1234):
+    """The long-running espeak-ng process against one launch per word, over a synthetic vocabulary: the same phonemes,
+    and the words/s of each"""
+    import time
+    import random
+    rng = random.Random(seed)
+    onsets = ["", "b", "br", "ch", "d", "f", "g", "gr", "h", "k", "l", "m", "n", "p", "qu", "r", "s", "sh", "st", "t", "th", "v", "w", "z"]
+    nuclei = ["a", "e", "i", "o", "u", "ai", "ea", "ee", "oo", "ou", "y"]
+    codas = ["", "", "n", "r", "s", "t", "ck", "ng", "ll", "nd", "'s"]
+    words = ["".join([rng.choice(onsets)+rng.choice(nuclei)+rng.choice(codas) for _ in range(rng.randint(1, 4))]) for _ in range(num_words)]
+    words += ["don't", "Mr.", "3rd", "1984", "naïve", "x", "e-mail"]
+
+    per_call = ESpeak(base_dir, language=language, persistent=False)
+    streamed = ESpeak(base_dir, language=language)
+    streamed.phonemize("start-up") # Not timed
+
+    start = time.time()
+    ref = [per_call.phonemize(word) for word in words]
+    per_call_rate = len(words)/(time.time()-start)
+
+    start = time.time()
+    out = [streamed.phonemize(word) for word in words]
+    streamed_rate = len(words)/(time.time()-start)
+
+    start = time.time()
+    out_batch = streamed.phonemize_batch(words)
+    batch_rate = len(words)/(time.time()-start)
+
+    for word, ref_phonemes, phonemes, batch_phonemes in zip(words, ref, out, out_batch):
+        assert ref_phonemes==phonemes==batch_phonemes, f'{word}: "{ref_phonemes}" vs "{phonemes}" vs "{batch_phonemes}"'
+    print(f'[{language}] {len(words)} words | per call: {int(per_call_rate)} words/s | long-running process: {int(streamed_rate)} words/s | batched: {int(batch_rate)} words/s')
+
+
+if __name__ == '__main__':
+    # python ipa_to_xvaarpabet.py <dir containing eSpeak_NG> [language]
+    check_espeak_stream(sys.argv[1], sys.argv[2] if len(sys.argv)>2 else "en")
@@ -4,6 +4,8 @@ import re
 import sys
 import json
 import codecs
+import collections
+from types import MappingProxyType
 from unidecode import unidecode
 from g2pc import G2pC
 
@@ -22,12 +24,14 @@ try:
     from resources.app.python.xvapitch.text.ipa_to_xvaarpabet import ESpeak, ipa2xvaarpabet, PUNCTUATION, ALL_SYMBOLS, PIN_YIN_ENDS, pinyin_to_arpabet_mappings, text_pinyin_to_pinyin_symbs, manual_phone_replacements
     from resources.app.python.xvapitch.text.en_numbers import normalize_numbers as en_normalize_numbers
     from resources.app.python.xvapitch.text.ro_numbers import generateWords as ro_generateWords
+    from resources.app.python.xvapitch.text.g2p_cache import G2PCache
     # from resources.app.python.xvapitch.text.h2p_parser.h2p import H2p
 except:
     try:
         from python.xvapitch.text.ipa_to_xvaarpabet import ESpeak, ipa2xvaarpabet, PUNCTUATION, ALL_SYMBOLS, PIN_YIN_ENDS, pinyin_to_arpabet_mappings, text_pinyin_to_pinyin_symbs, manual_phone_replacements
         from python.xvapitch.text.en_numbers import normalize_numbers as en_normalize_numbers
         from python.xvapitch.text.ro_numbers import generateWords as ro_generateWords
+        from python.xvapitch.text.g2p_cache import G2PCache
         # from python.xvapitch.text.h2p_parser.h2p import H2p
         # import python.xvapitch.text.phonecode_tables
     except:
@@ -35,10 +39,12 @@ except:
             from text.ipa_to_xvaarpabet import ESpeak, ipa2xvaarpabet, PUNCTUATION, ALL_SYMBOLS, PIN_YIN_ENDS, pinyin_to_arpabet_mappings, text_pinyin_to_pinyin_symbs, manual_phone_replacements
             from text.en_numbers import normalize_numbers as en_normalize_numbers
             from text.ro_numbers import generateWords as ro_generateWords
+            from text.g2p_cache import G2PCache
         except:
             from ipa_to_xvaarpabet import ESpeak, ipa2xvaarpabet, PUNCTUATION, ALL_SYMBOLS, PIN_YIN_ENDS, pinyin_to_arpabet_mappings, text_pinyin_to_pinyin_symbs, manual_phone_replacements
             from en_numbers import normalize_numbers as en_normalize_numbers
             from ro_numbers import generateWords as ro_generateWords
+            from g2p_cache import G2PCache
 
         # from text.h2p_parser.h2p import H2p
         # import text.phonecode_tables
@@ -84,6 +90,81 @@ except:
 #         return self.backend.phonemize(word, self.separator)
 
 
+# Single-pass dict replacement. The prompt's dict words are found with one scan over the text's word tokens, looked up
+# (case-insensitively, the way re.IGNORECASE compares characters) in a set of the words, and all replaced at once. This
+# gives the same output as the original one re.sub (twice) per word, as long as different words' matches neither overlap
+# nor touch, which is always the case for words made of only word characters. Prompts where that can't be guaranteed
+# (words with punctuation whose matches meet another word's, words with unescaped regex characters) still go through the
+# original word by word substitutions
+DICT_TOKEN_RE = re.compile(r'\w+')
+DICT_INSIDE_BRACES_RE = re.compile(r'[\w\s\(\)]*[\}]')
+DICT_UNSAFE_CHARS = set("\\^$*+?[]|{}")
+# Characters re.IGNORECASE treats as equal, which aren't through their one character upper/lower case forms
+IGNORECASE_EQUIVALENCES = {}
+for codes in [(0x390, 0x1fd3), (0x3b0, 0x1fe3), (0xfb05, 0xfb06)]:
+    for code in codes:
+        IGNORECASE_EQUIVALENCES[chr(code)] = chr(codes[0])
+
+def fold_char (char):
+    # The lower case of the (one character) upper case, so that eg "ſ", "ς", "ı" land on "s", "σ", "i", as in re
+    upper = char.upper()
+    if len(upper)==1:
+        char = upper
+    lower = char.lower()
+    if len(lower)==1:
+        char = lower
+    return IGNORECASE_EQUIVALENCES.get(char, char)
+
+def fold_case (text):
+    """Folds text so that two strings re.IGNORECASE would match give the same string"""
+    if text.isascii():
+        return text.lower()
+    return "".join([fold_char(char) for char in text])
+
+def dict_word_pattern (dict_word):
+    dict_word_replace = dict_word.strip().replace(".", "\.").replace("(", "\(").replace(")", "\)")
+    return r'(?<!\{)\b'+dict_word_replace+r'\b(?![\w\s\(\)]*[\}])'
+
+
+# Phone->[integer] look-ups. ALL_SYMBOLS.index() is a linear search through the ~500 symbols, for every phone, so each
+# language instead builds a frozen phone->id dict once, with its phone replacements/mappings already folded in. A few
+# symbols are listed twice in ALL_SYMBOLS (eg AO1), so the first index is kept, same as .index()
+def build_symbol_to_id (overrides={}, fallbacks={}):
+    """overrides are applied before the ALL_SYMBOLS look-up (eg manual_phone_replacements), fallbacks only for phones not in it"""
+    symbol_to_id = {}
+    for si, symbol in enumerate(ALL_SYMBOLS):
+        if symbol not in symbol_to_id.keys():
+            symbol_to_id[symbol] = si
+    for phone, symbol in fallbacks.items():
+        if phone not in symbol_to_id.keys():
+            symbol_to_id[phone] = symbol_to_id[symbol]
+    for phone, symbol in overrides.items():
+        symbol_to_id[phone] = symbol_to_id[symbol]
+    return MappingProxyType(symbol_to_id)
+
+# Separating the ARPAbet brackets from punctuation, in one pass each, rather than 8 .replace() calls each
+ARPABET_CLOSE_PUNCT_RE = re.compile(r'\}([.!?,"\'\-)])')
+ARPABET_OPEN_PUNCT_RE = re.compile(r'([.!?,"\'\-(])\{')
+WHITESPACE_RE = re.compile(r'\s+')
+
+SYMBOL_TO_ID = build_symbol_to_id()
+
+# The Chinese full-width punctuation, to ascii
+ZH_PUNCTUATION_TABLE = str.maketrans({"！": "!", "？": "?", "，": ",", "。": ",", "…": "...", "）": "", "（": "", "、": ",", "“": ",", "”": ",", "：": ":"})
+
+def pad_sequences (sequences, pad_id=0):
+    """Symbol id lists (eg from several languages' text_to_sequence) into a padded [B, longest] LongTensor, and their lengths"""
+    import torch
+    lengths = torch.tensor([len(sequence) for sequence in sequences], dtype=torch.long)
+    max_len = int(lengths.max()) if len(sequences) else 0
+    padded = torch.full((len(sequences), max_len), pad_id, dtype=torch.long)
+    mask = torch.arange(max_len).unsqueeze(0) < lengths.unsqueeze(1)
+    padded[mask] = torch.tensor([symbol_id for sequence in sequences for symbol_id in sequence], dtype=torch.long)
+    return padded, lengths
+
+SEQUENCE_MEMO_SIZE = 4096 # Lines; Scripts, and training epochs, repeat lines a lot
+
+
 class TextPreprocessor():
     def __init__(self, lang_code, lang_code2, base_dir, add_blank=True, logger=None, use_g2p=True, use_epitran=False):
         super(TextPreprocessor, self).__init__()
@@ -96,11 +177,18 @@ class TextPreprocessor():
         self.lang_code2 = lang_code2
         self.g2p_cache = {}
         self.g2p_cache_path = None
+        self.g2p_cache_store = None
         self.add_blank = add_blank
         self.dicts = []
         self.dict_words = [] # Cache
+        self.dict_word_sets = [] # For the look-ups
         self.dict_is_custom = [] # Built-in, or custom; Give custom dict entries priority over other pre-processing steps
 
+        self.symbol_to_id = build_symbol_to_id(overrides=manual_phone_replacements)
+        self.blank_id = len(ALL_SYMBOLS)-2
+        self.sequence_memo = collections.OrderedDict() # LRU of text -> (sequence, cleaned_text)
+        self.sequence_memo_size = SEQUENCE_MEMO_SIZE
+
         self._punctuation = '!\'(),.:;? ' # Standard english pronunciation symbols
 
         self.punct_to_whitespace_reg = re.compile(f'[\.,!?]*')
@@ -145,8 +233,7 @@ class TextPreprocessor():
         return text
 
     def collapse_whitespace(self, text):
-        _whitespace_re = re.compile(r'\s+')
-        return re.sub(_whitespace_re, ' ', text)
+        return WHITESPACE_RE.sub(' ', text)
 
     def load_dict (self, dict_path, isCustom=False):
         pron_dict = {}
@@ -160,6 +247,8 @@ class TextPreprocessor():
         self.dict_is_custom.append(isCustom)
         self.dicts.append(pron_dict)
         self.dict_words.append(list(pron_dict.keys()))
+        self.dict_word_sets.append(set(pron_dict.keys()))
+        self.sequence_memo.clear()
 
     # Override
     def post_process_dict(self, pron_dict):
@@ -198,8 +287,86 @@ class TextPreprocessor():
     #     return re.sub(self.punct_to_whitespace_reg, ' ', text)
 
 
+    def get_words_in_prompt (self, text, dict_words):
+        text_graphites = re.sub("{([^}]*)}", "", text, flags=re.IGNORECASE)
+
+        # Don't run the ARPAbet replacement for every single word, as it would be too slow. Instead, do it only for words that are actually present in the prompt
+        words_in_prompt = (text_graphites+" ").replace("}","").replace("{","").replace(",","").replace("?","").replace("!","").replace(";","").replace("...",".").replace(". "," ").lower().split(" ")
+        return [word.strip() for word in words_in_prompt if len(word.strip()) and word.lower() in dict_words]
+
     def dict_replace (self, text, customDicts):
 
+        for di, pron_dict in enumerate(self.dicts):
+
+            if (customDicts and self.dict_is_custom[di]) or (not customDicts and not self.dict_is_custom[di]):
+
+                words_in_prompt = self.get_words_in_prompt(text, self.dict_word_sets[di])
+
+                if len(words_in_prompt):
+                    # Pad out punctuation, to make sure they don't get used in the word look-ups
+                    text = " "+text.replace(",", " ,").replace(".", " .").replace("!", " !").replace("?", " ?")+" "
+
+                    replaced = self.replace_dict_words(text, words_in_prompt, pron_dict)
+                    text = replaced if replaced is not None else self.replace_dict_words_sequential(text, words_in_prompt, pron_dict)
+
+                    # Undo the punctuation padding, to retain the original sentence structure
+                    text = text.replace(" ,", ",").replace(" .", ".").replace(" !", "!").replace(" ?", "?")
+                    text = re.sub("^\s+", " ", text) if text.startswith("  ") else re.sub("^\s*", "", text)
+                    text = re.sub("\s+$", " ", text) if text.endswith("  ") else re.sub("\s*$", "", text)
+
+        return text
+
+    def replace_dict_words (self, text, words_in_prompt, pron_dict):
+        """All the prompt's dict words replaced in one go, or None if that might not give the same result as
+        replace_dict_words_sequential()"""
+        folded_words = {} # folded word -> word
+        token_words = {} # The same, for the words made of only word characters, which match whole word tokens
+        spans = [] # [start, end, word]
+        for dict_word in set(words_in_prompt):
+            if len(DICT_UNSAFE_CHARS.intersection(dict_word)) or "\\" in pron_dict[dict_word]:
+                return None
+            folded = fold_case(dict_word)
+            if folded in folded_words.keys():
+                return None # Two words that match each other's text, so the order they're replaced in matters
+            folded_words[folded] = dict_word
+
+            if DICT_TOKEN_RE.fullmatch(dict_word) is not None:
+                token_words[folded] = dict_word
+            else:
+                for match in re.finditer(dict_word_pattern(dict_word), text, flags=re.IGNORECASE):
+                    spans.append([match.start(), match.end(), dict_word])
+
+        for match in DICT_TOKEN_RE.finditer(text):
+            folded = fold_case(match.group())
+            if folded in token_words.keys() and text[match.start()-1]!="{" and DICT_INSIDE_BRACES_RE.match(text, match.end()) is None:
+                spans.append([match.start(), match.end(), token_words[folded]])
+
+        spans = sorted(spans)
+        for span_i in range(1, len(spans)):
+            if spans[span_i][0]<=spans[span_i-1][1] and spans[span_i][2]!=spans[span_i-1][2]:
+                return None # Overlapping, or touching (which changes the word boundaries), matches of different words
+
+        text_out = []
+        last_end = 0
+        for start, end, dict_word in spans:
+            text_out.append(text[last_end:start])
+            text_out.append("{"+pron_dict[dict_word]+"}")
+            last_end = end
+        text_out.append(text[last_end:])
+        return "".join(text_out)
+
+    def replace_dict_words_sequential (self, text, words_in_prompt, pron_dict):
+        for dict_word in words_in_prompt:
+            dict_word_with_spaces = "{"+pron_dict[dict_word]+"}"
+            # Do it twice, because re will not re-use spaces, so if you have two neighbouring words to be replaced,
+            # and they share a space character, one of them won't get changed
+            for _ in range(2):
+                text = re.sub(dict_word_pattern(dict_word), dict_word_with_spaces, text, flags=re.IGNORECASE)
+        return text
+
+    def dict_replace_reference (self, text, customDicts):
+        # The original word by word implementation, for check_dict_replace()
+
         # # Don't run the ARPAbet replacement for every single word, as it would be too slow. Instead, do it only for words that are actually present in the prompt
         # words_in_prompt = (text+" ").replace("}","").replace("{","").replace(",","").replace("?","").replace("!","").replace("...",".").replace(". "," ").lower().split(" ")
         # print(f'words_in_prompt, {words_in_prompt}')
@@ -279,26 +446,19 @@ class TextPreprocessor():
     def load_g2p_cache (self, cache_path):
         # print(f'[DEBUG] Loading cache: {cache_path}')
         self.g2p_cache_path = cache_path
-        if os.path.exists(cache_path):
-            with open(cache_path, encoding="utf8") as f:
-                lines = f.read().split("\n")
-                for line in lines:
-                    if "|" in line:
-                        word = line.split("|")[0]
-                        phones = "|".join(line.split("|")[1:])
-                        self.g2p_cache[word.lower().strip()] = phones.strip()
-        else:
-            print(f'g2p cache file not found at: {cache_path}')
+        self.g2p_cache_store = G2PCache(cache_path)
+        self.g2p_cache = self.g2p_cache_store.load(self.g2p_cache)
 
-    def save_g2p_cache (self):
-        if self.g2p_cache_path:
-            cache_out = []
-            cache_keys = sorted(list(self.g2p_cache.keys()))
-            for key in cache_keys:
-                cache_out.append(f'{key}|{self.g2p_cache[key]}')
+    def add_g2p_cache_entry (self, word, phones):
+        # Appended to the cache's journal, rather than re-writing the whole cache file every time
+        self.g2p_cache[word] = phones
+        if self.g2p_cache_store is not None:
+            self.g2p_cache_store.add(word, phones)
 
-            with open(self.g2p_cache_path, "w+", encoding="utf8") as f:
-                f.write("\n".join(cache_out))
+    def save_g2p_cache (self):
+        # Compacts the journal into the sorted cache file. Also done at exit, and once the journal gets big
+        if self.g2p_cache_store is not None:
+            self.g2p_cache_store.compact()
 
     # Override
     def fill_missing_via_g2p (self, text):
@@ -397,8 +557,7 @@ class TextPreprocessor():
                                         else:
                                             g2p_out = self.espeak.phonemize(sp).replace("|", " ")
                                         # print(f'g2p_out, {g2p_out}')
-                                        self.g2p_cache[sp.lower()] = g2p_out
-                                        self.save_g2p_cache()
+                                        self.add_g2p_cache_entry(sp.lower(), g2p_out)
                                         g2p_out = ipa2xvaarpabet(g2p_out)
                                         # print(f'g2p_out, {g2p_out}')
                                         sub_part_phonemes.append(g2p_out)
@@ -475,72 +634,76 @@ class TextPreprocessor():
 
     # Main entry-point for pre-processing text completely into phonemes
     # This converts not the phonemes, but to the index numbers for the phonemes list, as required by the models
+    # Lines are memoized (LRU), as scripts re-generate the same lines, and training re-visits them every epoch
     def text_to_sequence (self, text):
+        memo = self.sequence_memo.get(text)
+        if memo is not None:
+            self.sequence_memo.move_to_end(text)
+            return list(memo[0]), memo[1]
+
+        sequence, cleaned_text = self.text_to_sequence_uncached(text)
+
+        self.sequence_memo[text] = (tuple(sequence), cleaned_text)
+        if len(self.sequence_memo)>self.sequence_memo_size:
+            self.sequence_memo.popitem(last=False)
+        return sequence, cleaned_text
+
+    def text_to_sequence_uncached (self, text):
 
         # Separate the ARPAbet brackets from punctuation
-        text = text.replace("}.", "} .")
-        text = text.replace("}!", "} !")
-        text = text.replace("}?", "} ?")
-        text = text.replace("},", "} ,")
-        text = text.replace("}\"", "} \"")
-        text = text.replace("}'", "} '")
-        text = text.replace("}-", "} -")
-        text = text.replace("})", "} )")
-
-        text = text.replace(".{", ". {")
-        text = text.replace("!{", "! {")
-        text = text.replace("?{", "? {")
-        text = text.replace(",{", ", {")
-        text = text.replace("\"{", "\" {")
-        text = text.replace("'{", "' {")
-        text = text.replace("-{", "- {")
-        text = text.replace("({", "( {")
+        text = ARPABET_CLOSE_PUNCT_RE.sub(r'} \1', text)
+        text = ARPABET_OPEN_PUNCT_RE.sub(r'\1 {', text)
 
         orig_text = text
         text = self.text_to_phonemes(text) # Get 100% phonemes from the text
         text = self.collapse_whitespace(text).strip() # Get rid of duplicate/padding spaces
         phonemes = text.split(" ")
-        phonemes_final = []
-        for pi,phone in enumerate(phonemes):
-            if phone in manual_phone_replacements.keys():
-                phonemes_final.append(manual_phone_replacements[phone])
-            else:
-                phonemes_final.append(phone)
-
-
-        # sequence = [ALL_SYMBOLS.index(phone) for phone in phonemes]
-        # blacklist = ["#"]
-        try:
-            sequence = []
-            for phone in phonemes_final:
-                if phone=="#": # The g2p something returns things like "# foreign french". Cut away the commented out stuff, when this happens
-                    break
-                if len(phone.strip()):
-                    sequence.append(ALL_SYMBOLS.index(phone))
-
-            # sequence = [ALL_SYMBOLS.index(phone) for phone in phonemes_final if len(phone) and phone.strip() not in blacklist]
-        except:
-            print(orig_text, phonemes_final)
-            raise
-
-        # Intersperse blank symbol if required
-        if self.add_blank:
-            sequence_ = []
-            for si,symb in enumerate(sequence):
-                sequence_.append(symb)
-                if si<len(sequence)-1:
-                    # sequence_.append(len(ALL_SYMBOLS)-1)
-                    sequence_.append(len(ALL_SYMBOLS)-2)
-            sequence = sequence_
 
+        # manual_phone_replacements are already folded into symbol_to_id
+        sequence = []
+        for phone in phonemes:
+            if phone=="#": # The g2p something returns things like "# foreign french". Cut away the commented out stuff, when this happens
+                break
+            if len(phone.strip()):
+                symbol_id = self.symbol_to_id.get(phone)
+                if symbol_id is None:
+                    print(orig_text, phonemes)
+                    raise ValueError(f'{phone} is not in ALL_SYMBOLS')
+                sequence.append(symbol_id)
+
+        sequence = self.intersperse_blank(sequence)
         cleaned_text = "|".join([ALL_SYMBOLS[index] for index in sequence])
 
         return sequence, cleaned_text
 
+    # Intersperse blank symbol if required
+    def intersperse_blank (self, sequence):
+        if not self.add_blank or len(sequence)<2:
+            return sequence
+        sequence_ = [self.blank_id] * (len(sequence)*2-1)
+        sequence_[::2] = sequence
+        return sequence_
+
+    # Batch version of text_to_sequence, for the models: returns a (len(texts), longest) LongTensor of the symbol ids,
+    # padded with pad_id (the same 0 padding as the training batches), along with the sequence lengths and cleaned texts
+    def texts_to_padded_sequences (self, texts, pad_id=0):
+        sequences = []
+        cleaned_texts = []
+        for text in texts:
+            sequence, cleaned_text = self.text_to_sequence(text)
+            sequences.append(sequence)
+            cleaned_texts.append(cleaned_text)
+
+        padded, lengths = pad_sequences(sequences, pad_id=pad_id)
+        return padded, lengths, cleaned_texts
+
     def cleaned_text_to_sequence (self, text):
         text = self.collapse_whitespace(text).strip() # Get rid of duplicate/padding spaces
         phonemes = text.split(" ")
-        sequence = [ALL_SYMBOLS.index(phone) for phone in phonemes]
+        try:
+            sequence = [SYMBOL_TO_ID[phone] for phone in phonemes]
+        except KeyError as e:
+            raise ValueError(f'{e.args[0]} is not in ALL_SYMBOLS')
         return sequence
 
     def sequence_to_text (self, sequence):
@@ -649,9 +812,9 @@ class EnglishTextPreprocessor(TextPreprocessor):
 
         # return self.normalize_numbers(text)
 
-    def text_to_sequence(self, text):
+    def text_to_sequence_uncached (self, text):
         text = unidecode(text) # transliterate non-english letters to English, if they can be ascii
-        return super(EnglishTextPreprocessor, self).text_to_sequence(text)
+        return super(EnglishTextPreprocessor, self).text_to_sequence_uncached(text)
 
 
 class FrenchTextPreprocessor(TextPreprocessor):
@@ -1111,6 +1274,9 @@ class ChineseTextPreprocessor(TextPreprocessor):
 
         self.TEMP_unhandled = []
 
+        self.symbol_to_id = build_symbol_to_id(fallbacks=pinyin_to_arpabet_mappings)
+        self.blank_id = len(ALL_SYMBOLS)-1
+
 
     def split_pinyin (self, pinyin):
         symbs_split = []
@@ -1243,8 +1409,7 @@ class ChineseTextPreprocessor(TextPreprocessor):
                                     # g2p_out = self.espeak.phonemize(sp).replace("|", " ")
                                     g2p_out = self.g2p(sp)
                                     g2p_out = " ".join([out_part[2] for out_part in g2p_out])
-                                    self.g2p_cache[sp.lower()] = g2p_out
-                                    self.save_g2p_cache()
+                                    self.add_g2p_cache_entry(sp.lower(), g2p_out)
                                     # g2p_out = ipa2xvaarpabet(g2p_out)
                                     g2p_out = self.post_process_pinyin_symbs(g2p_out)
                                     # print(f'g2p_out, {g2p_out}')
@@ -1467,13 +1632,10 @@ class ChineseTextPreprocessor(TextPreprocessor):
         # print(f'fill_missing_via_g2p: |{text}|')
         return text
 
-    def text_to_sequence (self, text):
-
-        orig_text = text
+    def text_to_sequence_uncached (self, text):
 
         text = self.collapse_whitespace(text) # Get rid of duplicate/padding spaces
-        text = text.replace("！", "!").replace("？", "?").replace("，", ",").replace("。", ",").replace("…", "...").replace("）", "").replace("（", "")\
-            .replace("、", ",").replace("“", ",").replace("”", ",").replace("：", ":")
+        text = text.translate(ZH_PUNCTUATION_TABLE)
 
         text = self.text_to_phonemes(text) # Get 100% phonemes from the text
 
@@ -1485,33 +1647,19 @@ class ChineseTextPreprocessor(TextPreprocessor):
         phonemes = self.collapse_whitespace(text).strip().split(" ")
         # self.logger.info(f'1 phonemes: {phonemes}')
 
+        # The pinyin_to_arpabet_mappings are already folded into symbol_to_id, for phones not in ALL_SYMBOLS
         sequence = []
-        for pi,phone in enumerate(phonemes):
+        for phone in phonemes:
             phone = phone.replace(":","").strip()
             if len(phone):
-                try:
-                    sequence.append(ALL_SYMBOLS.index(phone))
-                except:
-                    if phone in pinyin_to_arpabet_mappings.keys():
-                        sequence.append(ALL_SYMBOLS.index(pinyin_to_arpabet_mappings[phone]))
-                    else:
-                        pass
-                        # if phone not in ["5"]:
-                        #     self.TEMP_unhandled.append(f'{orig_text}: {phone}')
-
-                # Add a space character between each symbol
-                # if pi is not len(phonemes)-1:
-                #     sequence.append(ALL_SYMBOLS.index("_"))
-
-        # Intersperse blank symbol if required
-        if self.add_blank:
-            sequence_ = []
-            for si,symb in enumerate(sequence):
-                sequence_.append(symb)
-                if si<len(sequence)-1:
-                    sequence_.append(len(ALL_SYMBOLS)-1)
-            sequence = sequence_
-
+                symbol_id = self.symbol_to_id.get(phone)
+                if symbol_id is not None:
+                    sequence.append(symbol_id)
+                # else:
+                #     if phone not in ["5"]:
+                #         self.TEMP_unhandled.append(f'{orig_text}: {phone}')
+
+        sequence = self.intersperse_blank(sequence)
         cleaned_text = "|".join([ALL_SYMBOLS[index] for index in sequence])
 
         return sequence, cleaned_text
@@ -1805,3 +1953,188 @@ def get_text_preprocessor(code, base_dir, override_useAnyG2P=None):
         tp.load_g2p_cache(tp_codes[code]["g2p_cache"][0])
 
     return tp
+
+
+def check_dict_replace (base_dir, num_sentences=300, seed=1234):
+    """Golden output check of the single-pass dict_replace() against the original word by word dict_replace_reference(),
+    over each language's sample sentence, and random sentences made from its dicts' words (with punctuation, casing,
+    curly brace ARPAbet, hyphens, apostrophes, brackets and non-dict words mixed in)"""
+    import time
+    import random
+    rng = random.Random(seed)
+
+    sample_sentences = {}
+    if os.path.exists(f'{base_dir}/../viz_sentences.json'):
+        with codecs.open(f'{base_dir}/../viz_sentences.json', encoding="utf8") as f:
+            sample_sentences = json.load(f)
+
+    codes = ["am", "ar", "da", "de", "el", "en", "es", "fi", "fr", "ha", "hi", "hu", "it", "jp", "ko", "la", "mn", "nl", "pl", "pt", "ro", "ru", "sv", "sw", "th", "tr", "uk", "vi", "wo", "yo", "zh"]
+    for code in codes:
+        try:
+            tp = get_text_preprocessor(code, base_dir, override_useAnyG2P=False)
+        except FileNotFoundError as e:
+            print(f'[{code}] Skipped, missing: {e.filename}')
+            continue
+        if code=="en":
+            tp.load_dict(f'{base_dir}/dicts/xvadict-elder_scrolls.json', isCustom=True)
+        if not len(tp.dicts):
+            continue
+
+        dict_words = [word for words in tp.dict_words for word in words]
+        fillers = ["xqz", "Blorp", "the", "a", "{AH0 B}", "{HH AH0 L OW1}", "-", "'", "(", ")", "...", "1984"]
+        puncs = ["", "", "", ",", ".", "!", "?", ";", "...", ":"]
+        sentences = [sample_sentences[code]] if code in sample_sentences.keys() else []
+        for _ in range(num_sentences):
+            words = []
+            for _ in range(rng.randint(1, 14)):
+                word = rng.choice(dict_words) if rng.random()<0.7 else rng.choice(fillers)
+                word = rng.choice([word, word, word.upper(), word.capitalize()])
+                if rng.random()<0.1:
+                    word = rng.choice(["(", "'", "\"", "{", ""]) + word + rng.choice([")", "'", "\"", "}", "-"+rng.choice(dict_words)])
+                words.append(word+rng.choice(puncs))
+            sentences.append(" ".join(words))
+
+        reference_time = 0
+        start = time.time()
+        outputs = [tp.dict_replace(tp.dict_replace(sentence, customDicts=True), customDicts=False) for sentence in sentences]
+        new_time = time.time()-start
+        for sentence, output in zip(sentences, outputs):
+            start = time.time()
+            reference = tp.dict_replace_reference(tp.dict_replace_reference(sentence, customDicts=True), customDicts=False)
+            reference_time += time.time()-start
+            assert output==reference, f'[{code}] "{sentence}":\n"{output}"\nvs\n"{reference}"'
+        print(f'[{code}] {len(sentences)} sentences match | word by word: {int(len(sentences)/reference_time)} sentences/s | single-pass: {int(len(sentences)/new_time)} sentences/s')
+
+
+def separate_arpabet_punct_reference (text):
+    for punct in [".", "!", "?", ",", "\"", "'", "-", ")"]:
+        text = text.replace("}"+punct, "} "+punct)
+    for punct in [".", "!", "?", ",", "\"", "'", "-", "("]:
+        text = text.replace(punct+"{", punct+" {")
+    return text
+
+def text_to_sequence_reference (tp, text):
+    """The original text_to_sequence, with the ALL_SYMBOLS.index() look-ups, for check_text_to_sequence"""
+    if isinstance(tp, ChineseTextPreprocessor):
+        text = tp.collapse_whitespace(text)
+        text = text.replace("！", "!").replace("？", "?").replace("，", ",").replace("。", ",").replace("…", "...").replace("）", "").replace("（", "")\
+            .replace("、", ",").replace("“", ",").replace("”", ",").replace("：", ":")
+        text = tp.text_to_phonemes(text)
+        phonemes = tp.collapse_whitespace(text).strip().split(" ")
+        sequence = []
+        for phone in phonemes:
+            phone = phone.replace(":","").strip()
+            if len(phone):
+                try:
+                    sequence.append(ALL_SYMBOLS.index(phone))
+                except:
+                    if phone in pinyin_to_arpabet_mappings.keys():
+                        sequence.append(ALL_SYMBOLS.index(pinyin_to_arpabet_mappings[phone]))
+        blank_id = len(ALL_SYMBOLS)-1
+    else:
+        if isinstance(tp, EnglishTextPreprocessor):
+            text = unidecode(text)
+        text = separate_arpabet_punct_reference(text)
+        text = tp.text_to_phonemes(text)
+        text = tp.collapse_whitespace(text).strip()
+        phonemes = [manual_phone_replacements[phone] if phone in manual_phone_replacements.keys() else phone for phone in text.split(" ")]
+        sequence = []
+        for phone in phonemes:
+            if phone=="#":
+                break
+            if len(phone.strip()):
+                sequence.append(ALL_SYMBOLS.index(phone))
+        blank_id = len(ALL_SYMBOLS)-2
+
+    if tp.add_blank:
+        sequence_ = []
+        for si,symb in enumerate(sequence):
+            sequence_.append(symb)
+            if si<len(sequence)-1:
+                sequence_.append(blank_id)
+        sequence = sequence_
+    return sequence, "|".join([ALL_SYMBOLS[index] for index in sequence])
+
+def check_text_to_sequence (base_dir, num_sentences=300, num_repeats=3, batch_size=32, seed=1234):
+    """Golden output check of text_to_sequence() (symbol_to_id look-ups, and the memo) and texts_to_padded_sequences()
+    against the original ALL_SYMBOLS.index() text_to_sequence_reference(), over every language's sample sentence, and
+    random sentences of dict words, ARPAbet and punctuation, plus a throughput benchmark"""
+    import time
+    import random
+    import torch # Imported by texts_to_padded_sequences, not to be timed
+    rng = random.Random(seed)
+
+    # The one-pass ARPAbet/punctuation separation
+    chars = [".", "!", "?", ",", "\"", "'", "-", "(", ")", "{", "}", " ", "a"]
+    for _ in range(20000):
+        text = "".join([rng.choice(chars) for _ in range(rng.randint(0, 12))])
+        assert ARPABET_OPEN_PUNCT_RE.sub(r'\1 {', ARPABET_CLOSE_PUNCT_RE.sub(r'} \1', text))==separate_arpabet_punct_reference(text), text
+
+    sample_sentences = {}
+    if os.path.exists(f'{base_dir}/../viz_sentences.json'):
+        with codecs.open(f'{base_dir}/../viz_sentences.json', encoding="utf8") as f:
+            sample_sentences = json.load(f)
+
+    arpabet = [symbol for symbol in ALL_SYMBOLS[:ALL_SYMBOLS.index("<PAD>")] if symbol.replace("_", "").isalnum()] + list(manual_phone_replacements.keys())
+    puncs = ["", "", "", ",", ".", "!", "?", "...", "，", "。", "！"]
+
+    def run (fn, text):
+        try:
+            return fn(text)
+        except ValueError:
+            return "ValueError"
+
+    codes = ["am", "ar", "da", "de", "el", "en", "es", "fi", "fr", "ha", "hi", "hu", "it", "jp", "ko", "la", "mn", "nl", "pl", "pt", "ro", "ru", "sv", "sw", "th", "tr", "uk", "vi", "wo", "yo", "zh"]
+    for code in codes:
+        try:
+            tp = get_text_preprocessor(code, base_dir, override_useAnyG2P=False)
+        except FileNotFoundError as e:
+            print(f'[{code}] Skipped, missing: {e.filename}')
+            continue
+        tp.g2p_cache_store = None # Don't save the random sentences' g2p outputs to the cache files
+
+        dict_words = [word for words in tp.dict_words for word in words]
+        sentences = [sample_sentences[code]] if code in sample_sentences.keys() else []
+        for _ in range(num_sentences):
+            words = []
+            for _ in range(rng.randint(1, 14)):
+                if len(dict_words) and rng.random()<0.6:
+                    word = rng.choice(dict_words)
+                else:
+                    word = "{"+" ".join([rng.choice(arpabet) for _ in range(rng.randint(1, 5))])+"}"
+                words.append(word+rng.choice(puncs))
+            sentences.append(" ".join(words))
+
+        start = time.time()
+        references = [run(lambda text: text_to_sequence_reference(tp, text), sentence) for sentence in sentences]
+        reference_time = time.time()-start
+        start = time.time()
+        outputs = [run(tp.text_to_sequence, sentence) for sentence in sentences]
+        new_time = time.time()-start
+        for sentence, output, reference in zip(sentences, outputs, references):
+            assert output==reference, f'[{code}] "{sentence}":\n{output}\nvs\n{reference}'
+
+        # Repeated lines, from the memo
+        start = time.time()
+        for _ in range(num_repeats):
+            for sentence, reference in zip(sentences, references):
+                assert run(tp.text_to_sequence, sentence)==reference
+        memo_time = (time.time()-start)/num_repeats
+
+        # Batches of padded id tensors
+        valid = [(sentence, reference) for sentence, reference in zip(sentences, references) if reference!="ValueError"]
+        start = time.time()
+        for bi in range(0, len(valid), batch_size):
+            batch = valid[bi:bi+batch_size]
+            padded, lengths, cleaned_texts = tp.texts_to_padded_sequences([sentence for sentence, _ in batch])
+            for row, length, cleaned_text, (_, reference) in zip(padded.tolist(), lengths.tolist(), cleaned_texts, batch):
+                assert row[:length]==reference[0] and cleaned_text==reference[1] and not any(row[length:])
+        batch_time = time.time()-start
+
+        print(f'[{code}] {len(sentences)} sentences match ({len(sentences)-len(valid)} errors) | original: {int(len(sentences)/reference_time)} lines/s | symbol_to_id: {int(len(sentences)/new_time)} lines/s | memoized: {int(len(sentences)/memo_time)} lines/s | padded batches of {batch_size}: {int(len(valid)/max(batch_time, 1e-6))} lines/s')
+
+
+if __name__ == '__main__':
+    # python text_preprocessing.py
+    check_dict_replace(os.path.dirname(os.path.abspath(__file__)))
+    check_text_to_sequence(os.path.dirname(os.path.abspath(__file__)))
@@ -1,3 +1,10 @@
+import os
+import time
+import queue
+import traceback
+import threading
+from contextlib import contextmanager
+
 import torch
 from itertools import chain
 
@@ -87,4 +94,235 @@ def format_time (seconds):
     if seconds>0:
         time_str += f'{int(seconds)}s '
 
-    return time_str
\ No newline at end of file
+    return time_str
+
+
+
+class DevicePrefetcher(object):
+    """Double-buffered batch prefetching onto the training device.
+
+    A background thread pulls the next batch from the dataloader, formats it, and copies it to the device (on a side
+    CUDA stream, when training on a GPU) while the current step is running. One staged batch is kept ahead, so that
+    the trainer can alternate between several prefetchers (finetune/priors) and always find its next batch ready.
+    Raises StopIteration at the end of the dataloader's epoch, like a normal iterator.
+
+    Args:
+        loader (DataLoader): Loader to iterate over (once).
+        device (torch.device): Device to stage the batches on.
+        format_fn (callable): Applied to each raw batch before the copy (eg model.format_batch).
+    """
+    def __init__(self, loader, device, format_fn=None):
+        self.device = device
+        self.format_fn = format_fn
+        self.iterator = iter(loader)
+        self.stream = torch.cuda.Stream(device) if device.type=="cuda" else None
+        self.queue = queue.Queue(maxsize=1)
+        self.stopped = False
+        self.last_wait_time = 0 # Seconds the last __next__ spent blocked on data
+        self.last_copy_timing = 0 # Host to device copy time of the last batch: seconds, or a (start, end) pair of CUDA events
+
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def stage(self, raw_batch):
+        batch = self.format_fn(raw_batch) if self.format_fn is not None else raw_batch
+        if "cache_stats" in raw_batch.keys():
+            batch["cache_stats"] = raw_batch["cache_stats"]
+
+        event = None
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                start_event = torch.cuda.Event(enable_timing=True)
+                start_event.record(self.stream)
+                for k, v in batch.items():
+                    if torch.is_tensor(v):
+                        batch[k] = v.to(self.device, non_blocking=True)
+                event = torch.cuda.Event(enable_timing=True)
+                event.record(self.stream)
+            copy_timing = (start_event, event)
+        else:
+            start = time.time()
+            for k, v in batch.items():
+                if torch.is_tensor(v):
+                    batch[k] = v.to(self.device)
+            copy_timing = time.time() - start
+        return batch, event, copy_timing
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def worker(self):
+        try:
+            for raw_batch in self.iterator:
+                if self.stopped:
+                    return
+                self.put(self.stage(raw_batch))
+            self.put(StopIteration())
+        except BaseException as e:
+            self.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        item = self.queue.get()
+        self.last_wait_time = time.time() - start
+
+        if isinstance(item, StopIteration):
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+
+        batch, event, self.last_copy_timing = item
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # Let the caching allocator know these (side stream allocated) tensors are now in use on the main stream
+            for v in batch.values():
+                if torch.is_tensor(v):
+                    v.record_stream(current_stream)
+        return batch
+
+    def stop(self):
+        self.stopped = True
+
+
+class StepProfiler(object):
+    """Per-phase timings of the training steps (data wait, H2D copy, forward/backward passes, optimizer, checkpoint I/O).
+
+    GPU phases are timed with CUDA events, which are only resolved (synchronized) when the averages are read, so the
+    profiling doesn't add a sync point to every phase. CPU-side phases (waiting on data, disk I/O) use wall time.
+    """
+    PHASES = ["data_wait", "h2d_copy", "gen_forward", "gen_backward", "disc_forward", "disc_backward", "optimizer_step", "checkpoint_io", "sample_output"]
+
+    def __init__(self, device, enabled=True):
+        self.use_cuda = device.type=="cuda"
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.totals = {phase: 0.0 for phase in self.PHASES}
+        self.pending_events = []
+        self.num_steps = 0
+
+    @contextmanager
+    def phase(self, name, wall=False):
+        if not self.enabled:
+            yield
+        elif self.use_cuda and not wall:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+            yield
+            end_event.record()
+            self.pending_events.append((name, start_event, end_event))
+        else:
+            start = time.time()
+            yield
+            self.add(name, time.time()-start)
+
+    def add(self, name, timing):
+        # timing - either seconds, or a (start, end) pair of CUDA events
+        if not self.enabled:
+            return
+        if isinstance(timing, tuple):
+            self.pending_events.append((name, timing[0], timing[1]))
+        else:
+            self.totals[name] = self.totals.get(name, 0.0) + timing
+
+    def step(self):
+        self.num_steps += 1
+
+    def get_averages(self):
+        """Average milliseconds per (optimizer) step, for each phase"""
+        for name, start_event, end_event in self.pending_events:
+            end_event.synchronize()
+            self.totals[name] = self.totals.get(name, 0.0) + start_event.elapsed_time(end_event)/1000
+        self.pending_events = []
+        return {name: round(total/max(1, self.num_steps)*1000, 2) for name, total in self.totals.items()}
+
+
+def snapshot_to_cpu (obj, half=False):
+    """Recursively copies the tensors in a (state dict) structure to the CPU, detached from the live ones. With half=True,
+    floating point tensors are also converted to fp16 (on the copy, not the live model)"""
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        if half and obj.is_floating_point():
+            return obj.to("cpu", dtype=torch.float16, copy=True)
+        return obj.to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((key, snapshot_to_cpu(val, half)) for key, val in obj.items())
+    if isinstance(obj, list):
+        return [snapshot_to_cpu(val, half) for val in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot_to_cpu(val, half) for val in obj)
+    return obj
+
+
+def torch_save_atomic (obj, fpath):
+    # Write to a temp file first, so that a crash mid-write never leaves a truncated checkpoint behind
+    # The temp file name doesn't start with the final file's prefix, so it's never picked up as a checkpoint
+    fpath_dir, fname = os.path.split(fpath)
+    tmp_fpath = os.path.join(fpath_dir, f'.tmp_{fname}')
+    try:
+        torch.save(obj, tmp_fpath)
+    except:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+    os.replace(tmp_fpath, fpath)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints (already snapshotted to the CPU) to disk on a background thread, so that training can carry on
+    during the disk I/O. At most max_pending jobs wait behind the one being written; submitting more blocks until there is
+    space, to bound the RAM used by the snapshots.
+
+    The writer thread isn't a daemon thread, so pending writes still complete if the training thread exits.
+    """
+    def __init__(self, max_pending=1):
+        super(CheckpointWriter, self).__init__()
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.errors = []
+
+    def submit (self, saves, before_fn=None):
+        # saves - a list of [obj, fpath] to torch.save. before_fn - run on the writer thread first (eg deleting old checkpoints)
+        self.jobs.put([saves, before_fn])
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.worker)
+                self.thread.start()
+
+    def worker (self):
+        while True:
+            with self.lock:
+                try:
+                    saves, before_fn = self.jobs.get_nowait()
+                except queue.Empty:
+                    # Exit while idle. Checked under the lock, so that submit() starts a new thread if needed
+                    self.thread = None
+                    return
+            try:
+                if before_fn is not None:
+                    before_fn()
+                for obj, fpath in saves:
+                    torch_save_atomic(obj, fpath)
+            except:
+                err_msg = traceback.format_exc()
+                print(f'Checkpoint writing failed: {err_msg}')
+                self.errors.append(err_msg)
+            finally:
+                del saves
+                self.jobs.task_done()
+
+    def wait (self):
+        """Blocks until all the submitted checkpoints are written"""
+        self.jobs.join()
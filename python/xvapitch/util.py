@@ -401,13 +401,135 @@ from typing import Dict, List, Tuple
 
 from torch.utils.data.sampler import WeightedRandomSampler
 def get_language_weighted_sampler(items: list):
+    dataset_samples_weight = get_language_weights(items)
+    return WeightedRandomSampler(dataset_samples_weight, len(dataset_samples_weight))
+
+def get_language_weights(items: list):
     language_names = np.array([item[3] for item in items])
     unique_language_names = np.unique(language_names).tolist()
     language_ids = [unique_language_names.index(l) for l in language_names]
     language_count = np.array([len(np.where(language_names == l)[0]) for l in unique_language_names])
     weight_language = 1.0 / language_count
-    dataset_samples_weight = torch.from_numpy(np.array([weight_language[l] for l in language_ids])).double()
-    return WeightedRandomSampler(dataset_samples_weight, len(dataset_samples_weight))
+    return torch.from_numpy(np.array([weight_language[l] for l in language_ids])).double()
+
+from torch.utils.data.sampler import Sampler
+class BucketedBatchSampler(Sampler):
+    """Batch sampler grouping utterances of similar mel length, to reduce the padding in each batch.
+
+    Each epoch, the sample indices are drawn (with per-language weighting, same as get_language_weighted_sampler, or
+    a plain shuffle, or in dataset order), split into large buckets, and each bucket sorted by length before being cut into batches. Batches
+    have either a fixed batch_size, or (if max_frames is set) as many items as fit into max_frames padded mel frames.
+
+    Args:
+        dataset (TTSDataset): Dataset to sample from. Its items/lengths are re-read every epoch, as the loss sorting changes them.
+        batch_size (int): Number of items per batch, when not using a frame budget.
+        max_frames (int): Padded mel frames budget per batch (B x max_len). Disabled when 0.
+        language_weighted (bool): Draw indices with per-language weighting, instead of a shuffled pass over the items.
+        bucket_size_mult (int): How many batches' worth of items to sort together in each bucket.
+        drop_last (bool): Drop the last incomplete batch of each bucket (fixed batch_size mode only).
+        shuffle (bool): Shuffle the items and batches. When False (and not language_weighted), the buckets follow the
+            dataset order (eg the loss sorted fine-tune items), and the batches are yielded bucket by bucket.
+    """
+    def __init__(self, dataset, batch_size, max_frames=0, language_weighted=True, bucket_size_mult=50, drop_last=False, shuffle=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.max_frames = max_frames
+        self.language_weighted = language_weighted
+        self.bucket_size_mult = bucket_size_mult
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.num_batches = None
+
+    def get_batches(self):
+        lengths = np.array(self.dataset.get_item_lengths())
+        num_items = len(lengths)
+
+        if self.language_weighted:
+            weights = get_language_weights(self.dataset.items)
+            indices = torch.multinomial(weights, num_items, replacement=True).numpy()
+        elif self.shuffle:
+            indices = np.random.permutation(num_items)
+        else:
+            indices = np.arange(num_items)
+
+        batches = []
+        bucket_size = max(1, self.batch_size * self.bucket_size_mult)
+        for bucket_start in range(0, num_items, bucket_size):
+            bucket = indices[bucket_start:bucket_start+bucket_size]
+            bucket = bucket[np.argsort(lengths[bucket], kind="stable")]
+
+            if self.max_frames:
+                batch = []
+                for idx in bucket:
+                    # Items are sorted ascending, so the current item is always the longest in the batch
+                    if len(batch) and (len(batch)+1) * lengths[idx] > self.max_frames:
+                        batches.append(batch)
+                        batch = []
+                    batch.append(int(idx))
+                if len(batch):
+                    batches.append(batch)
+            else:
+                for batch_start in range(0, len(bucket), self.batch_size):
+                    batch = [int(idx) for idx in bucket[batch_start:batch_start+self.batch_size]]
+                    if len(batch) < self.batch_size and self.drop_last:
+                        continue
+                    batches.append(batch)
+
+        if self.shuffle:
+            random.shuffle(batches)
+        self.num_batches = len(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        if self.num_batches is None:
+            self.get_batches()
+        return self.num_batches
+
+
+def check_bucketed_sampler (num_items=1000, batch_size=16, seed=1234):
+    """Deterministic checks of the BucketedBatchSampler batches, against the plain DataLoader batching it replaces: the
+    same items covered (each exactly once, when not language weighted), full batches with drop_last, the frame budget
+    kept, the dataset order kept without shuffling, and the same number of batches as len() reports"""
+    import argparse
+    from torch.utils.data import BatchSampler, SequentialSampler
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    lengths = [int(length) for length in rng.randint(50, 900, size=num_items)]
+    dataset = argparse.Namespace(items=[["text", f'wavs/{i}.wav', "speaker", ["en", "de", "fr"][i%3]] for i in range(num_items)], get_item_lengths=lambda: lengths)
+    plain_batches = list(BatchSampler(SequentialSampler(range(num_items)), batch_size, drop_last=False))
+
+    for shuffle in [True, False]:
+        batches = BucketedBatchSampler(dataset, batch_size, language_weighted=False, shuffle=shuffle).get_batches()
+        assert sorted([idx for batch in batches for idx in batch])==list(range(num_items))
+        assert len(batches)>=len(plain_batches) and all([len(batch)<=batch_size for batch in batches])
+
+    # Without shuffling, each bucket holds the next items in the dataset order, and its batches follow each other
+    bucket_size = batch_size*50
+    batches = BucketedBatchSampler(dataset, batch_size, language_weighted=False, shuffle=False).get_batches()
+    flat = [idx for batch in batches for idx in batch]
+    for bucket_start in range(0, num_items, bucket_size):
+        bucket = flat[bucket_start:bucket_start+bucket_size]
+        assert sorted(bucket)==list(range(bucket_start, min(num_items, bucket_start+bucket_size)))
+        assert [lengths[idx] for idx in bucket]==sorted([lengths[idx] for idx in bucket])
+    assert batches==BucketedBatchSampler(dataset, batch_size, language_weighted=False, shuffle=False).get_batches()
+
+    sampler = BucketedBatchSampler(dataset, batch_size, language_weighted=True, drop_last=True)
+    batches = sampler.get_batches()
+    assert all([len(batch)==batch_size for batch in batches]) and len(batches)==len(sampler)
+
+    max_frames = 4000
+    sampler = BucketedBatchSampler(dataset, batch_size, max_frames=max_frames, language_weighted=False)
+    batches = sampler.get_batches()
+    assert sorted([idx for batch in batches for idx in batch])==list(range(num_items))
+    assert all([len(batch)==1 or len(batch)*max([lengths[idx] for idx in batch])<=max_frames for batch in batches])
+    assert len(sampler)==len(batches)
+    print("Bucketed batches cover the dataset like the plain batching")
 
 
 
@@ -881,4 +1003,9 @@ def format_time (seconds):
     if seconds>0:
         time_str += f'{int(seconds)}s '
 
-    return time_str
\ No newline at end of file
+    return time_str
+
+
+
+if __name__ == '__main__':
+    check_bucketed_sampler()
@@ -3,6 +3,7 @@ os.environ['FOR_DISABLE_CONSOLE_CTRL_HANDLER'] = '1'
 os.environ['OPENBLAS_NUM_THREADS'] = '1'
 os.environ["NUM_THREADS"] = "1"
 os.environ["OMP_NUM_THREADS"] = "1"
+import copy
 import json
 import argparse
 import traceback
@@ -39,29 +40,32 @@ if __name__ == '__main__':
 try:
     sys.path.append(".")
     from resources.app.python.xvapitch.model import xVAPitch
-    from resources.app.python.xvapitch.util import get_language_weighted_sampler
+    from resources.app.python.xvapitch.util import get_language_weighted_sampler, BucketedBatchSampler
     from resources.app.python.xvapitch.losses import VitsDiscriminatorLoss, VitsGeneratorLoss
     from resources.app.python.xvapitch.dataset import TTSDataset, read_datasets, pre_cache_g2p
     from resources.app.python.xvapitch.get_dataset_emb import get_emb
-    from resources.app.python.xvapitch.training_util import make_optim, get_scheduler, format_time
-    from resources.app.python.xvapitch.text import get_text_preprocessor, lang_names
+    from resources.app.python.xvapitch.training_util import make_optim, get_scheduler, format_time, DevicePrefetcher, StepProfiler, CheckpointWriter, snapshot_to_cpu
+    from resources.app.python.xvapitch.sample_cache import merge_cache_stats, format_cache_stats
+    from resources.app.python.xvapitch.text import get_text_preprocessor, lang_names, pad_sequences
 except:
     try:
         from python.xvapitch.model import xVAPitch
-        from python.xvapitch.util import get_language_weighted_sampler
+        from python.xvapitch.util import get_language_weighted_sampler, BucketedBatchSampler
         from python.xvapitch.losses import VitsDiscriminatorLoss, VitsGeneratorLoss
         from python.xvapitch.dataset import TTSDataset, read_datasets, pre_cache_g2p
         from python.xvapitch.get_dataset_emb import get_emb
-        from python.xvapitch.training_util import make_optim, get_scheduler, format_time
-        from python.xvapitch.text import get_text_preprocessor, lang_names
+        from python.xvapitch.training_util import make_optim, get_scheduler, format_time, DevicePrefetcher, StepProfiler, CheckpointWriter, snapshot_to_cpu
+        from python.xvapitch.sample_cache import merge_cache_stats, format_cache_stats
+        from python.xvapitch.text import get_text_preprocessor, lang_names, pad_sequences
     except:
         from model import xVAPitch
-        from util import get_language_weighted_sampler
+        from util import get_language_weighted_sampler, BucketedBatchSampler
         from losses import VitsDiscriminatorLoss, VitsGeneratorLoss
         from dataset import TTSDataset, read_datasets, pre_cache_g2p
         from get_dataset_emb import get_emb
-        from training_util import make_optim, get_scheduler, format_time
-        from text import get_text_preprocessor, lang_names
+        from training_util import make_optim, get_scheduler, format_time, DevicePrefetcher, StepProfiler, CheckpointWriter, snapshot_to_cpu
+        from sample_cache import merge_cache_stats, format_cache_stats
+        from text import get_text_preprocessor, lang_names, pad_sequences
 
     # from python.xvapitch.fastpitch.model import FastPitch
     # from python.xvapitch.common.text import text_to_sequence
@@ -142,6 +146,11 @@ async def handleTrainer (models_manager, data, websocket, gpus, resume=False):
         running = trainer.running
         trainer.running = False
 
+        try:
+            trainer.priors_iterator.stop()
+            trainer.finetune_iterator.stop()
+        except:
+            pass
         try:
             del trainer.train_loader
         except:
@@ -436,15 +445,26 @@ class xVAPitchTrainer(object):
         torch.cuda.synchronize()
 
         self.print_and_log(f'Starting training.')
-        self.priors_iterator = iter(self.train_loader)
-        self.finetune_iterator = iter(self.finetune_loader)
+        self.priors_iterator = DevicePrefetcher(self.train_loader, self.device, format_fn=self.model.format_batch)
+        self.finetune_iterator = DevicePrefetcher(self.finetune_loader, self.device, format_fn=self.model.format_batch)
         self.ckpt_start_time = None
         self.step_start_time = None
         self.accumulated_steps = 0
         self.gam_num_frames = 0
+        self.gam_padded_frames = 0
+        self.gam_data_wait_time = 0
         self.finetune_counter = 0
         self.training_iters = 0
         self.do_samples_output = False
+        self.cache_stats = {"finetune": {}, "priors": {}} # Latest sample cache stats, per dataloader worker
+        self.profiler = StepProfiler(self.device, enabled=bool(self.args.profile))
+        self.checkpoint_writer = CheckpointWriter()
+        self.last_profile = None # Latest per-phase step timings (ms), for graphs.json
+
+        # Run, in order, after every optimizer step, with that step's info. Each is an async fn(step_info)
+        self.step_hooks = [self.log_step, self.checkpoint_step, self.print_step]
+        # Run after every iteration, once the step's batch and losses are freed from VRAM. Each is an async fn()
+        self.post_step_hooks = [self.samples_output_step]
         self.start_new_epoch()
 
         if self.websocket:
@@ -558,12 +578,8 @@ class xVAPitchTrainer(object):
             except KeyboardInterrupt:
                 raise
             except:
-                err_msg = traceback.format_exc()
-                if "recursion depth" in err_msg:
-                    continue
-                else:
-                    print(err_msg)
-                    raise
+                print(traceback.format_exc())
+                raise
 
 
     def pause (self, websocket=None):
@@ -585,6 +601,8 @@ class xVAPitchTrainer(object):
             "loss_duration": [],
             "loss_disc": [],
             "frames_per_second": [],
+            "padding_efficiency": [],
+            "data_wait_time": [],
         }
 
         self.steps_since_log = 0
@@ -599,12 +617,46 @@ class xVAPitchTrainer(object):
 
 
     async def iteration(self):
+        """A single training iteration (micro-batch). Every gam iterations, the optimizers are stepped, and the step hooks run"""
 
         if not self.is_init:
             await self.init()
 
+        batch = self.next_batch()
+
+        if self.ckpt_start_time is None:
+            self.ckpt_start_time = time.time()
+        if self.step_start_time is None:
+            self.step_start_time = time.time()
+
+        loss_dict = self.train_step(batch)
+        del batch
+
+        self.accumulated_steps += 1
+        if self.accumulated_steps%self.gam==0:
+            self.accumulated_steps = 0
+
+            self.optimizer_step()
+            step_info = self.finish_step(loss_dict)
+            del loss_dict
+
+            for hook in self.step_hooks:
+                await hook(step_info)
+
+            self.finetune_counter += 1
+            self.finetune_it = True
+            if self.finetune_counter>=self.FINETUNE_WEIGHT:
+                self.finetune_it = False
+                self.finetune_counter = 0
+            self.total_steps_done += self.gam
+        else:
+            del loss_dict
+
+        for hook in self.post_step_hooks:
+            await hook()
 
 
+    def next_batch (self):
         # Sample the next data point, either from the finetune dataset, or the priors dataset
         # If either of the dataloaders have reached the end, re-init them
         try:
@@ -622,50 +674,54 @@ class xVAPitchTrainer(object):
             self.epoch += 1
 
             if self.finetune_it:
-                self.finetune_iterator = iter(self.finetune_loader)
+                self.finetune_iterator = DevicePrefetcher(self.finetune_loader, self.device, format_fn=self.model.format_batch)
             else:
-                self.priors_iterator = iter(self.train_loader)
+                self.priors_iterator = DevicePrefetcher(self.train_loader, self.device, format_fn=self.model.format_batch)
             batch = next(self.finetune_iterator if self.finetune_it else self.priors_iterator)
         self.epoch_steps += 1
 
+        iterator = self.finetune_iterator if self.finetune_it else self.priors_iterator
+        self.gam_data_wait_time += iterator.last_wait_time
+        self.profiler.add("data_wait", iterator.last_wait_time)
+        self.profiler.add("h2d_copy", iterator.last_copy_timing)
 
-        if self.ckpt_start_time is None:
-            self.ckpt_start_time = time.time()
-        if self.step_start_time is None:
-            self.step_start_time = time.time()
+        if batch["cache_stats"] is not None:
+            self.cache_stats["finetune" if self.finetune_it else "priors"][batch["cache_stats"]["worker_id"]] = batch["cache_stats"]
+        return batch
 
 
-        # Format data
+    def train_step (self, batch):
+        # Forward + backward passes of the generator (idx 0), then the discriminator (idx 1). Returns the detached losses
+        # The batch comes already formatted and on the device, from the DevicePrefetcher
+        # (no .contiguous(), to keep the linear spectrogram's B x D x T memory layout)
         loss_dict = {}
-        batch = self.model.format_batch(batch)
-        for k, v in batch.items():
-            if torch.is_tensor(v):
-                batch[k] = v.contiguous().to(self.device, non_blocking=True)
 
         num_frames = torch.sum(batch["mel_lengths"])
         self.gam_num_frames += num_frames
+        self.gam_padded_frames += batch["mel_lengths"].shape[0] * torch.max(batch["mel_lengths"])
 
         y_disc_cache = None
         wav_seg_disc_cache = None
-        # last_loss = None
 
         for idx in range(2):
+            phase_name = "gen" if idx==0 else "disc"
 
             optimizer = self.optimizer[idx]
             optimizer.zero_grad()
 
             # Forward pass and loss computation
-            with torch.cuda.amp.autocast(enabled=self.amp):
-                outputs, loss_dict_it = self.model(batch, idx, y_disc_cache, wav_seg_disc_cache)
+            with self.profiler.phase(f'{phase_name}_forward'):
+                with torch.cuda.amp.autocast(enabled=self.amp):
+                    outputs, loss_dict_it = self.model(batch, idx, y_disc_cache, wav_seg_disc_cache)
 
-                # compute losses
-                if idx==0:
-                    y_disc_cache = outputs["model_outputs"].detach()
-                    wav_seg_disc_cache = outputs["waveform_seg"]
-                else:
-                    del y_disc_cache, wav_seg_disc_cache
-                    y_disc_cache, wav_seg_disc_cache = None, None
-                del outputs
+                    # compute losses
+                    if idx==0:
+                        y_disc_cache = outputs["model_outputs"].detach()
+                        wav_seg_disc_cache = outputs["waveform_seg"]
+                    else:
+                        del y_disc_cache, wav_seg_disc_cache
+                        y_disc_cache, wav_seg_disc_cache = None, None
+                    del outputs
 
             if idx==0 and self.do_loss_sorting and self.finetune_it:
                 for di in range(len(batch["wav_file_name"])):
@@ -673,15 +729,15 @@ class xVAPitchTrainer(object):
                     if fname_item not in self.loss_sampling_dict.keys():
                         self.loss_sampling_dict[fname_item] = loss_dict_it["per_sample_kl_loss"][di].item() + loss_dict_it["per_sample_pitch_loss"][di].item() + loss_dict_it["per_sample_mel_loss"][di].item()
 
-            # optimizer step
-            if self.amp:
-                last_loss = loss_dict_it["loss"].mean()
-                self.scaler.scale(last_loss).backward()
-                last_loss = last_loss.item()
-            else:
-                last_loss = loss_dict_it["loss"].mean()
-                last_loss.backward()
-            del last_loss
+            with self.profiler.phase(f'{phase_name}_backward'):
+                if self.amp:
+                    last_loss = loss_dict_it["loss"].mean()
+                    self.scaler.scale(last_loss).backward()
+                    last_loss = last_loss.item()
+                else:
+                    last_loss = loss_dict_it["loss"].mean()
+                    last_loss.backward()
+                del last_loss
 
             loss_dict_it["loss"] = loss_dict_it["loss"].mean().item()
 
@@ -717,11 +773,11 @@ class xVAPitchTrainer(object):
 
                 self.loss_analysis_dict[dataset_name][wav_file_name] = [per_sample_kl_loss, per_sample_mel_loss]
 
+        return loss_dict
 
-        self.accumulated_steps += 1
-        if self.accumulated_steps%self.gam==0:
 
-            self.accumulated_steps = 0
+    def optimizer_step (self):
+        with self.profiler.phase("optimizer_step"):
             if self.model.training_stage=="1" or not self.finetune_it: # Don't train the vocoder and posterior when doing priors enforcement
                 self.model.posterior_encoder.zero_grad()
                 self.model.waveform_decoder.zero_grad()
@@ -735,172 +791,192 @@ class xVAPitchTrainer(object):
                 else:
                     optimizer.step()
 
-            step_time = time.time() - self.step_start_time
-            self.step_start_time = time.time()
 
-            self.keep_avg_train["step_time"].append(step_time)
-            self.keep_avg_train["loss"].append(loss_dict["loss"])
-            self.keep_avg_train["loss_gen"].append(loss_dict["loss_gen"])
-            self.keep_avg_train["loss_kl"].append(loss_dict["loss_kl"])
-            self.keep_avg_train["loss_feat"].append(loss_dict["loss_feat"])
-            self.keep_avg_train["loss_mel"].append(loss_dict["loss_mel"])
-            self.keep_avg_train["loss_duration"].append(loss_dict["loss_duration"])
-            self.keep_avg_train["loss_disc"].append(loss_dict["loss_disc"])
-            self.keep_avg_train["current_lr"] = self.optimizer[0].param_groups[0]["lr"]
-
-            frames_per_second = int(self.gam_num_frames / step_time)
-            self.gam_num_frames = 0
-            self.keep_avg_train["frames_per_second"].append(frames_per_second)
-
-            self.training_iters += 1
-            self.steps_since_log += 1
-            if self.steps_since_log >= 21:
-                self.steps_since_log = 0
-                avg_fps = round(np.mean(self.keep_avg_train["frames_per_second"]),4)
-                avg_loss = round(np.mean(self.keep_avg_train["loss"]),4)
-                avg_loss_kl = round(np.mean(self.keep_avg_train["loss_kl"][-10:]),4)
-                avg_loss_duration = round(np.mean(self.keep_avg_train["loss_duration"][-10:]),4)
-                avg_loss_mel = round(np.mean(self.keep_avg_train["loss_mel"][-10:]),4)
-
-                self.writer.add_scalar(f'loss/loss', avg_loss, self.total_steps_done)
-                self.writer.add_scalar(f'loss/kl', avg_loss_kl, self.total_steps_done)
-                self.writer.add_scalar(f'loss/duration', avg_loss_duration, self.total_steps_done)
-                self.writer.add_scalar(f'loss/mel', avg_loss_mel, self.total_steps_done)
-
-                self.writer.add_scalar(f'meta/frames/s', avg_fps, self.total_steps_done)
-                self.writer.add_scalar(f'meta/lrate', self.optimizer[0].param_groups[0]['lr'], self.total_steps_done)
-
-            loss_delta = 0
-            avg_loss = round(np.mean(self.keep_avg_train["loss"][-10:]),4)
-            frames_per_second = int(np.mean(self.keep_avg_train["frames_per_second"]))
-
-            self.graphs_json["stages"][str(self.model.training_stage)]["loss"].append([self.total_steps_done, avg_loss])
-            if (self.training_iters%self.save_step) % 10 == 0:
-                with open(f'{self.dataset_output}/graphs.json', "w+", encoding="utf8") as f:
-                    f.write(json.dumps(self.graphs_json))
-
-            if self.model.training_stage<=2 and len(self.avg_disc_loss_per_epoch[self.model.training_stage-1])>1:
-                adlpe = self.avg_disc_loss_per_epoch[self.model.training_stage-1] # Shorter variable name
-                self.avg_disc_loss_per_epoch_deltas[self.model.training_stage-1].append((adlpe[-2]-adlpe[-1])/adlpe[-2])
-                adlped = self.avg_disc_loss_per_epoch_deltas[self.model.training_stage-1] # Shorter variable name
-
-                ckpt_AVG_SPAN = 10
-                loss_delta = np.mean(adlped if len(adlped)<ckpt_AVG_SPAN else adlped[-ckpt_AVG_SPAN:])
-
-            if self.training_iters % self.save_step == 0 and self.training_iters != 0:
-
-                ckpt_time = time.time() - self.ckpt_start_time
-                ckpt_avg_loss_disc = np.mean(self.keep_avg_train["loss_disc"]) # Can't explain it - seems the best way to gauge an automatic stopping time
-                if self.model.training_stage<=2:
-                    self.avg_disc_loss_per_epoch[self.model.training_stage-1].append(ckpt_avg_loss_disc)
-
-                has_saved = False
-                if loss_delta:
-
-                    self.graphs_json["stages"][str(self.model.training_stage)]["loss_delta"].append([self.total_steps_done, round(loss_delta*100, 3)])
-                    with open(f'{self.dataset_output}/graphs.json', "w+", encoding="utf8") as f:
-                        f.write(json.dumps(self.graphs_json))
-
-
-                    # Early stopping
-                    if loss_delta < self.target_deltas[self.model.training_stage-1]:
-
-                        self.target_patience_count += 1
-                        if self.model.training_stage<3 and self.target_patience_count>=self.target_patience:
-
-                            output_path = os.path.join(self.dataset_output, f"xVAPitch_{self.total_steps_done}.pt")
-
-                            if self.model.training_stage==1:
-                                has_saved = True
-                                self.save_checkpoint(frames_s=frames_per_second, avg_loss=avg_loss, loss_delta=loss_delta, fpath=output_path, ckpt_time=ckpt_time, doPrintLog=True)
-                                self.print_and_log(f'Finished Stage 1. Moving on.. \n\n', save_to_file=self.dataset_output)
-                                self.print_and_log(f'\nStage 2: Full training', save_to_file=self.dataset_output)
-                                self.model.training_stage = 2
-                                self.target_patience_count = 0
-                                loss_delta = 0
-                                if self.websocket:
-                                    await self.websocket.send(f'Set stage to: {self.model.training_stage} ')
-
-                            elif self.model.training_stage==2:
-                                self.END_OF_TRAINING = True
-
-                                self.JUST_FINISHED_STAGE = True
-                                if self.logger:
-                                    self.logger.info("[Trainer] JUST_FINISHED_STAGE...")
-                                self.model.training_stage += 1
-
-                                has_saved = True
-                                self.save_checkpoint(frames_s=frames_per_second, avg_loss=avg_loss, loss_delta=loss_delta, fpath=output_path, ckpt_time=ckpt_time, doPrintLog=True)
-                                self.print_and_log(f'Finished Stage 2. Stopping training. \n\n', save_to_file=self.dataset_output)
-                                raise
-                    else:
-                        self.target_patience_count = 0
-                    # round(loss_delta*100, 3)
+    def finish_step (self, loss_dict):
+        # Book-keeping after an optimizer step. Returns the step info passed to the step hooks
+        step_time = time.time() - self.step_start_time
+        self.step_start_time = time.time()
+        self.profiler.step()
+
+        self.keep_avg_train["step_time"].append(step_time)
+        self.keep_avg_train["loss"].append(loss_dict["loss"])
+        self.keep_avg_train["loss_gen"].append(loss_dict["loss_gen"])
+        self.keep_avg_train["loss_kl"].append(loss_dict["loss_kl"])
+        self.keep_avg_train["loss_feat"].append(loss_dict["loss_feat"])
+        self.keep_avg_train["loss_mel"].append(loss_dict["loss_mel"])
+        self.keep_avg_train["loss_duration"].append(loss_dict["loss_duration"])
+        self.keep_avg_train["loss_disc"].append(loss_dict["loss_disc"])
+        self.keep_avg_train["current_lr"] = self.optimizer[0].param_groups[0]["lr"]
+
+        frames_per_second = int(self.gam_num_frames / step_time)
+        self.keep_avg_train["padding_efficiency"].append(float(self.gam_num_frames / max(1, self.gam_padded_frames))) # Real/padded mel frames
+        self.gam_num_frames = 0
+        self.gam_padded_frames = 0
+        self.keep_avg_train["data_wait_time"].append(self.gam_data_wait_time) # Seconds this step spent blocked on the dataloaders
+        self.gam_data_wait_time = 0
+        self.keep_avg_train["frames_per_second"].append(frames_per_second)
+
+        self.training_iters += 1
+
+        loss_delta = 0
+        if self.model.training_stage<=2 and len(self.avg_disc_loss_per_epoch[self.model.training_stage-1])>1:
+            adlpe = self.avg_disc_loss_per_epoch[self.model.training_stage-1] # Shorter variable name
+            self.avg_disc_loss_per_epoch_deltas[self.model.training_stage-1].append((adlpe[-2]-adlpe[-1])/adlpe[-2])
+            adlped = self.avg_disc_loss_per_epoch_deltas[self.model.training_stage-1] # Shorter variable name
+
+            ckpt_AVG_SPAN = 10
+            loss_delta = np.mean(adlped if len(adlped)<ckpt_AVG_SPAN else adlped[-ckpt_AVG_SPAN:])
+
+        return {
+            "step_time": step_time,
+            "avg_loss": round(np.mean(self.keep_avg_train["loss"][-10:]),4),
+            "frames_per_second": int(np.mean(self.keep_avg_train["frames_per_second"])),
+            "loss_delta": loss_delta,
+        }
 
 
-                else:
-                    self.target_patience_count = 0
+    async def log_step (self, step_info):
+        # Tensorboard + graphs.json logging
+        self.steps_since_log += 1
+        if self.steps_since_log >= 21:
+            self.steps_since_log = 0
+            avg_fps = round(np.mean(self.keep_avg_train["frames_per_second"]),4)
+            avg_loss = round(np.mean(self.keep_avg_train["loss"]),4)
+            avg_loss_kl = round(np.mean(self.keep_avg_train["loss_kl"][-10:]),4)
+            avg_loss_duration = round(np.mean(self.keep_avg_train["loss_duration"][-10:]),4)
+            avg_loss_mel = round(np.mean(self.keep_avg_train["loss_mel"][-10:]),4)
+
+            self.writer.add_scalar(f'loss/loss', avg_loss, self.total_steps_done)
+            self.writer.add_scalar(f'loss/kl', avg_loss_kl, self.total_steps_done)
+            self.writer.add_scalar(f'loss/duration', avg_loss_duration, self.total_steps_done)
+            self.writer.add_scalar(f'loss/mel', avg_loss_mel, self.total_steps_done)
+
+            self.writer.add_scalar(f'meta/frames/s', avg_fps, self.total_steps_done)
+            self.writer.add_scalar(f'meta/padding_efficiency', round(np.mean(self.keep_avg_train["padding_efficiency"][-21:]),4), self.total_steps_done)
+            self.writer.add_scalar(f'meta/data_wait_ms', round(np.mean(self.keep_avg_train["data_wait_time"][-21:])*1000,2), self.total_steps_done)
+            self.writer.add_scalar(f'meta/lrate', self.optimizer[0].param_groups[0]['lr'], self.total_steps_done)
+
+            if self.profiler.enabled:
+                self.last_profile = self.profiler.get_averages()
+                self.profiler.reset()
+                for phase, phase_ms in self.last_profile.items():
+                    self.writer.add_scalar(f'profile/{phase}_ms', phase_ms, self.total_steps_done)
+
+        self.graphs_json["stages"][str(self.model.training_stage)]["loss"].append([self.total_steps_done, step_info["avg_loss"]])
+        if (self.training_iters%self.save_step) % 10 == 0:
+            with open(f'{self.dataset_output}/graphs.json', "w+", encoding="utf8") as f:
+                f.write(json.dumps(self.graphs_json))
+
+
+    async def checkpoint_step (self, step_info):
+        # Checkpointing, and the early stopping/stage transitions
+        if self.training_iters % self.save_step != 0 or self.training_iters == 0:
+            return
 
+        frames_per_second = step_info["frames_per_second"]
+        avg_loss = step_info["avg_loss"]
+        loss_delta = step_info["loss_delta"]
 
-                output_path = f'{self.dataset_output}/xVAPitch_{self.total_steps_done}.pt'
-                self.do_samples_output = True # Don't do here, as there's still stuff loaded in VRAM at this point, and adding the visualizations on top might OOM unnecessarily
+        ckpt_time = time.time() - self.ckpt_start_time
+        ckpt_avg_loss_disc = np.mean(self.keep_avg_train["loss_disc"]) # Can't explain it - seems the best way to gauge an automatic stopping time
+        if self.model.training_stage<=2:
+            self.avg_disc_loss_per_epoch[self.model.training_stage-1].append(ckpt_avg_loss_disc)
 
-                if not has_saved:
-                    del batch, loss_dict
-                    batch = None
-                    loss_dict = None
-                    self.save_checkpoint(frames_s=frames_per_second, avg_loss=avg_loss, loss_delta=loss_delta, fpath=output_path, ckpt_time=ckpt_time, doPrintLog=True)
+        if self.last_profile is not None:
+            if "profile" not in self.graphs_json.keys():
+                self.graphs_json["profile"] = []
+            self.graphs_json["profile"].append([self.total_steps_done, self.last_profile])
 
-                if self.args.analyze_loss:
-                    with open(f'{self.dataset_output}/loss_analysis.pkl', "wb+") as f:
-                        pkl.dump(self.loss_analysis_dict, f)
+        has_saved = False
+        if loss_delta:
 
-                self.writer.flush()
+            self.graphs_json["stages"][str(self.model.training_stage)]["loss_delta"].append([self.total_steps_done, round(loss_delta*100, 3)])
+            with open(f'{self.dataset_output}/graphs.json', "w+", encoding="utf8") as f:
+                f.write(json.dumps(self.graphs_json))
 
 
+            # Early stopping
+            if loss_delta < self.target_deltas[self.model.training_stage-1]:
 
-            if loss_delta:
-                loss_delta = round(loss_delta*100, 3)
-                avg_losses_print = f' | Avg loss % delta: {loss_delta} '
-                if self.model.training_stage<=2:
-                    target_delta = round(self.target_deltas[self.model.training_stage-1]*100, 3)
-                    avg_losses_print += f'| Target: {target_delta} '
-                if self.target_patience_count>0:
-                    avg_losses_print += f'| Hit: {self.target_patience_count}/{self.target_patience} '
+                self.target_patience_count += 1
+                if self.model.training_stage<3 and self.target_patience_count>=self.target_patience:
 
+                    output_path = os.path.join(self.dataset_output, f"xVAPitch_{self.total_steps_done}.pt")
+
+                    if self.model.training_stage==1:
+                        has_saved = True
+                        self.save_checkpoint(frames_s=frames_per_second, avg_loss=avg_loss, loss_delta=loss_delta, fpath=output_path, ckpt_time=ckpt_time, doPrintLog=True)
+                        self.print_and_log(f'Finished Stage 1. Moving on.. \n\n', save_to_file=self.dataset_output)
+                        self.print_and_log(f'\nStage 2: Full training', save_to_file=self.dataset_output)
+                        self.model.training_stage = 2
+                        self.target_patience_count = 0
+                        step_info["loss_delta"] = 0
+                        if self.websocket:
+                            await self.websocket.send(f'Set stage to: {self.model.training_stage} ')
+
+                    elif self.model.training_stage==2:
+                        self.END_OF_TRAINING = True
+
+                        self.JUST_FINISHED_STAGE = True
+                        if self.logger:
+                            self.logger.info("[Trainer] JUST_FINISHED_STAGE...")
+                        self.model.training_stage += 1
+
+                        has_saved = True
+                        self.save_checkpoint(frames_s=frames_per_second, avg_loss=avg_loss, loss_delta=loss_delta, fpath=output_path, ckpt_time=ckpt_time, doPrintLog=True)
+                        self.print_and_log(f'Finished Stage 2. Stopping training. \n\n', save_to_file=self.dataset_output)
+                        self.checkpoint_writer.wait() # Make sure the final checkpoint is on disk before training ends
+                        raise
             else:
-                avg_losses_print = "                                                                   "
-            iter_loss = round(np.mean(self.keep_avg_train["loss_disc"][-10:]), 4) # Average over the last 10 steps' losses (use the disc loss as that's the one that the deltas operate over)
-            print_line = f'Stage: {self.model.training_stage} | Steps: {(self.total_steps_done)} | Ckpt: {self.training_iters%self.save_step}/{self.save_step} | Loss: {iter_loss} | frames/s {frames_per_second}{avg_losses_print}   '
+                self.target_patience_count = 0
+            # round(loss_delta*100, 3)
 
 
-            self.training_log_live_line = print_line
-            self.print_and_log(save_to_file=self.dataset_output)
+        else:
+            self.target_patience_count = 0
 
 
+        output_path = f'{self.dataset_output}/xVAPitch_{self.total_steps_done}.pt'
+        self.do_samples_output = True # Don't do here, as there's still stuff loaded in VRAM at this point, and adding the visualizations on top might OOM unnecessarily
 
-            self.finetune_counter += 1
-            self.finetune_it = True
-            if self.finetune_counter>=self.FINETUNE_WEIGHT:
-                self.finetune_it = False
-                self.finetune_counter = 0
-            self.total_steps_done += self.gam
-            self.training_log_live_line = print_line
+        if not has_saved:
+            self.save_checkpoint(frames_s=frames_per_second, avg_loss=avg_loss, loss_delta=loss_delta, fpath=output_path, ckpt_time=ckpt_time, doPrintLog=True)
 
-        del batch, loss_dict
+        if self.args.analyze_loss:
+            with open(f'{self.dataset_output}/loss_analysis.pkl', "wb+") as f:
+                pkl.dump(self.loss_analysis_dict, f)
 
-        if self.do_samples_output:
-            self.do_samples_output = False
-            with torch.cuda.amp.autocast(enabled=self.amp):
-                self.output_samples(f'{self.dataset_output}/viz/{self.total_steps_done}')
+        self.writer.flush()
+
+
+    async def print_step (self, step_info):
+        # The live training progress line
+        loss_delta = step_info["loss_delta"]
+        if loss_delta:
+            loss_delta = round(loss_delta*100, 3)
+            avg_losses_print = f' | Avg loss % delta: {loss_delta} '
+            if self.model.training_stage<=2:
+                target_delta = round(self.target_deltas[self.model.training_stage-1]*100, 3)
+                avg_losses_print += f'| Target: {target_delta} '
+            if self.target_patience_count>0:
+                avg_losses_print += f'| Hit: {self.target_patience_count}/{self.target_patience} '
 
-        if self.running:
-            await self.iteration()
         else:
-            return
+            avg_losses_print = "                                                                   "
+        iter_loss = round(np.mean(self.keep_avg_train["loss_disc"][-10:]), 4) # Average over the last 10 steps' losses (use the disc loss as that's the one that the deltas operate over)
+        print_line = f'Stage: {self.model.training_stage} | Steps: {(self.total_steps_done)} | Ckpt: {self.training_iters%self.save_step}/{self.save_step} | Loss: {iter_loss} | frames/s {step_info["frames_per_second"]}{avg_losses_print}   '
 
+        self.training_log_live_line = print_line
+        self.print_and_log(save_to_file=self.dataset_output)
 
 
+    async def samples_output_step (self):
+        if self.do_samples_output:
+            self.do_samples_output = False
+            with self.profiler.phase("sample_output", wall=True):
+                with torch.cuda.amp.autocast(enabled=self.amp):
+                    self.output_samples(f'{self.dataset_output}/viz/{self.total_steps_done}')
+
 
 
 
@@ -922,13 +998,7 @@ class xVAPitchTrainer(object):
 
 
     def save_checkpoint (self, frames_s=0, avg_loss=None, loss_delta=None, fpath="out.pt", ckpt_time=None, doPrintLog=True):
-        torch.cuda.empty_cache()
-
-        # Clear out the oldest checkpoint(s), to only keep a rolling window of the latest few checkpoints
-        old_ckpts = sorted([fname for fname in os.listdir(self.dataset_output) if fname.startswith("xVAPitch_") and " - " not in fname], key=sort_xvap)
-        if len(old_ckpts)>2:
-            for ckpt in old_ckpts[:-2]:
-                os.remove(f'{self.dataset_output}/{ckpt}')
+        io_start_time = time.time()
 
         # Log the epoch summary
         # print_line = f'Stage: {self.model.training_stage} | Epoch: {self.epoch} | {self.dataset_output.split("/")[-1]}~{self.total_steps_done}.pt | Time: {format_time(ckpt_time)} | frames/s: {int(frames_s)}'
@@ -936,18 +1006,27 @@ class xVAPitchTrainer(object):
         print("\r", end="", flush=True)
         print_line = f'Stage: {self.model.training_stage} | {self.dataset_output.split("/")[-1]}~{self.total_steps_done}.pt | Time: {format_time(ckpt_time)} | frames/s: {int(frames_s)}'
 
+        for loader_name, workers_stats in self.cache_stats.items():
+            if len(workers_stats):
+                self.print_and_log(f'Sample cache ({loader_name}) | {format_cache_stats(merge_cache_stats(workers_stats))}', save_to_file=self.dataset_output)
+
+        # Snapshot everything to the CPU once, here, so training can carry on while the background thread writes to disk
+        # The fp16 conversion is also done on the snapshot, instead of casting the live model to half and back
         if hasattr(self.model, "module"):
-            model_state = self.model.module.state_dict()
+            model_state = snapshot_to_cpu(self.model.module.state_dict())
         else:
-            model_state = self.model.state_dict()
-        optimizer_state = [optim.state_dict() for optim in self.optimizer]
+            model_state = snapshot_to_cpu(self.model.state_dict())
+        optimizer_state = [snapshot_to_cpu(optim.state_dict()) for optim in self.optimizer]
         scaler_state = self.scaler.state_dict()
 
-
         sd = {k.replace('module.', ''): v for k, v in model_state.items()}
         del model_state
-        sd["avg_disc_loss_per_epoch"] = self.avg_disc_loss_per_epoch
-        sd["avg_disc_loss_per_epoch_deltas"] = self.avg_disc_loss_per_epoch_deltas
+        sd_half = snapshot_to_cpu(sd, half=True)
+        # Copies, as training keeps appending to the live lists while the writer thread pickles the snapshot
+        avg_disc_loss_per_epoch = copy.deepcopy(self.avg_disc_loss_per_epoch)
+        avg_disc_loss_per_epoch_deltas = copy.deepcopy(self.avg_disc_loss_per_epoch_deltas)
+        sd["avg_disc_loss_per_epoch"] = avg_disc_loss_per_epoch
+        sd["avg_disc_loss_per_epoch_deltas"] = avg_disc_loss_per_epoch_deltas
 
         checkpoint = {
             "model": sd,
@@ -957,8 +1036,8 @@ class xVAPitchTrainer(object):
             "epoch": self.epoch,
             "lr": self.optimizer[0].param_groups[0]["lr"],
             "date": datetime.date.today().strftime("%B %d, %Y"),
-            "avg_disc_loss_per_epoch": self.avg_disc_loss_per_epoch,
-            "avg_disc_loss_per_epoch_deltas": self.avg_disc_loss_per_epoch_deltas,
+            "avg_disc_loss_per_epoch": avg_disc_loss_per_epoch,
+            "avg_disc_loss_per_epoch_deltas": avg_disc_loss_per_epoch_deltas,
             "training_stage": self.model.training_stage,
         }
         del optimizer_state, scaler_state
@@ -977,28 +1056,27 @@ class xVAPitchTrainer(object):
         else:
             print_line += "                   "
 
-        if self.amp:
-            checkpoint['scaler'] = self.scaler.state_dict()
-        torch.save(checkpoint, fpath)
-
-        model_half = self.model.half()
-        if len(self.gpus)>1:
-            model_half = model_half.module
-        torch.save(model_half.state_dict(), f'{self.dataset_output}/{self.dataset_id}.pt')
+        saves = [[checkpoint, fpath], [sd_half, f'{self.dataset_output}/{self.dataset_id}.pt']]
 
         self.backup_model_counter += 1
         if self.backup_model_counter >= self.backup_model_every_x_ckpt:
             os.makedirs(f'{self.dataset_output}/viz/{self.total_steps_done}', exist_ok=True)
-            torch.save(model_half.state_dict(), f'{self.dataset_output}/viz/{self.total_steps_done}/{self.dataset_id}.pt')
+            saves.append([sd_half, f'{self.dataset_output}/viz/{self.total_steps_done}/{self.dataset_id}.pt'])
             self.backup_model_counter = 0
 
+        dataset_output = self.dataset_output
+        def delete_old_checkpoints ():
+            # Clear out the oldest checkpoint(s), to only keep a rolling window of the latest few checkpoints
+            old_ckpts = sorted([fname for fname in os.listdir(dataset_output) if fname.startswith("xVAPitch_") and " - " not in fname], key=sort_xvap)
+            if len(old_ckpts)>2:
+                for ckpt in old_ckpts[:-2]:
+                    os.remove(f'{dataset_output}/{ckpt}')
 
-        torch.cuda.empty_cache()
-        del model_half
-
-        self.model.float()
-        checkpoint["model"]["step"] = self.total_steps_done
-        self.model.load_state_dict(checkpoint["model"], strict=False)
+        for err_msg in self.checkpoint_writer.errors:
+            self.print_and_log(f'\nA previous checkpoint failed to save: {err_msg}', save_to_file=self.dataset_output)
+        self.checkpoint_writer.errors = []
+        self.checkpoint_writer.submit(saves, before_fn=delete_old_checkpoints)
+        del sd_half, saves
 
 
         with open(f'{self.dataset_output}/{self.dataset_id}.json', "w+", encoding="utf8") as f:
@@ -1022,6 +1100,7 @@ class xVAPitchTrainer(object):
             json.dump(json_data, f, indent=4)
 
         del checkpoint
+        self.profiler.add("checkpoint_io", time.time()-io_start_time) # Only the part that blocks training
         self.training_log_live_line = ""
         if doPrintLog:
             self.print_and_log(print_line+"      ", end="", flush=True, save_to_file=self.dataset_output)
@@ -1128,6 +1207,12 @@ class xVAPitchTrainer(object):
         parser.add_argument('--vocoder', type=int, default=0)
         parser.add_argument('--ft_weight', type=int, default=20)
         parser.add_argument('--do_loss_sorting', type=int, default=1)
+        parser.add_argument('--feature_store', type=int, default=1) # Pre-extract wav/mel/linear features to disk once, instead of re-computing them every epoch
+        parser.add_argument('--cache_mb_ft', type=int, default=-1) # RAM budget (MB) for the fine-tune dataset's sample cache, split across the dataloader workers. -1: 2048, or 64 (text/embeddings only) with the feature store
+        parser.add_argument('--cache_mb_priors', type=int, default=0) # RAM budget (MB) for the priors dataset's sample cache
+        parser.add_argument('--bucketing', type=int, default=1) # Batch together utterances of similar length, to reduce padding
+        parser.add_argument('--batch_frames', type=int, default=0) # Padded mel frames budget per batch, instead of a fixed batch size (needs --bucketing)
+        parser.add_argument('--profile', type=int, default=1) # Log per-phase step timings (data wait, H2D copy, forward/backward, optimizer, checkpoint I/O)
         parser.add_argument('--data', default="")
         args = parser.parse_args()
         return args
@@ -1167,8 +1252,7 @@ class xVAPitchTrainer(object):
             pre_cache_g2p([self.dataset_input], lang=self.lang)
             with open(f'{self.dataset_input}/.has_precached_g2p', "w+") as f: # TODO, detect dataset changes, to invalidate this? md5?
                 f.write("")
-        do_preExtract_embs = os.path.exists(f'{self.dataset_input}/.has_extracted_embs') # TODO, detect dataset changes, to invalidate this? md5?
-        train_samples_finetune, _, _, _ = read_datasets(languages, [self.dataset_input], extract_embs=do_preExtract_embs, device=device, data_mult=args.data_mult_ft, trainer=self, cmd_training=self.cmd_training, is_ft=True)
+        train_samples_finetune, _, _, _ = read_datasets(languages, [self.dataset_input], extract_embs=True, device=device, data_mult=args.data_mult_ft, trainer=self, cmd_training=self.cmd_training, is_ft=True)
         base_num_ft_samples = int(len(train_samples_finetune)/args.data_mult_ft)
         self.print_and_log(f'Fine-tune dataset files: {base_num_ft_samples}', save_to_file=self.dataset_output)
 
@@ -1183,8 +1267,7 @@ class xVAPitchTrainer(object):
             pre_cache_g2p(priors_datasets)
             with open(f'{priors_datasets_root}/.has_precached_g2p', "w+") as f: # TODO, detect dataset changes, to invalidate this? md5?
                 f.write("")
-        do_preExtract_embs = os.path.exists(f'{priors_datasets_root}/.has_extracted_embs') # TODO, detect dataset changes, to invalidate this? md5?
-        train_samples, total_num_speakers, _, languages_loaded = read_datasets(languages, priors_datasets, extract_embs=do_preExtract_embs, device=device, data_mult=args.data_mult, trainer=self, cmd_training=self.cmd_training, is_ft=False)
+        train_samples, total_num_speakers, _, languages_loaded = read_datasets(languages, priors_datasets, extract_embs=True, device=device, data_mult=args.data_mult, trainer=self, cmd_training=self.cmd_training, is_ft=False)
         self.priors_languages_loaded = languages_loaded
         self.print_and_log(f'Priors datasets files: {len(train_samples)} | Number of datasets: {total_num_speakers}', save_to_file=self.dataset_output)
 
@@ -1194,40 +1277,70 @@ class xVAPitchTrainer(object):
             meta_data=train_samples_finetune,
             min_seq_len=15,
             lang_override=self.lang,
-            is_ft=True
+            is_ft=True,
+            use_feature_store=args.feature_store,
+            cache_bytes=get_cache_mb_ft(args)*1024*1024
         )
         train_dataset = TTSDataset(
             args,
             meta_data=train_samples,
             min_seq_len=15,
+            use_feature_store=args.feature_store,
+            cache_bytes=args.cache_mb_priors*1024*1024
         )
         train_dataset.sort_and_filter_items()
         finetune_dataset.sort_and_filter_items()
 
-        sampler = get_language_weighted_sampler(train_dataset.items)
-        train_loader = DataLoader(
-            train_dataset,
-            batch_size=self.batch_size,
-            shuffle=args.hifi_only,
-            collate_fn=train_dataset.collate_fn,
-            drop_last=True,
-            sampler=sampler,
-            persistent_workers=args.workers>0,
-            num_workers=args.workers,
-            pin_memory=args.workers>0,
-        )
-        finetune_loader = DataLoader(
-            finetune_dataset,
-            batch_size=self.batch_size,
-            shuffle=args.hifi_only,
-            collate_fn=train_dataset.collate_fn,
-            drop_last=False,
-            persistent_workers=args.workers>0,
-            num_workers=args.workers,
-            pin_memory=args.workers>0,
-        )
-
-        batch_num_steps = int(len(train_loader.dataset) / (self.batch_size))
+        if args.feature_store:
+            finetune_dataset.extract_features(workers=max(1, args.workers), trainer=self, cmd_training=self.cmd_training)
+            train_dataset.extract_features(workers=max(1, args.workers), trainer=self, cmd_training=self.cmd_training)
+
+        if args.bucketing:
+            self.print_and_log(f'Length-bucketed batching{f" | Frames budget per batch: {args.batch_frames}" if args.batch_frames else ""}', save_to_file=self.dataset_output)
+            train_loader = DataLoader(
+                train_dataset,
+                batch_sampler=BucketedBatchSampler(train_dataset, self.batch_size, max_frames=args.batch_frames, language_weighted=True, drop_last=True),
+                collate_fn=train_dataset.collate_fn,
+                persistent_workers=args.workers>0,
+                num_workers=args.workers,
+                pin_memory=args.workers>0,
+            )
+            finetune_loader = DataLoader(
+                finetune_dataset,
+                batch_sampler=BucketedBatchSampler(finetune_dataset, self.batch_size, max_frames=args.batch_frames, language_weighted=False, drop_last=False, shuffle=bool(args.hifi_only)),
+                collate_fn=finetune_dataset.collate_fn,
+                persistent_workers=args.workers>0,
+                num_workers=args.workers,
+                pin_memory=args.workers>0,
+            )
+        else:
+            sampler = get_language_weighted_sampler(train_dataset.items)
+            train_loader = DataLoader(
+                train_dataset,
+                batch_size=self.batch_size,
+                shuffle=args.hifi_only,
+                collate_fn=train_dataset.collate_fn,
+                drop_last=True,
+                sampler=sampler,
+                persistent_workers=args.workers>0,
+                num_workers=args.workers,
+                pin_memory=args.workers>0,
+            )
+            finetune_loader = DataLoader(
+                finetune_dataset,
+                batch_size=self.batch_size,
+                shuffle=args.hifi_only,
+                collate_fn=finetune_dataset.collate_fn,
+                drop_last=False,
+                persistent_workers=args.workers>0,
+                num_workers=args.workers,
+                pin_memory=args.workers>0,
+            )
+
+        if args.bucketing:
+            batch_num_steps = len(train_loader.batch_sampler) # Variable batch sizes, in --batch_frames mode
+        else:
+            batch_num_steps = int(len(train_loader.dataset) / (self.batch_size))
         return train_loader, finetune_loader, batch_num_steps, base_num_ft_samples
 
 
@@ -1252,7 +1365,8 @@ class xVAPitchTrainer(object):
             self.args,
             meta_data=loss_sorting_init_train_samples_finetune,
             min_seq_len=0,
-            lang_override=self.lang
+            lang_override=self.lang,
+            use_feature_store=self.args.feature_store
         )
         loss_sorting_init_loader = DataLoader(
             loss_sorting_init_finetune_dataset,
@@ -1282,7 +1396,7 @@ class xVAPitchTrainer(object):
                 batch = self.model.format_batch(batch)
                 for k, v in batch.items():
                     if torch.is_tensor(v):
-                        batch[k] = v.contiguous().to(device, non_blocking=True)
+                        batch[k] = v.to(device, non_blocking=True)
 
                 # Do the model forward
                 y_disc_cache = None
@@ -1344,22 +1458,23 @@ class xVAPitchTrainer(object):
 
                 text_inputs, _ = tp.text_to_sequence(texts[lang])
 
-                text_inputs = torch.tensor(text_inputs).to(self.device).unsqueeze(dim=0)
-                language_id_tensor = torch.tensor(language_id).to(self.device)
-
-                for ei,emb in enumerate(embeddings):
+                # All the styles in one batch
+                text_inputs, x_lengths = pad_sequences([text_inputs for _ in embeddings])
+                language_ids = torch.tensor([language_id for _ in embeddings]).to(self.device)
 
-                    print(f'\rOutputting visualization samples. Language: {li+1}/{len(langs)} | Style: {ei+1}/{len(embeddings)}  ', end="", flush=True)
-                    torch.cuda.empty_cache()
+                print(f'\rOutputting visualization samples. Language: {li+1}/{len(langs)} | Styles: {len(embeddings)}  ', end="", flush=True)
+                torch.cuda.empty_cache()
 
-                    output = self.model.infer(text_inputs, language_id_tensor, emb, pacing=1)
+                with torch.no_grad():
+                    outputs = self.model.infer_batch(text_inputs.to(self.device), x_lengths.to(self.device), language_ids, torch.stack(embeddings), pacing=1)
+                for ei,output in enumerate(outputs):
                     wav = output.squeeze().cpu().detach().numpy()
                     wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
 
                     out_path = f'{output_folder}/{lang}_{ei}_tts.wav'
                     scipy.io.wavfile.write(out_path, 22050, wav_norm.astype(np.int16))
                     del wav
-                del language_id_tensor, text_inputs
+                del language_ids, text_inputs, x_lengths, outputs
 
         del embeddings
         torch.cuda.empty_cache()
@@ -1393,6 +1508,17 @@ class xVAPitchTrainer(object):
 
 
 
+# Batched inference, in two passes. The lines' mel frame counts are first predicted (text encoder + duration predictor
+# only), in batches of lines sorted by symbol count, padded to under INFER_MAX_BATCH_SYMBOLS. The lines are then sorted
+# by their predicted frames, and synthesized in batches padded to under INFER_MAX_BATCH_FRAMES, as the vocoder's cost and
+# memory use scale with the padded frames, not the symbols.
+# On CPU, batching was slower than one line at a time (12 random length lines: 23.4s batched vs 12.2s, and 17.0s vs
+# 15.1s even for equal length lines), as the convolutions already use all the cores for one line, and the padding is
+# extra work. So on CPU, the lines are synthesized one at a time, with infer()
+INFER_MAX_BATCH_SIZE = 32
+INFER_MAX_BATCH_SYMBOLS = 32*200
+INFER_MAX_BATCH_FRAMES = 32*500
+
 class xVAPitchModel(object):
     def __init__(self, logger, PROD, device, models_manager):
         super(xVAPitchModel, self).__init__()
@@ -1462,6 +1588,70 @@ class xVAPitchModel(object):
         torch.cuda.empty_cache()
         return ""
 
+    def get_lang_tp (self, lang):
+        if lang not in self.lang_tp.keys():
+            self.lang_tp[lang] = get_text_preprocessor(lang, self.base_dir)
+        return self.lang_tp[lang]
+
+    def infer_batch (self, texts, outputs, embeddings, languages=None, pacings=None, max_batch_size=INFER_MAX_BATCH_SIZE, max_batch_symbols=INFER_MAX_BATCH_SYMBOLS, max_batch_frames=INFER_MAX_BATCH_FRAMES):
+        """Batched infer(), writing one wav file per text (to outputs), each with its own speaker embedding, language
+        (default: "en") and pacing (default: 1). One line at a time on CPU"""
+        languages = ["en" for _ in texts] if languages is None else languages
+        pacings = [1 for _ in texts] if pacings is None else pacings
+
+        sequences = [self.get_lang_tp(lang).text_to_sequence(text)[0] for text, lang in zip(texts, languages)]
+
+        def write_wav (index, wav):
+            wav = wav.squeeze().cpu().detach().numpy()
+            wav_norm = wav * (32767 / max(0.01, np.max(np.abs(wav))))
+            scipy.io.wavfile.write(outputs[index], 22050, wav_norm.astype(np.int16))
+
+        def make_batches (lengths, max_batch_length):
+            batches = []
+            batch = []
+            for index in sorted(range(len(lengths)), key=lambda index: -lengths[index]):
+                # Longest first, so the batch's padded length is that of its first line
+                if len(batch) and ((len(batch)+1)*lengths[batch[0]] > max_batch_length or len(batch)>=max_batch_size):
+                    batches.append(batch)
+                    batch = []
+                batch.append(index)
+            if len(batch):
+                batches.append(batch)
+            return batches
+
+        def batch_inputs (batch):
+            text_inputs, x_lengths = pad_sequences([sequences[index] for index in batch])
+            language_ids = torch.tensor([self.language_id_mapping[languages[index]] for index in batch])
+            batch_embeddings = torch.stack([torch.tensor(embeddings[index]).float() for index in batch])
+            batch_pacings = torch.tensor([float(pacings[index]) for index in batch])
+            return text_inputs.to(self.device), x_lengths.to(self.device), language_ids.to(self.device), batch_embeddings.to(self.device), batch_pacings.to(self.device)
+
+        with torch.no_grad():
+            if torch.device(self.device).type=="cpu":
+                for index, sequence in enumerate(sequences):
+                    text_inputs = torch.tensor(sequence).to(self.device).unsqueeze(dim=0)
+                    language_id_tensor = torch.tensor(self.language_id_mapping[languages[index]]).to(self.device)
+                    embedding = torch.tensor(embeddings[index]).float().to(self.device)
+                    write_wav(index, self.model.infer(text_inputs, language_id_tensor, embedding, pacing=float(pacings[index])))
+                return ""
+
+            frames = [0 for _ in texts]
+            for batch in make_batches([len(sequence) for sequence in sequences], max_batch_symbols):
+                text_inputs, x_lengths, language_ids, batch_embeddings, batch_pacings = batch_inputs(batch)
+                y_lengths = self.model.infer_batch_durations(text_inputs, x_lengths, language_ids, batch_embeddings, pacing=batch_pacings)[-1]
+                for index, y_length in zip(batch, y_lengths.cpu().tolist()):
+                    frames[index] = y_length
+
+            for batch in make_batches(frames, max_batch_frames):
+                text_inputs, x_lengths, language_ids, batch_embeddings, batch_pacings = batch_inputs(batch)
+                wavs = self.model.infer_batch(text_inputs, x_lengths, language_ids, batch_embeddings, pacing=batch_pacings)
+                for index, wav in zip(batch, wavs):
+                    write_wav(index, wav)
+                del wavs, text_inputs, x_lengths, language_ids, batch_embeddings, batch_pacings
+
+        torch.cuda.empty_cache()
+        return ""
+
     def get_argparse(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('-gpus', default="1")
@@ -1507,6 +1697,12 @@ class xVAPitchModel(object):
         parser.add_argument('--vocoder', type=int, default=0)
         parser.add_argument('--ft_weight', type=int, default=20)
         parser.add_argument('--do_loss_sorting', type=int, default=1)
+        parser.add_argument('--feature_store', type=int, default=1) # Pre-extract wav/mel/linear features to disk once, instead of re-computing them every epoch
+        parser.add_argument('--cache_mb_ft', type=int, default=-1) # RAM budget (MB) for the fine-tune dataset's sample cache, split across the dataloader workers. -1: 2048, or 64 (text/embeddings only) with the feature store
+        parser.add_argument('--cache_mb_priors', type=int, default=0) # RAM budget (MB) for the priors dataset's sample cache
+        parser.add_argument('--bucketing', type=int, default=1) # Batch together utterances of similar length, to reduce padding
+        parser.add_argument('--batch_frames', type=int, default=0) # Padded mel frames budget per batch, instead of a fixed batch size (needs --bucketing)
+        parser.add_argument('--profile', type=int, default=1) # Log per-phase step timings (data wait, H2D copy, forward/backward, optimizer, checkpoint I/O)
         parser.add_argument('--data', default="")
         args = parser.parse_args()
         return args
@@ -1530,3 +1726,10 @@ def last_checkpoint(dataset_output):
 
 
 
+
+def get_cache_mb_ft(args):
+    # -1 (the default) picks the fine-tune sample cache budget. The feature store serves the wav/mel/linear features, so
+    # then only the text/speaker embeddings are cached, which need far less
+    if args.cache_mb_ft>=0:
+        return args.cache_mb_ft
+    return 64 if args.feature_store else 2048
@@ -191,22 +191,33 @@ if __name__ == '__main__':
                     except:
                         logger.info(f'TRAINING_ERROR:{traceback.format_exc()}')
                         await websocket.send(f'TRAINING_ERROR:{traceback.format_exc()}')
+                elif task=="cancelTask":
+                    models_manager.cancel_task(model)
+                elif task=="setWorkers":
+                    models_manager.worker_pool.set_workers(data)
                 else:
                     # Tasks
                     await models_manager.init_model(model, websocket)
                     if task=="runTask":
                         logger.info(f'Task: {model}')
-                        try:
-                            await models_manager.models_bank[model].runTask(data, websocket=websocket)
-                        except:
-                            logger.info(traceback.format_exc())
-                            await websocket.send(f'ERROR:{traceback.format_exc()}')
+                        if getattr(models_manager.models(model), "uses_worker_pool", False):
+                            # Worker pool jobs run in the background, so that this websocket can still take messages (eg cancelTask) meanwhile
+                            asyncio.ensure_future(runTask(model, data, websocket))
+                        else:
+                            await runTask(model, data, websocket)
 
             except KeyboardInterrupt:
                 sys.exit()
             except:
                 logger.info(f'message: {message} | {traceback.format_exc()}')
 
+    async def runTask (model, data, websocket):
+        try:
+            await models_manager.run_task(model, data, websocket=websocket)
+        except:
+            logger.info(traceback.format_exc())
+            await websocket.send(f'ERROR:{traceback.format_exc()}')
+
     # https://stackoverflow.com/questions/59645272/how-do-i-pass-an-async-function-to-a-thread-target-in-python
     def between_callback(models_manager, data, websocket, gpus, resume):
         loop = asyncio.new_event_loop()